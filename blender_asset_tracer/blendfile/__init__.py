@@ -23,30 +23,61 @@
 import atexit
 import collections
 import functools
-import gzip
+import hashlib
+import io
 import logging
+import mmap
 import os
 import struct
 import pathlib
 import shutil
 import tempfile
+import threading
 import typing
-
-from . import exceptions, dna, header, magic_compression
+import weakref
+
+from . import (
+    blocktable,
+    exceptions,
+    dna,
+    dna_cache,
+    header,
+    magic_compression,
+    patching,
+    payload_cache,
+)
 from blender_asset_tracer import bpathlib
 
 log = logging.getLogger(__name__)
 
 FILE_BUFFER_SIZE = 1024 * 1024
+# Blocks larger than this are not kept in the payload cache; reading their
+# entire payload to get at a single field would cost more than it saves.
+MAX_CACHED_PAYLOAD_SIZE = 64 * 1024
 BFBList = typing.List["BlendFileBlock"]
+BFBSequence = typing.Sequence["BlendFileBlock"]
 
 _cached_bfiles = {}  # type: typing.Dict[pathlib.Path, BlendFile]
 
+# open_cached() can be called from multiple threads. The per-path locks
+# ensure each file is opened only once, without blocking the opening of
+# other files.
+_cache_lock = threading.Lock()
+_cache_path_locks = {}  # type: typing.Dict[pathlib.Path, threading.Lock]
+
 
 def open_cached(
-    path: pathlib.Path, mode="rb", assert_cached: typing.Optional[bool] = None
+    path: pathlib.Path,
+    mode="rb",
+    assert_cached: typing.Optional[bool] = None,
+    *,
+    defer_dna: bool = False,
 ) -> "BlendFile":
-    """Open a blend file, ensuring it is only opened once."""
+    """Open a blend file, ensuring it is only opened once.
+
+    :param defer_dna: passed to BlendFile() when the file is not cached yet.
+        The DNA of a cached file is still decoded on first use.
+    """
     my_log = log.getChild("open_cached")
     bfile_path = bpathlib.make_absolute(path)
 
@@ -57,20 +88,29 @@ def open_cached(
         elif not assert_cached and is_cached:
             raise AssertionError("File %s was cached" % bfile_path)
 
-    try:
-        bfile = _cached_bfiles[bfile_path]
-    except KeyError:
-        my_log.debug("Opening non-cached %s", path)
-        bfile = BlendFile(path, mode=mode)
-        _cached_bfiles[bfile_path] = bfile
-    else:
-        my_log.debug("Returning cached %s", path)
+    with _cache_lock:
+        path_lock = _cache_path_locks.setdefault(bfile_path, threading.Lock())
+
+    with path_lock:
+        try:
+            bfile = _cached_bfiles[bfile_path]
+        except KeyError:
+            my_log.debug("Opening non-cached %s", path)
+            bfile = BlendFile(path, mode=mode, defer_dna=defer_dna)
+            _cached_bfiles[bfile_path] = bfile
+        else:
+            my_log.debug("Returning cached %s", path)
 
     return bfile
 
 
 @atexit.register
 def close_all_cached() -> None:
+    # Locks are also created for files that failed to open, so they are
+    # forgotten even when no file is cached.
+    with _cache_lock:
+        _cache_path_locks.clear()
+
     if not _cached_bfiles:
         # Don't even log anything when there is nothing to close
         return
@@ -96,9 +136,16 @@ def _uncache(path: pathlib.Path):
 class BlendFile:
     """Representation of a blend file.
 
+    Block headers are stored in a columnar BlockTable. BlendFileBlock objects
+    are only created when they are accessed, and are kept in a weak cache, so
+    memory usage scales with the blocks that are actually in use.
+
     :ivar filepath: which file this object represents.
     :ivar raw_filepath: which file is accessed; same as filepath for
-        uncompressed files, but a temporary file for compressed files.
+        uncompressed files and for seekable ZStandard files that are read
+        directly, but a temporary file for other compressed files. Small
+        compressed files are decompressed into memory; raw_filepath is then
+        also the same as filepath.
     :ivar fileobj: the file object that's being accessed.
     """
 
@@ -110,7 +157,53 @@ class BlendFile:
     Set to False to disable this exception, and to return None instead.
     """
 
-    def __init__(self, path: pathlib.Path, mode="rb") -> None:
+    use_mmap = False
+    """Default for accessing blend files through a memory map.
+
+    When True, block headers and field values are unpacked directly from a
+    memory-mapped view of the (uncompressed) file, instead of seeking and
+    reading through the file object. Can be overridden per file with the
+    `use_mmap` parameter of the constructor.
+    """
+
+    in_memory_limit = 64 * 1024 * 1024
+    """Maximum decompressed size, in bytes, of compressed files kept in memory.
+
+    Compressed blend files that are larger than this once decompressed are
+    written to a temporary file instead. Set to 0 to always use a temporary
+    file.
+    """
+
+    payload_cache_size = 4 * 1024 * 1024
+    """Byte budget of the cache of block payloads, shared by all files.
+
+    When a file is not memory-mapped, the payloads of small blocks are kept
+    in a least-recently-used cache, so that reading multiple fields of the
+    same block only reads from the file once. Set to 0 to disable. Change
+    this with set_payload_cache_size(), so that the cache is resized.
+    """
+
+    zstd_level = 3
+    """ZStandard compression level used when recompressing modified files."""
+
+    zstd_threads = -1
+    """Number of threads for ZStandard recompression of modified files.
+
+    -1 uses as many threads as there are CPUs, and 0 compresses in the calling
+    thread.
+    """
+
+    gzip_level = 9
+    """GZip compression level used when recompressing modified files."""
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        mode="rb",
+        use_mmap: typing.Optional[bool] = None,
+        *,
+        defer_dna: bool = False,
+    ) -> None:
         """Create a BlendFile instance for the blend file at the path.
 
         Opens the file for reading or writing pending on the access. Compressed
@@ -118,22 +211,53 @@ class BlendFile:
 
         :param path: the file to open
         :param mode: see mode description of pathlib.Path.open()
+        :param use_mmap: access the file through a memory map. When None,
+            the class-level default BlendFile.use_mmap is used.
+        :param defer_dna: only read the file header and the block headers,
+            and postpone decoding the DNA until it is needed to access block
+            fields. This makes opening faster when only the header, block
+            codes, or a few blocks are inspected. See library_paths() for
+            reading the linked libraries without decoding the DNA.
         """
         self.filepath = path
         self.raw_filepath = path
         self._is_modified = False
         self.file_subversion = 0
+        self.defer_dna = defer_dna
+        if use_mmap is not None:
+            self.use_mmap = use_mmap
+        self._mmap = None  # type: typing.Optional[mmap.mmap]
+        self._view = None  # type: typing.Optional[memoryview]
         self.fileobj = self._open_file(path, mode)
-
-        self.blocks = []  # type: BFBList
+        self._payload_key = payload_cache.new_file_key()
+        self._patch_recorder = None  # type: typing.Optional[patching.PatchRecorder]
+
+        self.block_table = blocktable.BlockTable()
+        """Block headers of this file, in disk order, as parallel arrays."""
+        self._block_cache = (
+            weakref.WeakValueDictionary()
+        )  # type: weakref.WeakValueDictionary[int, BlendFileBlock]
+        self._sdna_index_overrides = {}  # type: typing.Dict[int, int]
+        """Refined SDNA index per row, see BlendFileBlock.refine_type()."""
+
+        self.blocks = blocktable.BlockList(
+            self.block_table, self._block_from_row
+        )  # type: BFBSequence
         """BlendFileBlocks of this file, in disk order."""
 
-        self.code_index = collections.defaultdict(
-            list
-        )  # type: typing.Dict[bytes, BFBList]
-        self.structs = []  # type: typing.List[dna.Struct]
-        self.sdna_index_from_id = {}  # type: typing.Dict[bytes, int]
-        self.block_from_addr = {}  # type: typing.Dict[int, BlendFileBlock]
+        self.code_index = blocktable.CodeIndex(
+            self.block_table, self._block_from_row
+        )  # type: typing.Mapping[bytes, BFBList]
+        self._structs = []  # type: typing.List[dna.Struct]
+        self._sdna_index_from_id = {}  # type: typing.Dict[bytes, int]
+        self._dna_loaded = False
+        self._dna_key = None  # type: typing.Optional[str]
+        self._referrers = (
+            None
+        )  # type: typing.Optional[typing.Dict[int, typing.List[typing.Tuple[int, int]]]]
+        self.block_from_addr = blocktable.AddressIndex(
+            self.block_table, self._block_from_row
+        )  # type: typing.Mapping[int, BlendFileBlock]
 
         self.header = header.BlendFileHeader(self.fileobj, self.raw_filepath)
         self.block_header_struct, self.block_header_fields = self.header.create_block_header_struct()
@@ -150,39 +274,233 @@ class BlendFile:
             correct magic bytes.
         """
 
-        decompressed = magic_compression.open(path, mode, FILE_BUFFER_SIZE)
+        decompressed = magic_compression.open(
+            path, mode, FILE_BUFFER_SIZE, self.in_memory_limit
+        )
 
         self.filepath = path
         self.is_compressed = decompressed.is_compressed
+        self.compression = decompressed.compression
+        self.zstd_frame_size = decompressed.zstd_frame_size
         self.raw_filepath = decompressed.path
 
+        if not self.use_mmap or decompressed.is_streamed:
+            # Streamed files are decompressed on the fly, and cannot be mapped.
+            return decompressed.fileobj
+        if decompressed.is_in_memory:
+            return self._map_memory(decompressed.fileobj)
+        self._map_file(decompressed.fileobj, mode)
         return decompressed.fileobj
 
+    def _map_file(self, fileobj: typing.IO[bytes], mode: str) -> None:
+        """Memory-map the opened file, for access without seek()/read() calls."""
+
+        if "+" in mode or "w" in mode:
+            access = mmap.ACCESS_WRITE
+        else:
+            access = mmap.ACCESS_READ
+
+        # Decompressed files are written through the file object, so make sure
+        # everything is on disk before mapping it.
+        fileobj.flush()
+        self._mmap = mmap.mmap(fileobj.fileno(), 0, access=access)
+        self._view = memoryview(self._mmap)
+        self.log.debug(
+            "Memory-mapped %s (%d bytes)", self.raw_filepath, len(self._mmap)
+        )
+
+    def _map_memory(self, buffer: io.BytesIO) -> mmap.mmap:
+        """Copy the in-memory file into an anonymous memory map.
+
+        The map is also returned for use as file object, so that reads and
+        writes through either one see the same data.
+        """
+
+        with buffer.getbuffer() as contents:
+            self._mmap = mmap.mmap(-1, len(contents))
+            self._mmap.write(contents)
+        buffer.close()
+        self._mmap.seek(0)
+        self._view = memoryview(self._mmap)
+        self.log.debug(
+            "Copied %s into anonymous memory map (%d bytes)",
+            self.raw_filepath,
+            len(self._mmap),
+        )
+        return self._mmap
+
+    def _unmap_file(self) -> None:
+        if self._mmap is None:
+            return
+
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if not self._mmap.closed:
+            self._mmap.close()
+        self._mmap = None
+
     def _load_blocks(self) -> None:
         """Read the blend file to load its DNA structure to memory."""
 
-        self.structs.clear()
-        self.sdna_index_from_id.clear()
-        while True:
-            block = BlendFileBlock(self)
-            if block.code == b"ENDB":
-                break
-
-            if block.code == b"DNA1":
-                self.decode_structs(block)
-            elif block.code == b"GLOB":
-                self.decode_glob(block)
-            else:
-                self.fileobj.seek(block.size, os.SEEK_CUR)
+        self._structs.clear()
+        self._sdna_index_from_id.clear()
+        self._dna_loaded = False
+        self._dna_key = None
+
+        # Scan all block headers in one go. With a memory map the headers are
+        # unpacked from the mapped view; otherwise they are read from the file
+        # object.
+        table = blocktable.scan_headers(
+            self.fileobj,
+            self.block_header_struct,
+            self.block_header_fields,
+            self.filepath,
+            view=self._view,
+        )
+        self.block_table = table
+        self._block_cache.clear()
+        self._sdna_index_overrides.clear()
+        self._payload_key = payload_cache.new_file_key()
+        self._referrers = None
+        self.blocks = blocktable.BlockList(table, self._block_from_row)
+        self.code_index = blocktable.CodeIndex(table, self._block_from_row)
+        self.block_from_addr = blocktable.AddressIndex(table, self._block_from_row)
+
+        for block in self.code_index[b"GLOB"]:
+            self.decode_glob(block)
+
+        if not self.code_index[b"DNA1"]:
+            raise exceptions.NoDNA1Block(
+                "No DNA1 block in file, not a valid .blend file", self.filepath
+            )
+        if not self.defer_dna:
+            self.load_dna()
+
+    def load_dna(self) -> None:
+        """Decode the DNA1 block, if this hasn't been done yet.
 
-            self.blocks.append(block)
-            self.code_index[block.code].append(block)
-            self.block_from_addr[block.addr_old] = block
+        This is done automatically when the file is opened, or on first use
+        of the DNA when the file was opened with defer_dna=True.
+        """
+        if self._dna_loaded:
+            return
 
-        if not self.structs:
+        for block in self.code_index[b"DNA1"]:
+            self.decode_structs(block)
+        if not self._structs:
             raise exceptions.NoDNA1Block(
                 "No DNA1 block in file, not a valid .blend file", self.filepath
             )
+        self._dna_loaded = True
+
+    def dna_key(self) -> str:
+        """Return the key of this file's DNA in the dna_cache module.
+
+        This only hashes the DNA1 block, it does not decode it.
+        """
+        if self._dna_key is None:
+            dna1_block = self.code_index[b"DNA1"][0]
+            self._dna_key = dna_cache.catalogue_key(
+                dna1_block.raw_data(),
+                self.header.pointer_size,
+                self.header.endian_str,
+            )
+        return self._dna_key
+
+    def field_location(
+        self, struct_name: bytes, field_name: bytes
+    ) -> dna_cache.FieldLocation:
+        """Return the offset and size of a top-level field of a DNA struct.
+
+        The location is cached per DNA in the dna_cache module, so that files
+        with the same DNA can read the field without decoding their DNA.
+
+        :raises KeyError: when the struct or field does not exist.
+        """
+        key = self.dna_key()
+        location = dna_cache.field_location(key, struct_name, field_name)
+        if location is not None:
+            return location
+
+        dna_struct = self.structs[self.sdna_index_from_id[struct_name]]
+        field, offset = dna_struct.field_from_path(
+            self.header.pointer_size, field_name
+        )
+        location = (offset, field.size)
+        dna_cache.put_field_location(key, struct_name, field_name, location)
+        return location
+
+    def library_paths(self) -> typing.List[bytes]:
+        """Return the paths of the libraries linked by this file.
+
+        The paths are returned as stored in the LI blocks, so they can be
+        relative to this file. When the location of the path in the Library
+        struct is cached for this DNA, the DNA is not decoded.
+        """
+        lib_blocks = self.code_index[b"LI"]
+        if not lib_blocks:
+            return []
+
+        offset, size = self.field_location(b"Library", b"name")
+        read_data0 = self.header.endian.read_data0
+        return [
+            read_data0(block.raw_data()[offset : offset + size])
+            for block in lib_blocks
+        ]
+
+    @property
+    def structs(self) -> typing.List[dna.Struct]:
+        """The DNA structs of this file, indexed by SDNA index."""
+        self.load_dna()
+        return self._structs
+
+    @property
+    def sdna_index_from_id(self) -> typing.Dict[bytes, int]:
+        """Mapping from DNA struct name to SDNA index."""
+        self.load_dna()
+        return self._sdna_index_from_id
+
+    def _block_from_row(self, row: int) -> "BlendFileBlock":
+        """Return the block for this row of the block table.
+
+        The block object is created when it is not in use already.
+        """
+        try:
+            return self._block_cache[row]
+        except KeyError:
+            pass
+
+        table = self.block_table
+        block = BlendFileBlock(
+            self,
+            table.code(row),
+            table.size[row],
+            table.addr_old[row],
+            self._sdna_index_overrides.get(row, table.sdna_index[row]),
+            table.count[row],
+            table.file_offset[row],
+            row=row,
+        )
+        self._block_cache[row] = block
+        return block
+
+    def _block_payload(self, block: "BlendFileBlock") -> typing.Optional[bytes]:
+        """Return the payload of the block, through the payload cache.
+
+        :returns: None when the block is too large to be cached; read from
+            the file object instead.
+        """
+        if block.size > MAX_CACHED_PAYLOAD_SIZE or _payload_cache.max_bytes <= 0:
+            return None
+
+        key = (self._payload_key, block.file_offset)
+        payload = _payload_cache.get(key)
+        if payload is None:
+            self.fileobj.seek(block.file_offset, os.SEEK_SET)
+            payload = self.fileobj.read(block.size)
+            _payload_cache.put(key, payload)
+        return payload
 
     def __repr__(self) -> str:
         clsname = self.__class__.__qualname__
@@ -223,10 +541,33 @@ class BlendFile:
         """Recompess the file when it is closed."""
         self.log.debug("Marking %s as modified", self.raw_filepath)
         self._is_modified = True
+        # Written values may be pointers.
+        self._referrers = None
+
+    def record_patches(self) -> patching.PatchList:
+        """Record writes to this file as patches, instead of performing them.
+
+        Until stop_recording_patches() is called, BlendFileBlock.set() leaves
+        the file untouched, and appends (file offset, new bytes) tuples to the
+        returned list instead. Reading a field back still returns its old
+        value.
+
+        :raises ValueError: when the file is compressed, as the offsets would
+            not refer to the bytes on disk.
+        """
+        if self.is_compressed:
+            raise ValueError("unable to record patches against compressed file")
+        self._patch_recorder = patching.PatchRecorder()
+        return self._patch_recorder.patches
+
+    def stop_recording_patches(self) -> None:
+        self._patch_recorder = None
 
     def find_blocks_from_code(self, code: bytes) -> typing.List["BlendFileBlock"]:
         assert isinstance(code, bytes)
-        return self.code_index[code]
+        return [
+            self._block_from_row(row) for row in self.block_table.rows_for_code(code)
+        ]
 
     def close(self) -> None:
         """Close the blend file.
@@ -239,21 +580,17 @@ class BlendFile:
         if self._is_modified:
             log.debug("closing blend file %s after it was modified", self.raw_filepath)
 
-        if self._is_modified and self.is_compressed:
-            log.debug("GZip-recompressing modified blend file %s", self.raw_filepath)
-            self.fileobj.seek(os.SEEK_SET, 0)
+        if self._mmap is not None and self._is_modified:
+            self._mmap.flush()
 
-            with gzip.open(str(self.filepath), "wb") as gzfile:
-                while True:
-                    data = self.fileobj.read(FILE_BUFFER_SIZE)
-                    if not data:
-                        break
-                    gzfile.write(data)
-            log.debug("GZip-compression to %s finished", self.filepath)
+        if self._is_modified and self.is_compressed:
+            self._recompress()
 
         # Close the file object after recompressing, as it may be a temporary
         # file that'll disappear as soon as we close it.
+        self._unmap_file()
         self.fileobj.close()
+        self._payload_key = payload_cache.new_file_key()
         self._is_modified = False
 
         try:
@@ -261,6 +598,50 @@ class BlendFile:
         except KeyError:
             pass
 
+    def _recompress(self) -> None:
+        """Write the modified file to self.filepath in its original compression."""
+
+        compression = self.compression
+        if compression == magic_compression.Compression.ZSTD:
+            level, threads = self.zstd_level, self.zstd_threads
+        else:
+            level, threads = self.gzip_level, 0
+
+        log.debug(
+            "%s-recompressing modified blend file %s",
+            compression.name,
+            self.raw_filepath,
+        )
+
+        if self._view is not None:
+            size = len(self._view)
+        else:
+            size = self.fileobj.seek(0, os.SEEK_END)
+
+        # Seekable ZStandard files are written with the same frame size, so
+        # that they stay seekable.
+        with magic_compression.compressing_writer(
+            self.filepath,
+            compression,
+            level=level,
+            threads=threads,
+            size=size,
+            zstd_frame_size=self.zstd_frame_size,
+        ) as outfile:
+            if self._view is not None:
+                # The file object may still have stale data buffered from
+                # before the memory map was written to.
+                for offset in range(0, size, FILE_BUFFER_SIZE):
+                    outfile.write(self._view[offset : offset + FILE_BUFFER_SIZE])
+            else:
+                self.fileobj.seek(0, os.SEEK_SET)
+                while True:
+                    data = self.fileobj.read(FILE_BUFFER_SIZE)
+                    if not data:
+                        break
+                    outfile.write(data)
+        log.debug("%s-compression to %s finished", compression.name, self.filepath)
+
     def ensure_subtype_smaller(self, sdna_index_curr, sdna_index_next) -> None:
         # never refine to a smaller type
         curr_struct = self.structs[sdna_index_curr]
@@ -277,12 +658,33 @@ class BlendFile:
     def decode_structs(self, block: "BlendFileBlock"):
         """
         DNACatalog is a catalog of all information in the DNA1 file-block
+
+        Decoded catalogues are shared with other files that have the same
+        DNA, see the dna_cache module.
         """
+        data = block.raw_data()
+        key = dna_cache.catalogue_key(
+            data, self.header.pointer_size, self.header.endian_str
+        )
+        if self._dna_key is None:
+            self._dna_key = key
+        catalogue = dna_cache.get(key)
+        if catalogue is None:
+            catalogue = dna_cache.put(key, self._decode_catalogue(data))
+        else:
+            self.log.debug("using cached DNA catalog %s", key)
+
+        structs, sdna_index_from_id = catalogue
+        self._structs.extend(structs)
+        self._sdna_index_from_id.update(sdna_index_from_id)
+
+    def _decode_catalogue(self, data: bytes) -> dna_cache.Catalogue:
+        """Decode the contents of a DNA1 block."""
         self.log.debug("building DNA catalog")
 
         # Get some names in the local scope for faster access.
-        structs = self.structs
-        sdna_index_from_id = self.sdna_index_from_id
+        structs = []  # type: typing.List[dna.Struct]
+        sdna_index_from_id = {}  # type: typing.Dict[bytes, int]
         endian = self.header.endian
         shortstruct = endian.USHORT
         shortstruct2 = endian.USHORT2
@@ -292,7 +694,6 @@ class BlendFile:
         def pad_up_4(off: int) -> int:
             return (off + 3) & ~3
 
-        data = self.fileobj.read(block.size)
         types = []
         typenames = []
 
@@ -359,6 +760,8 @@ class BlendFile:
                 dna_struct.append_field(field)
                 dna_offset += dna_size
 
+        return structs, sdna_index_from_id
+
     def decode_glob(self, block: "BlendFileBlock") -> None:
         """Partially decode the GLOB block to get the file sub-version."""
         # Before this, the subversion didn't exist in 'FileGlobal'.
@@ -370,13 +773,8 @@ class BlendFile:
         # parse the fields.
 
         # The subversion is always the `short` at offset 4.
-        # block_data = io.BytesIO(block.raw_data())
         endian = self.header.endian
-        self.fileobj.seek(4, os.SEEK_CUR)  # Skip the next 4 bytes.
-        self.file_subversion = endian.read_short(self.fileobj)
-
-        # Skip to the next block.
-        self.fileobj.seek(block.file_offset + block.size, os.SEEK_SET)
+        self.file_subversion = endian.SSHORT.unpack_from(block.raw_data(), 4)[0]
 
     def abspath(self, relpath: bpathlib.BlendPath) -> bpathlib.BlendPath:
         """Construct an absolute path from a blendfile-relative path."""
@@ -402,25 +800,81 @@ class BlendFile:
         thrown, but None will be returned.
         """
 
-        try:
-            return self.block_from_addr[address]
-        except KeyError:
-            if self.strict_pointer_mode:
-                raise exceptions.SegmentationFault(
-                    "address does not exist", address
-                ) from None
-            log.warning(
-                "Silenced SegmentationFault caused by dereferencing invalid pointer"
-                " (0x%x) because strict_pointer_mode is off.",
-                address,
-            )
-            return None
+        row = self.block_table.row_for_addr(address)
+        if row is not None:
+            return self._block_from_row(row)
+
+        if self.strict_pointer_mode:
+            raise exceptions.SegmentationFault("address does not exist", address)
+        log.warning(
+            "Silenced SegmentationFault caused by dereferencing invalid pointer"
+            " (0x%x) because strict_pointer_mode is off.",
+            address,
+        )
+        return None
+
+    def referrers(
+        self, address: int
+    ) -> typing.List[typing.Tuple["BlendFileBlock", int]]:
+        """Return the blocks with a pointer to the address.
+
+        The first call builds a reverse index of all pointers in the file,
+        which takes a single pass over all blocks; later calls are cheap.
+
+        :returns: (block, offset) tuples, where the offset of the pointer is
+            relative to the start of the block.
+        """
+        if self._referrers is None:
+            self._referrers = self._build_referrer_index()
+
+        return [
+            (self._block_from_row(row), offset)
+            for row, offset in self._referrers.get(address, ())
+        ]
+
+    def _build_referrer_index(
+        self,
+    ) -> typing.Dict[int, typing.List[typing.Tuple[int, int]]]:
+        """Map every pointed-to address to (block table row, offset) tuples."""
+        self.log.debug("building reverse pointer index of %s", self.filepath)
+
+        index = collections.defaultdict(
+            list
+        )  # type: typing.DefaultDict[int, typing.List[typing.Tuple[int, int]]]
+        for row in range(len(self.block_table)):
+            block = self._block_from_row(row)
+            for offset, address in block.pointers():
+                index[address].append((row, offset))
+        return dict(index)
+
+    def dereference_pointers(
+        self, addresses: typing.Iterable[int]
+    ) -> typing.Iterator["BlendFileBlock"]:
+        """Generator, yield the pointed-to blocks of the non-null addresses.
+
+        Null pointers are skipped. Unknown addresses raise SegmentationFault,
+        or are skipped when BlendFile.strict_pointer_mode is False.
+        """
+        row_for_addr = self.block_table.row_for_addr
+        for address in addresses:
+            if not address:
+                continue
+            row = row_for_addr(address)
+            if row is None:
+                # Raise the exception, or log the warning, as usual.
+                self.dereference_pointer(address)
+                continue
+            yield self._block_from_row(row)
 
     def struct(self, name: bytes) -> dna.Struct:
         index = self.sdna_index_from_id[name]
         return self.structs[index]
 
 
+# Payloads of small blocks, shared by all BlendFile instances.
+_payload_cache = payload_cache.PayloadCache(BlendFile.payload_cache_size)
+
+
 @functools.total_ordering
 class BlendFileBlock:
     """
@@ -441,6 +895,8 @@ class BlendFileBlock:
         "file_offset",
         "endian",
         "_id_name",
+        "_row",
+        "__weakref__",
     )
 
     log = log.getChild("BlendFileBlock")
@@ -453,44 +909,37 @@ class BlendFileBlock:
     sdna_index: int
     count: int
 
-    def __init__(self, bfile: BlendFile) -> None:
+    def __init__(
+        self,
+        bfile: BlendFile,
+        code: bytes,
+        size: int,
+        addr_old: int,
+        sdna_index: int,
+        count: int,
+        file_offset: int,
+        row: typing.Optional[int] = None,
+    ) -> None:
+        """Construct the block from its header.
+
+        Block headers are read by BlendFile, see blocktable.scan_headers().
+
+        :param row: the row of the block in bfile.block_table, if any.
+        """
         self.bfile = bfile
-
-        # Defaults; actual values are set by interpreting the block header.
-        self.code = b""
-        self.size = 0
-        self.addr_old = 0
-        self.sdna_index = 0
-        self.count = 0
-        self.file_offset = 0
+        self.code = code
+        self.size = size
+        self.addr_old = addr_old
+        self.sdna_index = sdna_index
+        self.count = count
+        self.file_offset = file_offset
         """Offset in bytes from start of file to beginning of the data block.
 
         Points to the data after the block header.
         """
         self.endian = bfile.header.endian
         self._id_name = ...  # type: typing.Union[None, ellipsis, bytes]
-
-        header_struct = bfile.block_header_struct
-        data = bfile.fileobj.read(header_struct.size)
-        if len(data) != header_struct.size:
-            self.log.warning(
-                "Blend file %s seems to be truncated, "
-                "expected %d bytes but could read only %d",
-                bfile.filepath,
-                header_struct.size,
-                len(data),
-            )
-            self.code = b"ENDB"
-            return
-
-        blockheader = bfile.block_header_fields(*header_struct.unpack(data))
-        self.code = self.endian.read_data0(blockheader.code)
-        if self.code != b"ENDB":
-            self.size = blockheader.len
-            self.addr_old = blockheader.old
-            self.sdna_index = blockheader.SDNAnr
-            self.count = blockheader.nr
-            self.file_offset = bfile.fileobj.tell()
+        self._row = row
 
     def __repr__(self) -> str:
         return "<%s.%s (%s), size=%d at %s>" % (
@@ -567,6 +1016,11 @@ class BlendFileBlock:
         self.bfile.ensure_subtype_smaller(sdna_index_curr, sdna_index)
         self.sdna_index = sdna_index
 
+        # Block objects are only kept alive while they are in use, so the
+        # refinement is stored on the file for when the block is recreated.
+        if self._row is not None:
+            self.bfile._sdna_index_overrides[self._row] = sdna_index
+
     def refine_type(self, dna_type_id: bytes):
         """Change the DNA Struct associated with this block.
 
@@ -613,23 +1067,40 @@ class BlendFileBlock:
         :param return_field: When True, returns tuple (dna.Field, value).
             Otherwise just returns the value.
         """
-        self.bfile.fileobj.seek(self.file_offset, os.SEEK_SET)
-
-        dna_struct = self.bfile.structs[self.sdna_index]
-        field, value = dna_struct.field_get(
-            self.bfile.header,
-            self.bfile.fileobj,
-            path,
-            default=default,
-            null_terminated=null_terminated,
-            as_str=as_str,
-        )
+        bfile = self.bfile
+        dna_struct = bfile.structs[self.sdna_index]
+        try:
+            accessor = dna_struct.field_accessor(bfile.header, path)
+        except KeyError:
+            if default is ...:
+                raise
+            field, value = None, default
+        else:
+            field = accessor.field
+            view = bfile._view
+            if view is not None:
+                value = accessor.unpack(
+                    view, self.file_offset, null_terminated, as_str
+                )
+            else:
+                payload = bfile._block_payload(self)
+                if payload is not None:
+                    value = accessor.unpack(payload, 0, null_terminated, as_str)
+                else:
+                    bfile.fileobj.seek(self.file_offset, os.SEEK_SET)
+                    value = accessor.read(bfile.fileobj, null_terminated, as_str)
         if return_field:
             return value, field
         return value
 
     def raw_data(self) -> bytes:
         """Read low-level raw data of this datablock."""
+        view = self.bfile._view
+        if view is not None:
+            return view[self.file_offset : self.file_offset + self.size].tobytes()
+        payload = self.bfile._block_payload(self)
+        if payload is not None:
+            return payload
         self.bfile.fileobj.seek(self.file_offset, os.SEEK_SET)
         return self.bfile.fileobj.read(self.size)
 
@@ -692,27 +1163,82 @@ class BlendFileBlock:
         Generates a 'hash' that can be used instead of addr_old as block id,
         which should be 'stable' across .blend file load & save (i.e. it does
         not changes due to pointer addresses variations).
-        """
-        # TODO This implementation is most likely far from optimal... and CRC32
-        # is not kown as the best hashing algo either. But for now does the job!
-        import zlib
 
+        The raw data of the block is hashed with its pointers zeroed out, so
+        that all elements of the block are included, as well as any padding
+        bytes.
+        """
         dna_type = self.dna_type
-        pointer_size = self.bfile.header.pointer_size
+        data = self.raw_data()
+
+        if dna_type.pointer_ranges():
+            # Zero out the pointers of all elements of the block in one go, by
+            # AND-ing the data with the struct's pointer mask repeated for
+            # each element. Any trailing bytes are left as they are.
+            mask = dna_type.pointer_mask()
+            num_items = min(self.count, len(data) // len(mask))
+            tail = len(data) - num_items * len(mask)
+            full_mask = mask * num_items + b"\xff" * tail
+            masked = int.from_bytes(data, "little") & int.from_bytes(
+                full_mask, "little"
+            )
+            data = masked.to_bytes(len(data), "little")
 
-        hsh = 1
-        for path, value in self.items_recursive():
-            field, _ = dna_type.field_from_path(pointer_size, path)
-            if field.name.is_pointer:
-                continue
-            hsh = zlib.adler32(str(value).encode(), hsh)
-        return hsh
+        digest = hashlib.blake2b(data, digest_size=8).digest()
+        return int.from_bytes(digest, "little")
+
+    def pointers(self) -> typing.List[typing.Tuple[int, int]]:
+        """Return (offset, address) of all non-null pointers in the block.
+
+        The offset is relative to the start of the block. All elements of the
+        block are included. The pointers are found with the pointer offsets
+        of the block's DNA struct, without reading any other fields.
+        """
+        dna_type = self.dna_type
+        unpacker = dna_type.pointer_unpacker(self.bfile.header)
+        if unpacker is None:
+            return []
+
+        num_items = min(self.count, self.size // unpacker.size)
+        if num_items == 0:
+            return []
+        data_size = num_items * unpacker.size
+
+        view = self.bfile._view
+        if view is not None:
+            data = view[self.file_offset : self.file_offset + data_size]
+        else:
+            data = memoryview(self.raw_data())[:data_size]
+
+        offsets = dna_type.pointer_offsets()
+        found = []  # type: typing.List[typing.Tuple[int, int]]
+        for item_index, addresses in enumerate(unpacker.iter_unpack(data)):
+            item_offset = item_index * unpacker.size
+            found.extend(
+                (item_offset + offset, address)
+                for offset, address in zip(offsets, addresses)
+                if address
+            )
+        return found
 
     def set(self, path: bytes, value):
         dna_struct = self.bfile.structs[self.sdna_index]
+
+        recorder = self.bfile._patch_recorder
+        if recorder is not None:
+            recorder.seek(self.file_offset, os.SEEK_SET)
+            return dna_struct.field_set(self.bfile.header, recorder, path, value)
+
         self.bfile.mark_modified()
-        self.bfile.fileobj.seek(self.file_offset, os.SEEK_SET)
-        return dna_struct.field_set(self.bfile.header, self.bfile.fileobj, path, value)
+
+        # A memory map supports the file API, so the write goes straight
+        # into the mapped view.
+        fileobj = self.bfile.fileobj  # type: typing.Any
+        if self.bfile._mmap is not None:
+            fileobj = self.bfile._mmap
+        fileobj.seek(self.file_offset, os.SEEK_SET)
+        _payload_cache.discard((self.bfile._payload_key, self.file_offset))
+        return dna_struct.field_set(self.bfile.header, fileobj, path, value)
 
     def get_pointer(
         self,
@@ -761,22 +1287,8 @@ class BlendFileBlock:
         assert array.code == b"DATA", (
             "Array data block should have code DATA, is %r" % array.code.decode()
         )
-        file_offset = array.file_offset
-
-        endian = self.bfile.header.endian
-        ps = self.bfile.header.pointer_size
-
-        for i in range(array_size):
-            fileobj = self.bfile.fileobj
-            fileobj.seek(file_offset + ps * i, os.SEEK_SET)
-            address = endian.read_pointer(fileobj, ps)
-            if address == 0:
-                continue
-            dereferenced = self.bfile.dereference_pointer(address)
-            if dereferenced is None:
-                # This can happen when strict pointer mode is disabled.
-                continue
-            yield dereferenced
+        addresses = self._unpack_pointers(array, 0, array_size)
+        yield from self.bfile.dereference_pointers(addresses)
 
     def iter_fixed_array_of_pointers(
         self, path: dna.FieldPath
@@ -795,24 +1307,34 @@ class BlendFileBlock:
 
         dna_struct = self.dna_type
         ps = self.bfile.header.pointer_size
-        endian = self.bfile.header.endian
-        fileobj = self.bfile.fileobj
-
         field, offset_in_struct = dna_struct.field_from_path(ps, path)
         array_size = field.size // ps
 
-        for i in range(array_size):
-            fileobj.seek(self.file_offset + offset_in_struct + ps * i, os.SEEK_SET)
-            address = endian.read_pointer(fileobj, ps)
-            if not address:
-                # Fixed-size arrays contain 0-pointers.
-                continue
+        # Fixed-size arrays contain 0-pointers, which are skipped.
+        addresses = self._unpack_pointers(self, offset_in_struct, array_size)
+        yield from self.bfile.dereference_pointers(addresses)
 
-            dereferenced = self.bfile.dereference_pointer(address)
-            if dereferenced is None:
-                # This can happen when strict pointer mode is disabled.
-                continue
-            yield dereferenced
+    @staticmethod
+    def _unpack_pointers(
+        block: "BlendFileBlock", offset: int, count: int
+    ) -> typing.Tuple[int, ...]:
+        """Read an array of pointers from the block in one go.
+
+        :param offset: offset of the array, relative to the start of the block.
+        """
+        bfile = block.bfile
+        ps = bfile.header.pointer_size
+        endian = bfile.header.endian
+
+        view = bfile._view
+        if view is not None:
+            return endian.unpack_pointers(view, block.file_offset + offset, ps, count)
+
+        payload = bfile._block_payload(block)
+        if payload is None or len(payload) < offset + ps * count:
+            bfile.fileobj.seek(block.file_offset + offset, os.SEEK_SET)
+            payload, offset = bfile.fileobj.read(ps * count), 0
+        return endian.unpack_pointers(payload, offset, ps, count)
 
     def __getitem__(self, path: dna.FieldPath):
         return self.get(path)
@@ -858,3 +1380,59 @@ def set_strict_pointer_mode(strict_pointers: bool) -> None:
     """
 
     BlendFile.strict_pointer_mode = strict_pointers
+
+
+def set_in_memory_limit(num_bytes: int) -> None:
+    """Set the maximum size of compressed files to decompress into memory.
+
+    Larger files are decompressed into a temporary file. This sets the
+    default for BlendFile objects created after this call, including those
+    opened by open_cached(). See BlendFile.in_memory_limit.
+    """
+
+    BlendFile.in_memory_limit = num_bytes
+
+
+def set_recompression_options(
+    *,
+    zstd_level: typing.Optional[int] = None,
+    zstd_threads: typing.Optional[int] = None,
+    gzip_level: typing.Optional[int] = None,
+) -> None:
+    """Control how modified compressed blend files are recompressed.
+
+    Modified files are recompressed when they are closed, in the same format
+    they were read in. Options that are None are left unchanged; see the
+    BlendFile attributes of the same name for their meaning.
+    """
+
+    if zstd_level is not None:
+        BlendFile.zstd_level = zstd_level
+    if zstd_threads is not None:
+        BlendFile.zstd_threads = zstd_threads
+    if gzip_level is not None:
+        BlendFile.gzip_level = gzip_level
+
+
+def set_payload_cache_size(num_bytes: int) -> None:
+    """Set the byte budget of the block payload cache.
+
+    The cache is shared by all open blend files, so this is the total memory
+    used for cached payloads by the process, no matter how many files are
+    kept open by open_cached(). Process pools, like trace.deps_parallel()
+    uses, have a cache of this size in every worker process. See
+    BlendFile.payload_cache_size.
+    """
+
+    BlendFile.payload_cache_size = num_bytes
+    _payload_cache.resize(max(0, num_bytes))
+
+
+def set_mmap_mode(use_mmap: bool) -> None:
+    """Control whether blend files are accessed through a memory map.
+
+    This sets the default for BlendFile objects created after this call,
+    including those opened by open_cached().
+    """
+
+    BlendFile.use_mmap = use_mmap
@@ -0,0 +1,355 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+# ***** END GPL LICENCE BLOCK *****
+"""Bulk scanning of block headers into a columnar table.
+
+Instead of creating a Python object per block header while reading the file,
+scan_headers() walks the file once, jumping from header to header, and stores
+the header fields in parallel arrays.
+
+The BlockList, CodeIndex, and AddressIndex classes provide the familiar list
+and dictionary interfaces on top of such a table, only creating block objects
+when they are actually accessed.
+"""
+
+import array
+import bisect
+import collections.abc
+import dataclasses
+import logging
+import os
+import pathlib
+import struct
+import typing
+
+from . import dna_io
+
+log = logging.getLogger(__name__)
+
+
+class BlockTable:
+    """Block headers of a blend file, stored as parallel arrays.
+
+    Row N describes the Nth block of the file, in disk order. The ENDB block
+    is not included.
+
+    :ivar codes: the distinct block codes (like b'OB' or b'DATA'), indexed
+        by the values of the code_id column.
+    """
+
+    def __init__(self) -> None:
+        self.codes = []  # type: typing.List[bytes]
+        self._code_ids = {}  # type: typing.Dict[bytes, int]
+
+        self.code_id = array.array("H")
+        self.size = array.array("q")
+        self.addr_old = array.array("Q")
+        self.sdna_index = array.array("i")
+        self.count = array.array("q")
+        self.file_offset = array.array("Q")
+        """Offset of the block data, i.e. just after the block header."""
+
+        # Built by build_indices() after all rows have been appended.
+        self._rows_per_code = []  # type: typing.List[array.array]
+        self._addr_sorted = array.array("Q")
+        self._addr_rows = array.array("I")
+
+    def __len__(self) -> int:
+        return len(self.code_id)
+
+    def __repr__(self) -> str:
+        return "<%s with %d blocks>" % (type(self).__qualname__, len(self))
+
+    def code(self, row: int) -> bytes:
+        """Return the block code of the given row."""
+        return self.codes[self.code_id[row]]
+
+    def id_for_code(self, code: bytes) -> typing.Optional[int]:
+        """Return the code ID used in the code_id column, or None if unused."""
+        return self._code_ids.get(code)
+
+    def rows_for_code(self, code: bytes) -> typing.Sequence[int]:
+        """Return the rows of blocks with this code, in disk order."""
+        code_id = self._code_ids.get(code)
+        if code_id is None:
+            return ()
+        return self._rows_per_code[code_id]
+
+    def row_for_addr(self, addr_old: int) -> typing.Optional[int]:
+        """Return the row of the block at this address, or None if there is none.
+
+        When multiple blocks share the same address, the last one in the file
+        is returned.
+        """
+        addresses = self._addr_sorted
+        index = bisect.bisect_right(addresses, addr_old) - 1
+        if index < 0 or addresses[index] != addr_old:
+            return None
+        return self._addr_rows[index]
+
+    def unique_addresses(self) -> typing.Iterator[int]:
+        """Generator, yields each block address once, in ascending order."""
+        previous = None
+        for addr_old in self._addr_sorted:
+            if addr_old != previous:
+                yield addr_old
+            previous = addr_old
+
+    def build_indices(self) -> None:
+        """Build the per-code and per-address indices.
+
+        Call this after all rows have been appended.
+        """
+        rows_per_code = [array.array("I") for _ in self.codes]
+        for row, code_id in enumerate(self.code_id):
+            rows_per_code[code_id].append(row)
+        self._rows_per_code = rows_per_code
+
+        # The sort is stable, so of duplicate addresses the last row in the
+        # file ends up last, and is found by row_for_addr().
+        addr_old = self.addr_old
+        order = sorted(range(len(addr_old)), key=addr_old.__getitem__)
+        self._addr_sorted = array.array("Q", (addr_old[row] for row in order))
+        self._addr_rows = array.array("I", order)
+
+    def append(
+        self,
+        raw_code: bytes,
+        size: int,
+        addr_old: int,
+        sdna_index: int,
+        count: int,
+        file_offset: int,
+    ) -> None:
+        """Append a row to the table.
+
+        :param raw_code: the block code as stored in the file, so possibly
+            including trailing zero bytes.
+        """
+        try:
+            code_id = self._code_ids[raw_code]
+        except KeyError:
+            code = dna_io.EndianIO.read_data0(raw_code)
+            code_id = self._code_ids.get(code)
+            if code_id is None:
+                code_id = len(self.codes)
+                self.codes.append(code)
+                self._code_ids[code] = code_id
+            self._code_ids[raw_code] = code_id
+
+        self.code_id.append(code_id)
+        self.size.append(size)
+        self.addr_old.append(addr_old)
+        self.sdna_index.append(sdna_index)
+        self.count.append(count)
+        self.file_offset.append(file_offset)
+
+
+def _field_positions(
+    header_fields: type,
+) -> typing.Tuple[int, int, int, int, int]:
+    """Return the tuple index of code, len, old, SDNAnr, and nr.
+
+    The order of those fields in the block header depends on the file format,
+    see header.BlendFileHeader.create_block_header_struct().
+    """
+    names = [field.name for field in dataclasses.fields(header_fields)]
+    return (
+        names.index("code"),
+        names.index("len"),
+        names.index("old"),
+        names.index("SDNAnr"),
+        names.index("nr"),
+    )
+
+
+def scan_headers(
+    fileobj: typing.IO[bytes],
+    header_struct: struct.Struct,
+    header_fields: type,
+    filepath: pathlib.Path,
+    view: typing.Optional[memoryview] = None,
+) -> BlockTable:
+    """Scan all block headers, starting at the current position of fileobj.
+
+    Stops at the ENDB block, or at the end of the file when it is truncated.
+
+    :param header_struct: struct for the block header, from
+        header.BlendFileHeader.create_block_header_struct().
+    :param header_fields: the block header class, from the same function.
+    :param filepath: only used for logging.
+    :param view: memory-mapped view of the file. When given, the headers are
+        unpacked from this view instead of read from fileobj.
+    """
+    table = BlockTable()
+    append = table.append
+    i_code, i_len, i_old, i_sdna, i_nr = _field_positions(header_fields)
+    header_size = header_struct.size
+    offset = fileobj.tell()
+
+    if view is not None:
+        unpack_from = header_struct.unpack_from
+        file_size = len(view)
+        while True:
+            if offset + header_size > file_size:
+                _warn_truncated(filepath, header_size, max(file_size - offset, 0))
+                break
+            fields = unpack_from(view, offset)
+            if fields[i_code] == b"ENDB":
+                break
+            offset += header_size
+            append(
+                fields[i_code],
+                fields[i_len],
+                fields[i_old],
+                fields[i_sdna],
+                fields[i_nr],
+                offset,
+            )
+            offset += fields[i_len]
+        table.build_indices()
+        return table
+
+    read = fileobj.read
+    seek = fileobj.seek
+    unpack = header_struct.unpack
+    while True:
+        data = read(header_size)
+        if len(data) != header_size:
+            _warn_truncated(filepath, header_size, len(data))
+            break
+        fields = unpack(data)
+        if fields[i_code] == b"ENDB":
+            break
+        offset += header_size
+        append(
+            fields[i_code],
+            fields[i_len],
+            fields[i_old],
+            fields[i_sdna],
+            fields[i_nr],
+            offset,
+        )
+        seek(fields[i_len], os.SEEK_CUR)
+        offset += fields[i_len]
+    table.build_indices()
+    return table
+
+
+def _warn_truncated(filepath: pathlib.Path, expected: int, actual: int) -> None:
+    log.warning(
+        "Blend file %s seems to be truncated, "
+        "expected %d bytes but could read only %d",
+        filepath,
+        expected,
+        actual,
+    )
+
+
+BlockFactory = typing.Callable[[int], typing.Any]
+"""Function that returns the block object for a row of a BlockTable."""
+
+
+class BlockList(collections.abc.Sequence):
+    """Read-only list of blocks in disk order, created on demand."""
+
+    def __init__(self, table: BlockTable, block_from_row: BlockFactory) -> None:
+        self._table = table
+        self._block_from_row = block_from_row
+
+    def __repr__(self) -> str:
+        return "<%s with %d blocks>" % (type(self).__qualname__, len(self))
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._block_from_row(row) for row in range(len(self))[index]]
+
+        num_rows = len(self)
+        if index < 0:
+            index += num_rows
+        if not 0 <= index < num_rows:
+            raise IndexError("block index out of range")
+        return self._block_from_row(index)
+
+    def __iter__(self):
+        block_from_row = self._block_from_row
+        for row in range(len(self)):
+            yield block_from_row(row)
+
+
+class CodeIndex(collections.abc.Mapping):
+    """Mapping from block code to the list of blocks with that code.
+
+    Just like the defaultdict(list) it replaces, looking up an unknown code
+    returns an empty list.
+    """
+
+    def __init__(self, table: BlockTable, block_from_row: BlockFactory) -> None:
+        self._table = table
+        self._block_from_row = block_from_row
+
+    def __repr__(self) -> str:
+        return "<%s with %d codes>" % (type(self).__qualname__, len(self))
+
+    def __getitem__(self, code: bytes) -> typing.List[typing.Any]:
+        block_from_row = self._block_from_row
+        return [block_from_row(row) for row in self._table.rows_for_code(code)]
+
+    def __contains__(self, code: object) -> bool:
+        if not isinstance(code, bytes):
+            return False
+        return self._table.id_for_code(code) is not None
+
+    def __iter__(self) -> typing.Iterator[bytes]:
+        return iter(self._table.codes)
+
+    def __len__(self) -> int:
+        return len(self._table.codes)
+
+
+class AddressIndex(collections.abc.Mapping):
+    """Mapping from block address (addr_old) to block."""
+
+    def __init__(self, table: BlockTable, block_from_row: BlockFactory) -> None:
+        self._table = table
+        self._block_from_row = block_from_row
+        self._len = None  # type: typing.Optional[int]
+
+    def __repr__(self) -> str:
+        return "<%s with %d addresses>" % (type(self).__qualname__, len(self))
+
+    def __getitem__(self, addr_old: int) -> typing.Any:
+        row = self._table.row_for_addr(addr_old)
+        if row is None:
+            raise KeyError(addr_old)
+        return self._block_from_row(row)
+
+    def __contains__(self, addr_old: object) -> bool:
+        if not isinstance(addr_old, int):
+            return False
+        return self._table.row_for_addr(addr_old) is not None
+
+    def __iter__(self) -> typing.Iterator[int]:
+        return self._table.unique_addresses()
+
+    def __len__(self) -> int:
+        if self._len is None:
+            self._len = sum(1 for _ in self._table.unique_addresses())
+        return self._len
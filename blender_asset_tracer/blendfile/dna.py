@@ -21,6 +21,7 @@
 # (c) 2018, Blender Foundation - Sybren A. Stüvel
 import logging
 import os
+import struct
 import typing
 from typing import Optional
 
@@ -100,6 +101,188 @@ class Field:
         return "<%r %r (%s)>" % (type(self).__qualname__, self.name, self.dna_type)
 
 
+class FieldAccessor:
+    """Compiled reader for a field path of a Struct.
+
+    Resolving a field path, and determining how to read the field, is done
+    once when the accessor is created. Use Struct.field_accessor() to obtain
+    a cached instance.
+
+    :ivar field: the field that is read.
+    :ivar offset: offset of the value relative to the start of the struct,
+        taking into account sub-structs and array indices of the path.
+    """
+
+    # How the bytes of the field are interpreted.
+    KIND_POINTER = "pointer"
+    KIND_CHAR = "char"  # single char, read as int
+    KIND_STRING = "string"  # char array, read as bytes or str
+    KIND_SIMPLE = "simple"  # single number
+    KIND_ARRAY = "array"  # array of numbers, read as list
+    KIND_UNSUPPORTED = "unsupported"
+
+    __slots__ = (
+        "field",
+        "offset",
+        "path",
+        "kind",
+        "size",
+        "pointer_size",
+        "endian",
+        "_unpack_from",
+    )
+
+    def __init__(
+        self,
+        file_header: header.BlendFileHeader,
+        field: Field,
+        offset: int,
+        path: FieldPath,
+    ) -> None:
+        self.field = field
+        self.offset = offset
+        self.path = path
+        self.pointer_size = file_header.pointer_size
+        self.endian = file_header.endian
+        self._unpack_from = None  # type: typing.Optional[typing.Callable]
+
+        dna_type = field.dna_type
+        dna_name = field.name
+        endian = self.endian
+
+        if dna_name.is_pointer:
+            self.kind = self.KIND_POINTER
+            self.size = self.pointer_size
+            self._unpack_from = {4: endian.UINT, 8: endian.ULONG}[
+                self.pointer_size
+            ].unpack_from
+            return
+
+        if dna_type.dna_type_id == b"char":
+            if field.size == 1:
+                # Single char, assume it's bitflag or int value, and not a
+                # string/bytes data...
+                self.kind = self.KIND_CHAR
+                self.size = 1
+                self._unpack_from = endian.UCHAR.unpack_from
+            else:
+                self.kind = self.KIND_STRING
+                self.size = dna_name.array_size
+            return
+
+        try:
+            typestruct = endian.simple_types()[dna_type.dna_type_id]
+        except KeyError:
+            self.kind = self.KIND_UNSUPPORTED
+            self.size = 0
+            return
+
+        if isinstance(path, tuple) and len(path) > 1 and isinstance(path[-1], int):
+            # The caller wants to get a single item from an array. The offset
+            # already points to this item. In this case we do not want to look
+            # at dna_name.array_size, because we want a single item from that
+            # array.
+            array_size = 1
+        else:
+            array_size = dna_name.array_size
+
+        if array_size > 1:
+            self.kind = self.KIND_ARRAY
+            fmt = typestruct.format
+            array_struct = struct.Struct("%s%d%s" % (fmt[0], array_size, fmt[1:]))
+            self.size = array_struct.size
+            self._unpack_from = array_struct.unpack_from
+        else:
+            self.kind = self.KIND_SIMPLE
+            self.size = typestruct.size
+            self._unpack_from = typestruct.unpack_from
+
+    def __repr__(self) -> str:
+        return "<%s %r %s at offset %d>" % (
+            type(self).__qualname__,
+            self.path,
+            self.kind,
+            self.offset,
+        )
+
+    def compatible_with(self, file_header: header.BlendFileHeader) -> bool:
+        """Return whether this accessor can read files with this header."""
+        return (
+            self.endian is file_header.endian
+            and self.pointer_size == file_header.pointer_size
+        )
+
+    def unpack(
+        self,
+        buffer,
+        struct_offset: int,
+        null_terminated: typing.Optional[bool] = True,
+        as_str: bool = True,
+    ) -> typing.Any:
+        """Unpack the value from a buffer (bytes, mmap, memoryview).
+
+        :param struct_offset: offset in bytes of the start of the struct in
+            the buffer.
+        """
+        return self._unpack_at(
+            buffer, struct_offset + self.offset, null_terminated, as_str
+        )
+
+    def _unpack_at(
+        self,
+        buffer,
+        offset: int,
+        null_terminated: typing.Optional[bool],
+        as_str: bool,
+    ) -> typing.Any:
+        kind = self.kind
+
+        if kind is self.KIND_SIMPLE or kind is self.KIND_POINTER:
+            return self._unpack_from(buffer, offset)[0]
+        if kind is self.KIND_STRING:
+            data = bytes(buffer[offset : offset + self.size])
+            if null_terminated or (null_terminated is None and as_str):
+                data = self.endian.read_data0(data)
+            if as_str:
+                return data.decode("utf8")
+            return data
+        if kind is self.KIND_ARRAY:
+            return list(self._unpack_from(buffer, offset))
+        if kind is self.KIND_CHAR:
+            return self._unpack_from(buffer, offset)[0]
+
+        dna_type = self.field.dna_type
+        dna_name = self.field.name
+        raise exceptions.NoReaderImplemented(
+            "%r exists but not simple type (%r), can't resolve field %r"
+            % (self.path, dna_type.dna_type_id.decode(), dna_name.name_only),
+            dna_name,
+            dna_type,
+        )
+
+    def read(
+        self,
+        fileobj: typing.IO[bytes],
+        null_terminated: typing.Optional[bool] = True,
+        as_str: bool = True,
+    ) -> typing.Any:
+        """Read the value from a file.
+
+        Assumes the file pointer of `fileobj` is seek()ed to the start of the
+        struct on disk (e.g. the start of the BlendFileBlock containing the
+        data).
+        """
+        if self.kind is self.KIND_UNSUPPORTED:
+            return self._unpack_at(b"", 0, null_terminated, as_str)
+
+        fileobj.seek(self.offset, os.SEEK_CUR)
+        data = fileobj.read(self.size)
+        try:
+            return self._unpack_at(data, 0, null_terminated, as_str)
+        except struct.error as ex:
+            raise struct.error("%s (read %d bytes)" % (ex, len(data))) from None
+
+
 class Struct:
     """dna.Struct is a C-type structure stored in the DNA."""
 
@@ -116,6 +299,20 @@ class Struct:
         self._size = size
         self._fields = []  # type: typing.List[Field]
         self._fields_by_name = {}  # type: typing.Dict[bytes, Field]
+        # Missing fields are cached as the KeyError that was raised for them.
+        self._accessors = (
+            {}
+        )  # type: typing.Dict[FieldPath, typing.Union[FieldAccessor, KeyError]]
+        self._pointers = (
+            None
+        )  # type: typing.Optional[typing.List[typing.Tuple[int, int]]]
+        self._pointer_ranges = (
+            None
+        )  # type: typing.Optional[typing.List[typing.Tuple[int, int]]]
+        self._pointer_mask = None  # type: typing.Optional[bytes]
+        self._pointer_unpackers = (
+            {}
+        )  # type: typing.Dict[typing.Tuple[bytes, int], typing.Optional[struct.Struct]]
 
     def __repr__(self):
         return "%s(%r)" % (type(self).__qualname__, self.dna_type_id)
@@ -136,6 +333,11 @@ class Struct:
     def append_field(self, field: Field):
         self._fields.append(field)
         self._fields_by_name[field.name.name_only] = field
+        self._accessors.clear()
+        self._pointers = None
+        self._pointer_ranges = None
+        self._pointer_mask = None
+        self._pointer_unpackers.clear()
 
     @property
     def fields(self) -> typing.List[Field]:
@@ -145,6 +347,146 @@ class Struct:
         """
         return self._fields
 
+    def pointer_offsets(self) -> typing.List[int]:
+        """Return the offsets of all pointers in the struct, in ascending order.
+
+        This includes the pointers in pointer arrays, in embedded structs, and
+        in arrays of those. The result is cached.
+        """
+        return [offset for offset, _ in self._pointer_fields()]
+
+    def pointer_ranges(self) -> typing.List[typing.Tuple[int, int]]:
+        """Return the (start, end) byte ranges of all pointers in the struct.
+
+        This covers the same pointers as pointer_offsets(), but with adjacent
+        pointers merged into a single range. The result is cached.
+        """
+        if self._pointer_ranges is not None:
+            return self._pointer_ranges
+
+        merged = []  # type: typing.List[typing.Tuple[int, int]]
+        for offset, size in self._pointer_fields():
+            if merged and offset <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(offset + size, merged[-1][1]))
+            else:
+                merged.append((offset, offset + size))
+        self._pointer_ranges = merged
+        return merged
+
+    def pointer_mask(self) -> bytes:
+        """Return a mask that zeroes out the pointers of the struct.
+
+        The mask has the size of the struct, with zero bytes where the
+        pointers are and 0xFF bytes elsewhere. The result is cached.
+        """
+        if self._pointer_mask is not None:
+            return self._pointer_mask
+
+        mask = bytearray(b"\xff" * self.size)
+        for range_start, range_end in self.pointer_ranges():
+            mask[range_start:range_end] = bytes(range_end - range_start)
+        self._pointer_mask = bytes(mask)
+        return self._pointer_mask
+
+    def pointer_unpacker(
+        self, file_header: header.BlendFileHeader
+    ) -> typing.Optional[struct.Struct]:
+        """Return a struct.Struct that unpacks all pointers of this struct.
+
+        The returned struct.Struct has the size of this struct, and unpacks
+        the pointers at pointer_offsets() in one call; use its iter_unpack()
+        to handle multiple consecutive structs. Returns None when this struct
+        contains no pointers. The result is cached.
+        """
+        key = (file_header.endian_str, file_header.pointer_size)
+        try:
+            return self._pointer_unpackers[key]
+        except KeyError:
+            pass
+
+        pointer_fields = self._pointer_fields()
+        if not pointer_fields:
+            unpacker = None
+        else:
+            pointer_code = "Q" if file_header.pointer_size == 8 else "I"
+            fmt = [file_header.endian_str.decode()]
+            position = 0
+            for offset, size in pointer_fields:
+                assert size == file_header.pointer_size, (self, offset, size)
+                if offset > position:
+                    fmt.append("%dx" % (offset - position))
+                fmt.append(pointer_code)
+                position = offset + size
+            if self.size > position:
+                fmt.append("%dx" % (self.size - position))
+            unpacker = struct.Struct("".join(fmt))
+
+        self._pointer_unpackers[key] = unpacker
+        return unpacker
+
+    def _pointer_fields(self) -> typing.List[typing.Tuple[int, int]]:
+        """Return (offset, size) of all pointers in the struct, sorted by offset.
+
+        Pointer arrays are expanded to their individual pointers.
+        """
+        if self._pointers is not None:
+            return self._pointers
+
+        pointers = []  # type: typing.List[typing.Tuple[int, int]]
+        for field in self._fields:
+            if field.name.is_pointer:
+                pointer_size = field.size // field.name.array_size
+                pointers.extend(
+                    (offset, pointer_size)
+                    for offset in range(
+                        field.offset, field.offset + field.size, pointer_size
+                    )
+                )
+                continue
+            if not field.dna_type.fields:
+                continue
+            sub_pointers = field.dna_type._pointer_fields()
+            if not sub_pointers:
+                continue
+            item_size = field.dna_type.size
+            for index in range(field.name.array_size):
+                item_offset = field.offset + index * item_size
+                pointers.extend(
+                    (item_offset + offset, size) for offset, size in sub_pointers
+                )
+
+        pointers.sort()
+        self._pointers = pointers
+        return pointers
+
+    def field_path_at(self, offset: int) -> typing.Tuple[typing.Union[bytes, int], ...]:
+        """Return the path of the field at the offset, like (b'id', b'next').
+
+        This is the reverse of field_from_path(), and is mostly useful to
+        name the pointers found by pointer_offsets(). Array elements are
+        included as index, for example (b'mat', 2).
+
+        :raises KeyError: when no field of this struct covers the offset.
+        """
+        for field in self._fields:
+            relative = offset - field.offset
+            if not 0 <= relative < field.size:
+                continue
+
+            path = (field.name.name_only,)  # type: typing.Tuple[typing.Any, ...]
+            array_size = field.name.array_size
+            if field.name.is_pointer or not field.dna_type.fields:
+                if array_size > 1:
+                    path += (relative // (field.size // array_size),)
+                return path
+
+            index, relative = divmod(relative, field.dna_type.size)
+            if array_size > 1:
+                path += (index,)
+            return path + field.dna_type.field_path_at(relative)
+
+        raise KeyError("%r has no field at offset %d" % (self, offset))
+
     def has_field(self, field_name: bytes) -> bool:
         return field_name in self._fields_by_name
 
@@ -205,6 +547,44 @@ class Struct:
 
         return field, offset
 
+    def field_accessor(
+        self, file_header: header.BlendFileHeader, path: FieldPath
+    ) -> "FieldAccessor":
+        """Return the compiled accessor for the field path.
+
+        Accessors are cached per path, so that repeated lookups of the same
+        field only have to resolve the path once.
+
+        :raises KeyError: if the field does not exist.
+        """
+        try:
+            accessor = self._accessors[path]
+        except TypeError:
+            # Unhashable path, like a list; don't bother caching it.
+            field, offset = self.field_from_path(file_header.pointer_size, path)
+            return FieldAccessor(file_header, field, offset, path)
+        except KeyError:
+            try:
+                field, offset = self.field_from_path(file_header.pointer_size, path)
+            except KeyError as ex:
+                # Only keep the message, not the traceback and its frames.
+                self._accessors[path] = KeyError(*ex.args)
+                raise
+            accessor = FieldAccessor(file_header, field, offset, path)
+            self._accessors[path] = accessor
+            return accessor
+
+        if isinstance(accessor, KeyError):
+            # Known to be missing. Raise a new exception, as re-raising the
+            # cached one would extend its traceback every time.
+            raise KeyError(*accessor.args)
+
+        if not accessor.compatible_with(file_header):
+            field, offset = self.field_from_path(file_header.pointer_size, path)
+            accessor = FieldAccessor(file_header, field, offset, path)
+            self._accessors[path] = accessor
+        return accessor
+
     def field_get(
         self,
         file_header: header.BlendFileHeader,
@@ -234,77 +614,43 @@ class Struct:
             and the field was not found, (None, default) is returned.
         """
         try:
-            field, offset = self.field_from_path(file_header.pointer_size, path)
+            accessor = self.field_accessor(file_header, path)
         except KeyError:
             if default is ...:
                 raise
             return None, default
 
-        fileobj.seek(offset, os.SEEK_CUR)
-
-        dna_type = field.dna_type
-        dna_name = field.name
-        endian = file_header.endian
-
-        # Some special cases (pointers, strings/bytes)
-        if dna_name.is_pointer:
-            return field, endian.read_pointer(fileobj, file_header.pointer_size)
-        if dna_type.dna_type_id == b"char":
-            return field, self._field_get_char(
-                file_header, fileobj, field, null_terminated, as_str
-            )
+        return accessor.field, accessor.read(fileobj, null_terminated, as_str)
 
-        simple_readers = {
-            b"uchar": endian.read_char,
-            b"int": endian.read_int,
-            b"short": endian.read_short,
-            b"uint64_t": endian.read_ulong,
-            b"float": endian.read_float,
-            b"int8_t": endian.read_int8,
-        }
-        try:
-            simple_reader = simple_readers[dna_type.dna_type_id]
-        except KeyError:
-            raise exceptions.NoReaderImplemented(
-                "%r exists but not simple type (%r), can't resolve field %r"
-                % (path, dna_type.dna_type_id.decode(), dna_name.name_only),
-                dna_name,
-                dna_type,
-            ) from None
-
-        if isinstance(path, tuple) and len(path) > 1 and isinstance(path[-1], int):
-            # The caller wants to get a single item from an array. The offset we seeked to already
-            # points to this item. In this case we do not want to look at dna_name.array_size,
-            # because we want a single item from that array.
-            return field, simple_reader(fileobj)
-
-        if dna_name.array_size > 1:
-            return field, [simple_reader(fileobj) for _ in range(dna_name.array_size)]
-        return field, simple_reader(fileobj)
-
-    def _field_get_char(
+    def field_get_from_buffer(
         self,
         file_header: header.BlendFileHeader,
-        fileobj: typing.IO[bytes],
-        field: "Field",
-        null_terminated: typing.Optional[bool],
-        as_str: bool,
-    ) -> typing.Any:
-        dna_name = field.name
-        endian = file_header.endian
+        buffer,
+        struct_offset: int,
+        path: FieldPath,
+        default=...,
+        null_terminated=True,
+        as_str=True,
+    ) -> typing.Tuple[typing.Optional[Field], typing.Any]:
+        """Read the value of the field from an in-memory buffer.
 
-        if field.size == 1:
-            # Single char, assume it's bitflag or int value, and not a string/bytes data...
-            return endian.read_char(fileobj)
+        Same as field_get(), but instead of reading from a file object this
+        unpacks the value from a buffer (bytes, mmap, memoryview) without any
+        seeking or copying.
 
-        if null_terminated or (null_terminated is None and as_str):
-            data = endian.read_bytes0(fileobj, dna_name.array_size)
-        else:
-            data = fileobj.read(dna_name.array_size)
+        :param buffer: the buffer containing the struct.
+        :param struct_offset: offset in bytes of the start of the struct in
+            the buffer.
+        """
+        try:
+            accessor = self.field_accessor(file_header, path)
+        except KeyError:
+            if default is ...:
+                raise
+            return None, default
 
-        if as_str:
-            return data.decode("utf8")
-        return data
+        value = accessor.unpack(buffer, struct_offset, null_terminated, as_str)
+        return accessor.field, value
 
     def field_set(
         self,
@@ -0,0 +1,351 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+# ***** END GPL LICENCE BLOCK *****
+"""Cache of decoded DNA catalogues.
+
+All blend files saved by the same Blender version carry the same SDNA, so
+there is no need to decode it again for every opened file. Decoded catalogues
+are kept in memory for the lifetime of the process. They can also be stored
+on disk, so that later runs can skip parsing the DNA1 block as well. The
+on-disk cache is disabled unless a directory is set with the BAT_DNA_CACHE_DIR
+environment variable or set_cache_dir().
+
+The catalogues are keyed by a hash of the DNA1 block contents, the pointer
+size, and the endianness. The latter two influence field sizes and offsets.
+
+The dna.Struct objects in a catalogue are shared between BlendFile instances,
+and thus should be treated as read-only.
+
+Next to the catalogues, the location of individual struct fields can be
+cached under the same key. That allows reading those fields from later files
+without decoding their DNA at all, see BlendFile.field_location().
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+import typing
+
+from . import dna
+
+log = logging.getLogger(__name__)
+
+Catalogue = typing.Tuple[typing.List[dna.Struct], typing.Dict[bytes, int]]
+FieldLocation = typing.Tuple[int, int]
+"""Offset relative to the start of the struct, and size, of a field."""
+
+# Increase this whenever the on-disk format changes.
+_FORMAT_VERSION = 2
+
+_catalogues = {}  # type: typing.Dict[str, Catalogue]
+_field_locations = {}  # type: typing.Dict[str, typing.Dict[str, FieldLocation]]
+_lock = threading.Lock()
+
+
+def _default_cache_dir() -> typing.Optional[pathlib.Path]:
+    env_dir = os.environ.get("BAT_DNA_CACHE_DIR")
+    return pathlib.Path(env_dir) if env_dir else None
+
+
+_cache_dir = _default_cache_dir()
+
+
+def set_cache_dir(cache_dir: typing.Optional[pathlib.Path]) -> None:
+    """Set the directory of the on-disk cache; None disables it.
+
+    The default is taken from the BAT_DNA_CACHE_DIR environment variable. When
+    that is not set, the on-disk cache is disabled.
+    """
+    global _cache_dir
+    _cache_dir = cache_dir
+
+
+def clear() -> None:
+    """Forget all catalogues cached in memory.
+
+    The on-disk cache is left as-is.
+    """
+    with _lock:
+        _catalogues.clear()
+        _field_locations.clear()
+
+
+def catalogue_key(dna1_data: bytes, pointer_size: int, endian_str: bytes) -> str:
+    """Compute the cache key for the DNA1 block contents.
+
+    :param endian_str: b'<' or b'>', see header.BlendFileHeader.endian_str.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(b"%d%s" % (pointer_size, endian_str))
+    hasher.update(dna1_data)
+    return hasher.hexdigest()
+
+
+def get(key: str) -> typing.Optional[Catalogue]:
+    """Return the cached catalogue, or None if it is not cached."""
+
+    with _lock:
+        try:
+            return _catalogues[key]
+        except KeyError:
+            pass
+
+    catalogue = _load(key)
+    if catalogue is None:
+        return None
+
+    with _lock:
+        # Another thread may have loaded it in the mean time; make sure that
+        # everybody shares the same objects.
+        return _catalogues.setdefault(key, catalogue)
+
+
+def put(key: str, catalogue: Catalogue) -> Catalogue:
+    """Cache a decoded catalogue, in memory and on disk.
+
+    :returns: the cached catalogue. When another thread cached the same key
+        already, that catalogue is returned instead of the given one.
+    """
+    with _lock:
+        if key in _catalogues:
+            return _catalogues[key]
+        _catalogues[key] = catalogue
+
+    _save(key, catalogue)
+    return catalogue
+
+
+def _cache_path(key: str) -> typing.Optional[pathlib.Path]:
+    if _cache_dir is None:
+        return None
+    return _cache_dir / ("%s.json" % key)
+
+
+def _load(key: str) -> typing.Optional[Catalogue]:
+    path = _cache_path(key)
+    if path is None:
+        return None
+
+    try:
+        with path.open("r", encoding="utf-8") as infile:
+            version, flat = json.load(infile)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, TypeError) as ex:
+        log.debug("Unable to read cached DNA catalogue %s: %s", path, ex)
+        return None
+
+    if version != _FORMAT_VERSION:
+        log.debug("Ignoring cached DNA catalogue %s of version %r", path, version)
+        return None
+
+    log.debug("Loading DNA catalogue from %s", path)
+    try:
+        return _unflatten(flat)
+    except (IndexError, ValueError, TypeError) as ex:
+        log.debug("Ignoring invalid cached DNA catalogue %s: %s", path, ex)
+        return None
+
+
+def _save(key: str, catalogue: Catalogue) -> None:
+    path = _cache_path(key)
+    if path is None:
+        return
+    if _write_json(path, key, (_FORMAT_VERSION, _flatten(catalogue))):
+        log.debug("Saved DNA catalogue to %s", path)
+
+
+def _write_json(path: pathlib.Path, key: str, contents: typing.Any) -> bool:
+    """Write the contents to the path as JSON.
+
+    :returns: whether the file was written.
+    """
+
+    # Write to a temporary file first, so that concurrent readers never see
+    # a partially written file.
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=str(path.parent), prefix=key)
+    except OSError as ex:
+        log.debug("Unable to write DNA cache %s: %s", path, ex)
+        return False
+
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as outfile:
+            json.dump(contents, outfile)
+        os.replace(tmp_name, str(path))
+    except OSError as ex:
+        log.debug("Unable to write DNA cache %s: %s", path, ex)
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def field_location(
+    key: str, struct_name: bytes, field_name: bytes
+) -> typing.Optional[FieldLocation]:
+    """Return the cached location of the field, or None if it is not cached.
+
+    :param key: the catalogue key of the DNA, see catalogue_key().
+    """
+    field_key = _field_key(struct_name, field_name)
+
+    with _lock:
+        locations = _field_locations.get(key)
+    if locations is None:
+        locations = _load_field_locations(key)
+        with _lock:
+            locations = _field_locations.setdefault(key, locations)
+
+    return locations.get(field_key)
+
+
+def put_field_location(
+    key: str, struct_name: bytes, field_name: bytes, location: FieldLocation
+) -> None:
+    """Cache the location of the field, in memory and on disk."""
+    field_key = _field_key(struct_name, field_name)
+
+    with _lock:
+        locations = _field_locations.setdefault(key, {})
+        if locations.get(field_key) == location:
+            return
+        locations[field_key] = location
+        to_save = dict(locations)
+
+    path = _field_locations_path(key)
+    if path is None:
+        return
+    if _write_json(path, key, (_FORMAT_VERSION, to_save)):
+        log.debug("Saved DNA field locations to %s", path)
+
+
+def _field_key(struct_name: bytes, field_name: bytes) -> str:
+    return "%s.%s" % (struct_name.decode("latin-1"), field_name.decode("latin-1"))
+
+
+def _field_locations_path(key: str) -> typing.Optional[pathlib.Path]:
+    if _cache_dir is None:
+        return None
+    return _cache_dir / ("%s.fields.json" % key)
+
+
+def _load_field_locations(key: str) -> typing.Dict[str, FieldLocation]:
+    path = _field_locations_path(key)
+    if path is None:
+        return {}
+
+    try:
+        with path.open("r", encoding="utf-8") as infile:
+            version, flat = json.load(infile)
+        if version != _FORMAT_VERSION:
+            log.debug(
+                "Ignoring cached DNA field locations %s of version %r", path, version
+            )
+            return {}
+        return {
+            field_key: (int(offset), int(size))
+            for field_key, (offset, size) in flat.items()
+        }
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError, TypeError, AttributeError) as ex:
+        log.debug("Unable to read cached DNA field locations %s: %s", path, ex)
+        return {}
+
+
+# Fields are stored as (type index, full name, size, offset). Names are stored
+# as str decoded from Latin-1, so that they round-trip through JSON unchanged.
+_FlatField = typing.Tuple[int, str, int, int]
+_FlatCatalogue = typing.Tuple[
+    typing.List[typing.Tuple[str, typing.Optional[int]]],
+    typing.List[typing.Tuple[int, typing.List[_FlatField]]],
+]
+
+
+def _flatten(catalogue: Catalogue) -> _FlatCatalogue:
+    """Convert the catalogue to plain lists of numbers and strings.
+
+    The types are stored once and referred to by index, as the pointer
+    fields refer from struct to struct.
+    """
+    structs, _ = catalogue
+
+    types = []  # type: typing.List[typing.Tuple[str, typing.Optional[int]]]
+    type_indices = {}  # type: typing.Dict[int, int]
+
+    def type_index(dna_type: dna.Struct) -> int:
+        try:
+            return type_indices[id(dna_type)]
+        except KeyError:
+            pass
+        index = len(types)
+        types.append((dna_type.dna_type_id.decode("latin-1"), dna_type._size))
+        type_indices[id(dna_type)] = index
+        return index
+
+    flat_structs = [
+        (
+            type_index(dna_struct),
+            [
+                (
+                    type_index(field.dna_type),
+                    field.name.name_full.decode("latin-1"),
+                    field.size,
+                    field.offset,
+                )
+                for field in dna_struct.fields
+            ],
+        )
+        for dna_struct in structs
+    ]
+    return types, flat_structs
+
+
+def _unflatten(flat: _FlatCatalogue) -> Catalogue:
+    flat_types, flat_structs = flat
+
+    types = [
+        dna.Struct(dna_type_id.encode("latin-1"), size)
+        for dna_type_id, size in flat_types
+    ]
+    names = {}  # type: typing.Dict[bytes, dna.Name]
+    structs = []  # type: typing.List[dna.Struct]
+    sdna_index_from_id = {}  # type: typing.Dict[bytes, int]
+
+    for sdna_index, (struct_type_index, fields) in enumerate(flat_structs):
+        dna_struct = types[struct_type_index]
+        sdna_index_from_id[dna_struct.dna_type_id] = sdna_index
+        structs.append(dna_struct)
+
+        for field_type_index, name_str, size, offset in fields:
+            name_full = name_str.encode("latin-1")
+            try:
+                dna_name = names[name_full]
+            except KeyError:
+                dna_name = names[name_full] = dna.Name(name_full)
+            field = dna.Field(types[field_type_index], dna_name, size, offset)
+            dna_struct.append_field(field)
+
+    return structs, sdna_index_from_id
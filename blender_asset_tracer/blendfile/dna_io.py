@@ -143,6 +143,21 @@ class EndianIO:
             raise ValueError("unsupported pointer size %d" % pointer_size)
         return typestruct.unpack(pointer_data)[0]
 
+    @classmethod
+    def unpack_pointers(
+        cls, buffer, offset: int, pointer_size: int, count: int
+    ) -> typing.Tuple[int, ...]:
+        """Unpack an array of pointers from a buffer at the offset."""
+
+        if pointer_size == 4:
+            typestruct = cls.UINT
+        elif pointer_size == 8:
+            typestruct = cls.ULONG
+        else:
+            raise ValueError("unsupported pointer size %d" % pointer_size)
+        fmt = typestruct.format
+        return struct.unpack_from("%s%d%s" % (fmt[0], count, fmt[1:]), buffer, offset)
+
     @classmethod
     def write_pointer(cls, fileobj: typing.IO[bytes], pointer_size: int, value: int):
         """Write a pointer to a file."""
@@ -239,6 +254,22 @@ class EndianIO:
             b"float": cls.write_float,
         }
 
+    @classmethod
+    def simple_types(cls) -> typing.Mapping[bytes, struct.Struct]:
+        """Return a mapping from DNA type name to the struct used to read it.
+
+        These are the types that can be read without knowing anything more
+        about the DNA; see dna.Struct.field_get().
+        """
+        return {
+            b"uchar": cls.UCHAR,
+            b"int": cls.SINT,
+            b"short": cls.SSHORT,
+            b"uint64_t": cls.ULONG,
+            b"float": cls.FLOAT,
+            b"int8_t": cls.SINT8,
+        }
+
 
 class LittleEndianTypes(EndianIO):
     pass
@@ -19,23 +19,90 @@
 # (c) 2009, At Mind B.V. - Jeroen Bakker
 # (c) 2014, Blender Foundation - Campbell Barton
 # (c) 2018, Blender Foundation - Sybren A. Stüvel
+import os
 import typing
 
 from blender_asset_tracer import cdefs
 from . import BlendFileBlock
-from .dna import FieldPath
+from .dna import FieldAccessor, FieldPath
+
+# Accessors for the next pointer and the requested fields of a ListBase item,
+# and the number of bytes to read to cover them all.
+_ListBaseLayout = typing.Tuple[FieldAccessor, typing.List[FieldAccessor], int]
 
 
 def listbase(
     block: typing.Optional[BlendFileBlock], next_path: FieldPath = b"next"
 ) -> typing.Iterator[BlendFileBlock]:
     """Generator, yields all blocks in the ListBase linked list."""
-    while block:
+    for block, _ in listbase_fields(block, (), next_path):
         yield block
-        next_ptr = block[next_path]
+
+
+def listbase_fields(
+    block: typing.Optional[BlendFileBlock],
+    field_paths: typing.Sequence[FieldPath],
+    next_path: FieldPath = b"next",
+    dna_type_id: typing.Optional[bytes] = None,
+) -> typing.Iterator[typing.Tuple[BlendFileBlock, typing.List[typing.Any]]]:
+    """Generator, yields (block, field values) for all blocks in the ListBase.
+
+    The values are read as with `block[path]` for each of the field paths.
+    The field paths and the next pointer are resolved only once per DNA
+    struct, and all of them are read from the block in a single read (or
+    directly from the memory map).
+
+    The next pointer is only decoded after the caller is done with the
+    yielded block, so that the caller can still refine its type.
+
+    :param dna_type_id: when given, each block is refined to this DNA type
+        (see BlendFileBlock.refine_type()) before its fields are read.
+    :raises KeyError: if the block has no such field.
+    """
+    layouts = {}  # type: typing.Dict[int, _ListBaseLayout]
+
+    while block:
+        if dna_type_id is not None:
+            block.refine_type(dna_type_id)
+        bfile = block.bfile
+        sdna_index = block.sdna_index
+        try:
+            next_accessor, accessors, read_size = layouts[sdna_index]
+        except KeyError:
+            dna_struct = bfile.structs[sdna_index]
+            next_accessor = dna_struct.field_accessor(bfile.header, next_path)
+            accessors = [
+                dna_struct.field_accessor(bfile.header, path) for path in field_paths
+            ]
+            read_size = max(
+                accessor.offset + accessor.size
+                for accessor in [next_accessor] + accessors
+            )
+            layouts[sdna_index] = next_accessor, accessors, read_size
+
+        view = bfile._view
+        if view is not None:
+            buffer, struct_offset = view, block.file_offset
+        else:
+            buffer, struct_offset = bfile._block_payload(block), 0
+            if buffer is None:
+                bfile.fileobj.seek(block.file_offset, os.SEEK_SET)
+                buffer = bfile.fileobj.read(read_size)
+
+        values = [
+            accessor.unpack(buffer, struct_offset, as_str=False)
+            for accessor in accessors
+        ]
+        yield block, values
+
+        if block.sdna_index == sdna_index:
+            next_ptr = next_accessor.unpack(buffer, struct_offset)
+        else:
+            # The caller refined the type of the block.
+            next_ptr = block[next_path]
         if next_ptr == 0:
             break
-        block = block.bfile.dereference_pointer(next_ptr)
+        block = bfile.dereference_pointer(next_ptr)
 
 
 def sequencer_strips(
@@ -49,15 +116,17 @@ def sequencer_strips(
     See blender_asset_tracer.cdefs.SEQ_TYPE_xxx for the type numbers.
     """
 
+    seq_fields = (b"type", (b"seqbase", b"first"))
+
     def iter_seqbase(seqbase) -> typing.Iterator[typing.Tuple[BlendFileBlock, int]]:
-        for seq in listbase(seqbase):
-            seq.refine_type(b"Sequence")
-            seq_type = seq[b"type"]
+        for seq, (seq_type, subseq_ptr) in listbase_fields(
+            seqbase, seq_fields, dna_type_id=b"Sequence"
+        ):
             yield seq, seq_type
 
-            if seq_type == cdefs.SEQ_TYPE_META:
+            if seq_type == cdefs.SEQ_TYPE_META and subseq_ptr:
                 # Recurse into this meta-sequence.
-                subseq = seq.get_pointer((b"seqbase", b"first"))
+                subseq = seq.bfile.dereference_pointer(subseq_ptr)
                 yield from iter_seqbase(subseq)
 
     sbase = sequence_editor.get_pointer((b"seqbase", b"first"))
@@ -18,12 +18,17 @@
 #
 # (c) 2021, Blender Foundation
 
+import array
+import bisect
 import collections
+import contextlib
 import enum
 import gzip
+import io
 import logging
 import os
 import pathlib
+import struct
 import tempfile
 import typing
 
@@ -50,17 +55,16 @@ ZSTD_MAGIC = b"\x28\xB5\x2F\xFD"
 ZSTD_MAGIC_SKIPPABLE = b"\x50\x2A\x4D\x18"
 ZSTD_MAGIC_SKIPPABLE_MASK = b"\xF0\xFF\xFF\xFF"
 
-log = logging.getLogger(__name__)
-
+# Seekable ZStandard files end in a skippable frame containing the seek table.
+# See https://github.com/facebook/zstd/blob/dev/contrib/seekable_format/zstd_seekable_compression_format.md
+ZSTD_SEEKABLE_MAGIC = 0x8F92EAB1
+_ZSTD_SEEK_TABLE_FRAME_MAGIC = b"\x5E\x2A\x4D\x18"
+_ZSTD_SKIPPABLE_HEADER = struct.Struct("<4sI")  # magic, frame size
+_ZSTD_SEEK_TABLE_FOOTER = struct.Struct("<IBI")  # frames, descriptor, magic
+_ZSTD_SEEK_TABLE_ENTRY = struct.Struct("<II")  # compressed, decompressed size
+_ZSTD_SEEK_TABLE_ENTRY_CHECKSUM = struct.Struct("<III")  # same + checksum
 
-# @dataclasses.dataclass
-DecompressedFileInfo = collections.namedtuple(
-    "DecompressedFileInfo", "is_compressed path fileobj"
-)
-# is_compressed: bool
-# path: pathlib.Path
-# """The path of the decompressed file, or the input path if the file is not compressed."""
-# fileobj: BinaryIO
+log = logging.getLogger(__name__)
 
 
 class Compression(enum.Enum):
@@ -70,8 +74,35 @@ class Compression(enum.Enum):
     ZSTD = 2
 
 
-def open(path: pathlib.Path, mode: str, buffer_size: int) -> DecompressedFileInfo:
-    """Open the file, decompressing it into a temporary file if necesssary."""
+# @dataclasses.dataclass
+DecompressedFileInfo = collections.namedtuple(
+    "DecompressedFileInfo",
+    "is_compressed path fileobj is_streamed is_in_memory compression "
+    "zstd_frame_size",
+    defaults=[False, False, Compression.NONE, 0],
+)
+# is_compressed: bool
+# path: pathlib.Path
+# """The path of the decompressed file, or the input path if the file is not compressed."""
+# fileobj: BinaryIO
+# is_streamed: bool
+# """Whether fileobj decompresses on the fly, instead of being a real file."""
+# is_in_memory: bool
+# """Whether fileobj is an io.BytesIO holding the decompressed file."""
+# compression: Compression
+# """The compression of the file on disk."""
+# zstd_frame_size: int
+# """Decompressed size of the frames of a seekable ZStandard file, 0 if not seekable."""
+
+
+def open(
+    path: pathlib.Path, mode: str, buffer_size: int, in_memory_limit: int = 0
+) -> DecompressedFileInfo:
+    """Open the file, decompressing it into a temporary file if necesssary.
+
+    :param in_memory_limit: compressed files that decompress to at most this
+        many bytes are decompressed into memory instead of a temporary file.
+    """
     fileobj = path.open(mode, buffering=buffer_size)  # typing.IO[bytes]
     compression = find_compression_type(fileobj)
 
@@ -88,8 +119,21 @@ def open(path: pathlib.Path, mode: str, buffer_size: int) -> DecompressedFileInf
 
     log.debug("%s-compressed blendfile detected: %s", compression.name, path)
 
-    # Decompress to a temporary file.
-    tmpfile = tempfile.NamedTemporaryFile()
+    zstd_frame_size = 0
+    if compression == Compression.ZSTD:
+        seek_table = ZstdSeekTable.from_file(fileobj)
+        if seek_table is None:
+            log.debug("No ZStandard seek table in %s, decompressing fully", path)
+        else:
+            # Remembered so that the file can be recompressed as seekable.
+            zstd_frame_size = seek_table.frame_size
+            if mode == "rb" and has_zstandard:
+                return _open_seekable_zstd(path, fileobj, compression, seek_table)
+
+    # Decompress into memory, switching to a temporary file as soon as the
+    # decompressed data grows beyond the limit.
+    outfile = io.BytesIO()  # type: typing.IO[bytes]
+    in_memory = True
     fileobj.seek(0, os.SEEK_SET)
 
     decompressor = _decompressor(fileobj, mode, compression)
@@ -101,18 +145,321 @@ def open(path: pathlib.Path, mode: str, buffer_size: int) -> DecompressedFileInf
 
         data = magic
         while data:
-            tmpfile.write(data)
+            outfile.write(data)
+            if in_memory and outfile.tell() > in_memory_limit:
+                outfile = _spill_to_tempfile(outfile)
+                in_memory = False
             data = compressed_file.read(buffer_size)
 
     # Further interaction should be done with the uncompressed file.
     fileobj.close()
+    outfile.seek(0, os.SEEK_SET)
+
+    if in_memory:
+        log.debug("decompressed %s into memory", path)
+        return DecompressedFileInfo(
+            is_compressed=True,
+            path=path,
+            fileobj=outfile,
+            is_in_memory=True,
+            compression=compression,
+            zstd_frame_size=zstd_frame_size,
+        )
+
     return DecompressedFileInfo(
         is_compressed=True,
-        path=pathlib.Path(tmpfile.name),
-        fileobj=tmpfile,
+        path=pathlib.Path(outfile.name),
+        fileobj=outfile,
+        compression=compression,
+        zstd_frame_size=zstd_frame_size,
     )
 
 
+def _spill_to_tempfile(buffer: io.BytesIO) -> typing.IO[bytes]:
+    """Move the contents of the in-memory buffer to a temporary file."""
+    tmpfile = tempfile.NamedTemporaryFile()
+    with buffer.getbuffer() as contents:
+        tmpfile.write(contents)
+    buffer.close()
+    return tmpfile
+
+
+def _open_seekable_zstd(
+    path: pathlib.Path,
+    fileobj: typing.IO[bytes],
+    compression: Compression,
+    seek_table: "ZstdSeekTable",
+) -> DecompressedFileInfo:
+    """Open a seekable ZStandard file for random access without decompressing."""
+
+    log.debug(
+        "Reading %s through its ZStandard seek table (%d frames)",
+        path,
+        len(seek_table),
+    )
+    reader = io.BufferedReader(SeekableZstdReader(fileobj, seek_table))
+    magic = reader.read(len(BLENDFILE_MAGIC))
+    if magic != BLENDFILE_MAGIC:
+        reader.close()
+        raise exceptions.BlendFileError("Compressed file is not a blend file", path)
+    reader.seek(0, os.SEEK_SET)
+
+    return DecompressedFileInfo(
+        is_compressed=True,
+        path=path,
+        fileobj=reader,
+        is_streamed=True,
+        compression=compression,
+        zstd_frame_size=seek_table.frame_size,
+    )
+
+
+class ZstdSeekTable:
+    """Frame index of a seekable ZStandard file.
+
+    Frame N starts at compressed_offsets[N] in the file, and decompresses to
+    the data at decompressed_offsets[N] in the decompressed stream. Both
+    arrays have an extra item at the end, for the end of the last frame.
+    """
+
+    def __init__(
+        self,
+        compressed_sizes: typing.Sequence[int],
+        decompressed_sizes: typing.Sequence[int],
+    ) -> None:
+        self.compressed_offsets = array.array("Q", [0])
+        self.decompressed_offsets = array.array("Q", [0])
+        for size in compressed_sizes:
+            self.compressed_offsets.append(self.compressed_offsets[-1] + size)
+        for size in decompressed_sizes:
+            self.decompressed_offsets.append(self.decompressed_offsets[-1] + size)
+
+    def __len__(self) -> int:
+        return len(self.compressed_offsets) - 1
+
+    @property
+    def decompressed_size(self) -> int:
+        return self.decompressed_offsets[-1]
+
+    @property
+    def frame_size(self) -> int:
+        """The decompressed size of the largest frame."""
+        offsets = self.decompressed_offsets
+        return max(
+            (offsets[index + 1] - offsets[index] for index in range(len(self))),
+            default=0,
+        )
+
+    def frame_at(self, decompressed_offset: int) -> int:
+        """Return the index of the frame containing the decompressed offset."""
+        return bisect.bisect_right(self.decompressed_offsets, decompressed_offset) - 1
+
+    @classmethod
+    def from_file(cls, fileobj: typing.IO[bytes]) -> typing.Optional["ZstdSeekTable"]:
+        """Read the seek table at the end of the file.
+
+        :returns: None if the file does not end in a valid seek table.
+        """
+        file_size = fileobj.seek(0, os.SEEK_END)
+        footer_size = _ZSTD_SEEK_TABLE_FOOTER.size
+        if file_size < _ZSTD_SKIPPABLE_HEADER.size + footer_size:
+            return None
+
+        fileobj.seek(file_size - footer_size, os.SEEK_SET)
+        num_frames, descriptor, magic = _ZSTD_SEEK_TABLE_FOOTER.unpack(
+            fileobj.read(footer_size)
+        )
+        if magic != ZSTD_SEEKABLE_MAGIC:
+            return None
+
+        has_checksums = bool(descriptor & 0x80)
+        if has_checksums:
+            entry_struct = _ZSTD_SEEK_TABLE_ENTRY_CHECKSUM
+        else:
+            entry_struct = _ZSTD_SEEK_TABLE_ENTRY
+        entries_size = num_frames * entry_struct.size
+
+        table_start = (
+            file_size - footer_size - entries_size - _ZSTD_SKIPPABLE_HEADER.size
+        )
+        if table_start < 0:
+            return None
+        fileobj.seek(table_start, os.SEEK_SET)
+        frame_magic, frame_size = _ZSTD_SKIPPABLE_HEADER.unpack(
+            fileobj.read(_ZSTD_SKIPPABLE_HEADER.size)
+        )
+        if not _matches_magic_masked(
+            frame_magic, ZSTD_MAGIC_SKIPPABLE, ZSTD_MAGIC_SKIPPABLE_MASK
+        ):
+            return None
+        if frame_size != entries_size + footer_size:
+            return None
+
+        entries = fileobj.read(entries_size)
+        compressed_sizes = []  # type: typing.List[int]
+        decompressed_sizes = []  # type: typing.List[int]
+        for entry in entry_struct.iter_unpack(entries):
+            compressed_sizes.append(entry[0])
+            decompressed_sizes.append(entry[1])
+
+        seek_table = cls(compressed_sizes, decompressed_sizes)
+        if seek_table.compressed_offsets[-1] != table_start:
+            # The frames should end exactly where the seek table starts.
+            return None
+        return seek_table
+
+
+class SeekableZstdReader(io.RawIOBase):
+    """Read-only, seekable file object for seekable ZStandard files.
+
+    Only the frames that contain the requested data are decompressed. The
+    most recently used frames are kept in memory, as reading a block header
+    and then its data typically hits the same frame.
+    """
+
+    frames_to_keep = 4
+
+    def __init__(self, fileobj: typing.IO[bytes], seek_table: ZstdSeekTable) -> None:
+        super().__init__()
+        self._fileobj = fileobj
+        self._seek_table = seek_table
+        self._dctx = zstandard.ZstdDecompressor()
+        self._pos = 0
+        self._frames = (
+            collections.OrderedDict()
+        )  # type: collections.OrderedDict[int, bytes]
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == os.SEEK_END:
+            pos = self._seek_table.decompressed_size + offset
+        else:
+            raise ValueError("invalid whence (%r)" % whence)
+        if pos < 0:
+            raise ValueError("negative seek position %d" % pos)
+        self._pos = pos
+        return pos
+
+    def readinto(self, buffer) -> int:
+        if self._pos >= self._seek_table.decompressed_size:
+            return 0
+
+        frame_index = self._seek_table.frame_at(self._pos)
+        frame = self._frame(frame_index)
+        start = self._pos - self._seek_table.decompressed_offsets[frame_index]
+        size = min(len(buffer), len(frame) - start)
+        buffer[:size] = frame[start : start + size]
+        self._pos += size
+        return size
+
+    def _frame(self, frame_index: int) -> bytes:
+        try:
+            frame = self._frames[frame_index]
+        except KeyError:
+            pass
+        else:
+            self._frames.move_to_end(frame_index)
+            return frame
+
+        seek_table = self._seek_table
+        compressed_offset = seek_table.compressed_offsets[frame_index]
+        compressed_size = (
+            seek_table.compressed_offsets[frame_index + 1] - compressed_offset
+        )
+        decompressed_size = (
+            seek_table.decompressed_offsets[frame_index + 1]
+            - seek_table.decompressed_offsets[frame_index]
+        )
+
+        self._fileobj.seek(compressed_offset, os.SEEK_SET)
+        compressed = self._fileobj.read(compressed_size)
+        frame = self._dctx.decompress(compressed, max_output_size=decompressed_size)
+
+        self._frames[frame_index] = frame
+        if len(self._frames) > self.frames_to_keep:
+            self._frames.popitem(last=False)
+        return frame
+
+    def close(self) -> None:
+        if not self.closed:
+            self._frames.clear()
+            self._fileobj.close()
+        super().close()
+
+
+class SeekableZstdWriter(io.RawIOBase):
+    """Write-only file object that writes a seekable ZStandard file.
+
+    The data is compressed in independent frames of frame_size decompressed
+    bytes, followed by a seek table, so that the file can be read again with
+    SeekableZstdReader. The seek table is written when this file object is
+    closed; the underlying file object is left open.
+    """
+
+    def __init__(
+        self,
+        fileobj: typing.IO[bytes],
+        cctx: "zstandard.ZstdCompressor",
+        frame_size: int,
+    ) -> None:
+        super().__init__()
+        self._fileobj = fileobj
+        self._cctx = cctx
+        self._frame_size = frame_size
+        self._buffer = bytearray()
+        self._entries = []  # type: typing.List[typing.Tuple[int, int]]
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._buffer += data
+        frame_size = self._frame_size
+        while len(self._buffer) >= frame_size:
+            self._write_frame(self._buffer[:frame_size])
+            del self._buffer[:frame_size]
+        return len(data)
+
+    def _write_frame(self, data: bytes) -> None:
+        compressed = self._cctx.compress(data)
+        self._fileobj.write(compressed)
+        self._entries.append((len(compressed), len(data)))
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        if self._buffer:
+            self._write_frame(self._buffer)
+            self._buffer.clear()
+
+        entries = b"".join(
+            _ZSTD_SEEK_TABLE_ENTRY.pack(*entry) for entry in self._entries
+        )
+        footer = _ZSTD_SEEK_TABLE_FOOTER.pack(
+            len(self._entries), 0, ZSTD_SEEKABLE_MAGIC
+        )
+        self._fileobj.write(
+            _ZSTD_SKIPPABLE_HEADER.pack(
+                _ZSTD_SEEK_TABLE_FRAME_MAGIC, len(entries) + len(footer)
+            )
+        )
+        self._fileobj.write(entries)
+        self._fileobj.write(footer)
+        super().close()
+
+
 def find_compression_type(fileobj: typing.IO[bytes]) -> Compression:
     fileobj.seek(0, os.SEEK_SET)
 
@@ -167,3 +514,47 @@ def _decompressor(
         return dctx.stream_reader(fileobj)
 
     raise ValueError("Unsupported compression type: %s" % compression)
+
+
+@contextlib.contextmanager
+def compressing_writer(
+    path: pathlib.Path,
+    compression: Compression,
+    *,
+    level: int,
+    threads: int = 0,
+    size: int = -1,
+    zstd_frame_size: int = 0,
+) -> typing.Iterator[typing.IO[bytes]]:
+    """Context manager, yield a file object that compresses to the path.
+
+    :param level: the compression level; its range depends on the compression.
+    :param threads: number of ZStandard compression threads; 0 compresses in
+        the calling thread, and -1 uses as many threads as there are CPUs.
+        Ignored for GZip.
+    :param size: the number of bytes that will be written, or -1 if unknown.
+        ZStandard stores this in the frame header.
+    :param zstd_frame_size: when non-zero, write a seekable ZStandard file
+        with frames of this many decompressed bytes. Ignored for GZip.
+    """
+    if compression == Compression.GZIP:
+        with gzip.open(str(path), "wb", compresslevel=level) as gzfile:
+            yield typing.cast(typing.IO[bytes], gzfile)
+        return
+
+    if compression == Compression.ZSTD:
+        if not has_zstandard:
+            raise EnvironmentError(
+                "Install the `zstandard` module to write ZStandard-compressed files."
+            )
+        cctx = zstandard.ZstdCompressor(level=level, threads=threads)
+        with path.open("wb") as outfile:
+            if zstd_frame_size > 0:
+                with SeekableZstdWriter(outfile, cctx, zstd_frame_size) as zstdfile:
+                    yield typing.cast(typing.IO[bytes], zstdfile)
+                return
+            with cctx.stream_writer(outfile, size=size, closefd=False) as zstdfile:
+                yield zstdfile
+        return
+
+    raise ValueError("Unsupported compression type: %s" % compression)
@@ -0,0 +1,149 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+# ***** END GPL LICENCE BLOCK *****
+"""Byte-range patches against blend files.
+
+Rewriting a few paths in a big blend file only changes a handful of bytes.
+Instead of copying the entire file and writing to the copy, the writes can be
+recorded as patches: (file offset, new bytes) tuples. These are then applied
+to the data while it is transferred to its destination.
+"""
+
+import bisect
+import io
+import os
+import pathlib
+import typing
+
+Patch = typing.Tuple[int, bytes]
+PatchList = typing.List[Patch]
+
+
+class PatchRecorder:
+    """File-like object that records writes as patches.
+
+    Only supports the subset of the file API that is used to write DNA
+    fields, i.e. seek(), tell(), and write().
+    """
+
+    def __init__(self) -> None:
+        self.patches = []  # type: PatchList
+        self._pos = 0
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            self._pos = offset
+        elif whence == os.SEEK_CUR:
+            self._pos += offset
+        else:
+            raise ValueError("unsupported whence %d" % whence)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def write(self, data: bytes) -> int:
+        self.patches.append((self._pos, bytes(data)))
+        self._pos += len(data)
+        return len(data)
+
+
+def merge(patches: typing.Iterable[Patch]) -> PatchList:
+    """Return equivalent patches that are sorted and do not overlap.
+
+    Where patches overlap, the later one wins, just like when they would have
+    been written to the file in order. This works per byte, so it is only
+    suitable for small patches like the ones recorded for changed fields.
+    """
+    patched = {}  # type: typing.Dict[int, int]
+    for offset, data in patches:
+        for index, byte in enumerate(data):
+            patched[offset + index] = byte
+
+    merged = []  # type: typing.List[typing.Tuple[int, bytearray]]
+    for offset in sorted(patched):
+        if merged and merged[-1][0] + len(merged[-1][1]) == offset:
+            merged[-1][1].append(patched[offset])
+        else:
+            merged.append((offset, bytearray((patched[offset],))))
+    return [(offset, bytes(data)) for offset, data in merged]
+
+
+def apply_in_place(fileobj: typing.IO[bytes], patches: PatchList) -> None:
+    """Write the patches to a file opened for writing."""
+    for offset, data in patches:
+        fileobj.seek(offset, os.SEEK_SET)
+        fileobj.write(data)
+
+
+class PatchedReader(io.RawIOBase):
+    """Read-only file object that applies patches to the data it reads.
+
+    The patches are applied on the fly, so the underlying file is never
+    modified and no temporary copy is needed. The size of the data does not
+    change.
+    """
+
+    def __init__(self, fileobj: typing.BinaryIO, patches: PatchList) -> None:
+        super().__init__()
+        self._fileobj = fileobj
+        self._patches = merge(patches)
+        self._offsets = [offset for offset, _ in self._patches]
+        self._pos = fileobj.tell()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        self._pos = self._fileobj.seek(offset, whence)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        num_read = self._fileobj.readinto(buffer)
+        if not num_read:
+            return num_read
+
+        start, end = self._pos, self._pos + num_read
+        view = memoryview(buffer).cast("B")
+
+        # Find the first patch that may overlap with the data read.
+        index = max(0, bisect.bisect_right(self._offsets, start) - 1)
+        for offset, data in self._patches[index:]:
+            if offset >= end:
+                break
+            low = max(offset, start)
+            high = min(offset + len(data), end)
+            if low < high:
+                view[low - start : high - start] = data[low - offset : high - offset]
+
+        self._pos = end
+        return num_read
+
+    def close(self) -> None:
+        self._fileobj.close()
+        super().close()
+
+
+def open_patched(path: pathlib.Path, patches: PatchList) -> PatchedReader:
+    """Open the file for reading, with the patches applied to its data."""
+    return PatchedReader(path.open("rb"), patches)
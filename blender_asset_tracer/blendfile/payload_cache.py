@@ -0,0 +1,117 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+# ***** END GPL LICENCE BLOCK *****
+"""LRU cache of block payloads.
+
+When a blend file is not memory-mapped, every field read is a seek() and a
+read() on the file object. The tracer often reads several fields of the same
+small block in a row, so instead the complete payload of such blocks is read
+once and kept in this cache.
+
+A single cache is shared by all open blend files, so that its byte budget
+limits the memory use of the process, regardless of how many files are kept
+open by open_cached().
+"""
+
+import collections
+import itertools
+import threading
+import typing
+
+# Cache key, as (file key, file offset).
+PayloadKey = typing.Tuple[int, int]
+
+_file_keys = itertools.count()
+
+
+def new_file_key() -> int:
+    """Return a file key that has never been used before.
+
+    A blend file takes a new key whenever its cached payloads become invalid,
+    for example when it is closed. Its old payloads can then never be
+    returned again, and are evicted as the cache fills up.
+    """
+    return next(_file_keys)
+
+
+class PayloadCache:
+    """Least-recently-used cache of block payloads, keyed by PayloadKey.
+
+    Evicts the least recently used payloads when the total size of the cached
+    payloads exceeds the byte budget. Safe to use from multiple threads.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._payloads = (
+            collections.OrderedDict()
+        )  # type: collections.OrderedDict[PayloadKey, bytes]
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._payloads)
+
+    def get(self, key: PayloadKey) -> typing.Optional[bytes]:
+        """Return the cached payload, or None if it is not cached."""
+        with self._lock:
+            try:
+                payload = self._payloads[key]
+            except KeyError:
+                return None
+            self._payloads.move_to_end(key)
+            return payload
+
+    def put(self, key: PayloadKey, payload: bytes) -> None:
+        """Cache the payload, evicting others if necessary.
+
+        Payloads that are larger than the entire budget are not cached.
+        """
+        if len(payload) > self.max_bytes:
+            return
+
+        with self._lock:
+            self._discard(key)
+            self._payloads[key] = payload
+            self.num_bytes += len(payload)
+            self._evict()
+
+    def discard(self, key: PayloadKey) -> None:
+        """Remove the payload from the cache, if it is cached."""
+        with self._lock:
+            self._discard(key)
+
+    def resize(self, max_bytes: int) -> None:
+        """Change the byte budget, evicting payloads if necessary."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._payloads.clear()
+            self.num_bytes = 0
+
+    def _discard(self, key: PayloadKey) -> None:
+        payload = self._payloads.pop(key, None)
+        if payload is not None:
+            self.num_bytes -= len(payload)
+
+    def _evict(self) -> None:
+        while self.num_bytes > self.max_bytes:
+            _, evicted = self._payloads.popitem(last=False)
+            self.num_bytes -= len(evicted)
@@ -24,7 +24,7 @@ import datetime
 import logging
 import time
 
-from . import blocks, common, pack, list_deps, version
+from . import blocks, common, graph, pack, list_deps, version
 
 
 def cli_main():
@@ -69,6 +69,13 @@ def cli_main():
         action="store_true",
         help="Crash on pointers to missing data; otherwise the missing data is just ignored.",
     )
+    parser.add_argument(
+        "-M",
+        "--mmap",
+        default=False,
+        action="store_true",
+        help="Access blend files through memory maps instead of seeking and reading.",
+    )
 
     subparsers = parser.add_subparsers(
         help="Choose a subcommand to actually make BAT do something. "
@@ -80,6 +87,7 @@ def cli_main():
     blocks.add_parser(subparsers)
     pack.add_parser(subparsers)
     list_deps.add_parser(subparsers)
+    graph.add_parser(subparsers)
     version.add_parser(subparsers)
 
     args = parser.parse_args()
@@ -98,6 +106,7 @@ def cli_main():
         parser.error("No subcommand was given")
 
     set_strict_pointer_mode(args.strict_pointers)
+    set_mmap_mode(args.mmap)
 
     start_time = time.time()
     if args.profile:
@@ -135,3 +144,9 @@ def set_strict_pointer_mode(strict_pointers: bool) -> None:
     from blender_asset_tracer import blendfile
 
     blendfile.set_strict_pointer_mode(strict_pointers)
+
+
+def set_mmap_mode(use_mmap: bool) -> None:
+    from blender_asset_tracer import blendfile
+
+    blendfile.set_mmap_mode(use_mmap)
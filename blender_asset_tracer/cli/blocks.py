@@ -122,21 +122,21 @@ def cli_blocks(args):
 
     print("Finding what points there")
     addr_to_find = biggest_block.addr_old
-    found_pointer = False
-    for block in bfile.blocks:
-        for prop_path, prop_value in block.items_recursive():
-            if not isinstance(prop_value, int) or prop_value != addr_to_find:
-                continue
+    referrers = bfile.referrers(addr_to_find)
+    for block, offset in referrers:
+        item_index, item_offset = divmod(offset, block.dna_type.size)
+        prop_path = block.dna_type.field_path_at(item_offset)
+        if block.count > 1:
+            print("    ", block, "item %d" % item_index, prop_path)
+        else:
             print("    ", block, prop_path)
-            found_pointer = True
 
-    if not found_pointer:
+    if not referrers:
         print("Nothing points there")
 
     if args.dump:
         print("Hexdump:")
-        bfile.fileobj.seek(biggest_block.file_offset)
-        data = bfile.fileobj.read(biggest_block.size)
+        data = biggest_block.raw_data()
         line_len_bytes = 32
         import codecs
 
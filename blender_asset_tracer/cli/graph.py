@@ -0,0 +1,116 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+# ***** END GPL LICENCE BLOCK *****
+"""Show which blend files in a project link which libraries."""
+import functools
+import json
+import logging
+import pathlib
+import sys
+
+from blender_asset_tracer import bpathlib
+from blender_asset_tracer.trace import library_graph
+from . import common
+
+log = logging.getLogger(__name__)
+
+
+def add_parser(subparsers):
+    """Add argparser for this subcommand."""
+
+    parser = subparsers.add_parser("graph", help=__doc__)
+    parser.set_defaults(func=cli_graph)
+    parser.add_argument("project", type=pathlib.Path)
+    common.add_flag(
+        parser, "json", help="Output as JSON instead of human-readable text"
+    )
+    parser.add_argument(
+        "--users-of",
+        type=pathlib.Path,
+        metavar="LIBRARY",
+        help="Only list the blend files that link this library, directly or "
+        "indirectly. These are the files affected when the library changes.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        metavar="N",
+        help="Number of worker processes; defaults to the number of CPUs.",
+    )
+
+
+def cli_graph(args):
+    project = args.project
+    if not project.is_dir():
+        log.fatal("Project directory %s does not exist", project)
+        return 3
+
+    graph = library_graph.scan(project, max_workers=args.workers)
+
+    if args.users_of:
+        lib_path = bpathlib.make_absolute(args.users_of)
+        report_paths(sorted(graph.all_users(lib_path)), args.json)
+    elif args.json:
+        report_json(graph)
+    else:
+        report_text(graph)
+
+    if graph.errors:
+        log.error("%d blend files could not be read", len(graph.errors))
+        return 1
+
+
+def report_paths(paths, as_json: bool):
+    if as_json:
+        json.dump([str(path) for path in paths], sys.stdout, indent=4)
+        return
+
+    shorten = functools.partial(common.shorten, pathlib.Path.cwd())
+    for path in paths:
+        print(shorten(path))
+
+
+def report_text(graph: library_graph.LibraryGraph):
+    shorten = functools.partial(common.shorten, pathlib.Path.cwd())
+    missing = graph.missing_libraries()
+
+    for bfilepath in sorted(graph.blendfiles):
+        print(shorten(bfilepath))
+        for lib_path in sorted(graph.libraries.get(bfilepath, ())):
+            if lib_path in missing:
+                print("   ", shorten(lib_path), "(missing)")
+            else:
+                print("   ", shorten(lib_path))
+
+    for bfilepath, error in sorted(graph.errors.items()):
+        print(shorten(bfilepath), "(unreadable: %s)" % error)
+
+
+def report_json(graph: library_graph.LibraryGraph):
+    def as_json(mapping):
+        return {
+            str(path): sorted(str(other) for other in others)
+            for path, others in sorted(mapping.items())
+        }
+
+    report = {
+        "libraries": as_json(graph.libraries),
+        "users": as_json(graph.users),
+        "missing": sorted(str(path) for path in graph.missing_libraries()),
+        "errors": {str(path): error for path, error in sorted(graph.errors.items())},
+    }
+    json.dump(report, sys.stdout, indent=4)
@@ -49,6 +49,21 @@ def add_parser(subparsers):
         "SHA256sums in a BAT-pack when paths are rewritten.",
     )
     common.add_flag(parser, "timing", help="Include timing information in the output")
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Open up to N linked libraries in the background while tracing "
+        "the current one. The output is the same as without prefetching.",
+    )
+    parser.add_argument(
+        "--index",
+        type=pathlib.Path,
+        metavar="DBFILE",
+        help="SQLite database to store trace results in. Blend files that did "
+        "not change since the last run are not traced again.",
+    )
 
 
 def cli_list(args):
@@ -62,9 +77,29 @@ def cli_list(args):
             log.fatal("--sha256 can currently not be used in combination with --json")
         if args.timing:
             log.fatal("--timing can currently not be used in combination with --json")
-        report_json(bpath)
-    else:
-        report_text(bpath, include_sha256=args.sha256, show_timing=args.timing)
+
+    if args.index and args.prefetch:
+        log.fatal("--prefetch can currently not be used in combination with --index")
+        return 3
+
+    dep_index = None
+    if args.index:
+        dep_index = trace.index.DependencyIndex(args.index)
+    trace_options = {"prefetch_libraries": args.prefetch, "dep_index": dep_index}
+
+    try:
+        if args.json:
+            report_json(bpath, trace_options)
+        else:
+            report_text(
+                bpath,
+                include_sha256=args.sha256,
+                show_timing=args.timing,
+                trace_options=trace_options,
+            )
+    finally:
+        if dep_index is not None:
+            dep_index.close()
 
 
 def calc_sha_sum(filepath: pathlib.Path) -> typing.Tuple[str, float]:
@@ -90,7 +125,13 @@ def calc_sha_sum(filepath: pathlib.Path) -> typing.Tuple[str, float]:
     return digest, duration
 
 
-def report_text(bpath, *, include_sha256: bool, show_timing: bool):
+def report_text(
+    bpath,
+    *,
+    include_sha256: bool,
+    show_timing: bool,
+    trace_options: typing.Optional[typing.Dict[str, typing.Any]] = None,
+):
     reported_assets = set()  # type: typing.Set[pathlib.Path]
     last_reported_bfile = None
     shorten = functools.partial(common.shorten, pathlib.Path.cwd())
@@ -98,7 +139,7 @@ def report_text(bpath, *, include_sha256: bool, show_timing: bool):
     time_spent_on_shasums = 0.0
     start_time = time.time()
 
-    for usage in trace.deps(bpath):
+    for usage in trace.deps(bpath, **(trace_options or {})):
         filepath = usage.block.bfile.filepath.absolute()
         if filepath != last_reported_bfile:
             if include_sha256:
@@ -142,13 +183,15 @@ class JSONSerialiser(json.JSONEncoder):
         return super().default(o)
 
 
-def report_json(bpath):
+def report_json(
+    bpath, trace_options: typing.Optional[typing.Dict[str, typing.Any]] = None
+):
     import collections
 
     # Mapping from blend file to its dependencies.
     report = collections.defaultdict(set)
 
-    for usage in trace.deps(bpath):
+    for usage in trace.deps(bpath, **(trace_options or {})):
         filepath = usage.block.bfile.filepath.absolute()
         for assetpath in usage.files():
             assetpath = assetpath.resolve()
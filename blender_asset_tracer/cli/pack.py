@@ -18,6 +18,7 @@
 #
 # (c) 2018, Blender Foundation - Sybren A. Stüvel
 """Create a BAT-pack for the given blend file."""
+import argparse
 import logging
 import pathlib
 import sys
@@ -88,6 +89,35 @@ def add_parser(subparsers):
         help="Only pack assets that are referred to with a relative path (e.g. "
         "starting with `//`.",
     )
+    parser.add_argument(
+        "-s",
+        "--streaming",
+        default=False,
+        action="store_true",
+        help="Start copying assets while the dependencies are still being "
+        "traced. This option is only valid when packing into a directory or "
+        "ZIP file.",
+    )
+    parser.add_argument(
+        "--threads",
+        type=positive_int,
+        metavar="N",
+        help="Maximum number of files to copy at the same time, per lane of "
+        "large and small files. Without compression, BAT starts with one and "
+        "uses more while that speeds things up. This option is only valid "
+        "when packing into a directory.",
+    )
+
+
+def positive_int(value: str) -> int:
+    """Argparse type for options that need a number of at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("%r is not a whole number" % value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("%d is not a positive number" % number)
+    return number
 
 
 def cli_pack(args):
@@ -119,6 +149,12 @@ def create_packer(
         if args.relative_only:
             raise ValueError("S3 uploader does not support the --relative-only option")
 
+        if args.streaming:
+            raise ValueError("S3 uploader does not support the --streaming option")
+
+        if args.threads is not None:
+            raise ValueError("S3 uploader does not support the --threads option")
+
         packer = create_s3packer(bpath, ppath, pathlib.PurePosixPath(target))
 
     elif (
@@ -137,6 +173,12 @@ def create_packer(
                 "Shaman uploader does not support the --relative-only option"
             )
 
+        if args.streaming:
+            raise ValueError("Shaman uploader does not support the --streaming option")
+
+        if args.threads is not None:
+            raise ValueError("Shaman uploader does not support the --threads option")
+
         packer = create_shamanpacker(bpath, ppath, target)
 
     elif target.lower().endswith(".zip"):
@@ -145,8 +187,16 @@ def create_packer(
         if args.compress:
             raise ValueError("ZIP packer does not support on-the-fly compression")
 
+        if args.threads is not None:
+            raise ValueError("ZIP packer does not support the --threads option")
+
         packer = zipped.ZipPacker(
-            bpath, ppath, target, noop=args.noop, relative_only=args.relative_only
+            bpath,
+            ppath,
+            target,
+            noop=args.noop,
+            relative_only=args.relative_only,
+            streaming=args.streaming,
         )
     else:
         packer = pack.Packer(
@@ -156,6 +206,8 @@ def create_packer(
             noop=args.noop,
             compress=args.compress,
             relative_only=args.relative_only,
+            streaming=args.streaming,
+            transfer_threads=args.threads,
         )
 
     if args.exclude:
@@ -5,7 +5,8 @@ import logging
 import pathlib
 import shutil
 
-from blender_asset_tracer.blendfile import magic_compression
+from blender_asset_tracer import fastcopy
+from blender_asset_tracer.blendfile import magic_compression, patching
 
 log = logging.getLogger(__name__)
 
@@ -38,7 +39,26 @@ def copy(src: pathlib.Path, dest: pathlib.Path):
     if src.suffix.lower() == ".blend":
         _move_or_copy(src, dest, my_log, source_must_remain=True)
     else:
-        shutil.copy2(str(src), str(dest))
+        fastcopy.copy2(src, dest)
+
+
+def copy_patched(src: pathlib.Path, dest: pathlib.Path, patches: patching.PatchList):
+    """Copy a file from src to dest with the patches applied, gzip-compressing.
+
+    Patches are only recorded against uncompressed blend files, so unlike
+    copy() this does not check whether the source is compressed already.
+    Only compresses files ending in .blend; others are copied as-is.
+    """
+    my_log = log.getChild("copy_patched")
+    my_log.debug("Copying %s to %s with %d patches", src, dest, len(patches))
+
+    with patching.open_patched(src, patches) as srcfile:
+        if src.suffix.lower() == ".blend":
+            with gzip.open(str(dest), mode="wb") as destfile:
+                shutil.copyfileobj(srcfile, destfile, BLOCK_SIZE)
+        else:
+            with dest.open("wb") as destfile:
+                shutil.copyfileobj(srcfile, destfile, BLOCK_SIZE)
 
 
 def _move_or_copy(
@@ -64,7 +84,7 @@ def _move_or_copy(
             srcfile.close()
             my_log.debug("Source file %s is compressed already", src)
             if source_must_remain:
-                shutil.copy2(str(src), str(dest))
+                fastcopy.copy2(src, dest)
             else:
                 shutil.move(str(src), str(dest))
             return
@@ -0,0 +1,182 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+# ***** END GPL LICENCE BLOCK *****
+"""File copies that let the kernel do the work where possible.
+
+The copy strategies are tried from fastest to slowest:
+
+- a reflink (FICLONE), which shares the data blocks between both files on
+  copy-on-write filesystems like btrfs and XFS, so no data is copied at all;
+- os.copy_file_range(), which copies inside the kernel, and can be offloaded
+  to the storage or network filesystem server;
+- os.sendfile(), which also copies inside the kernel;
+- a plain read/write loop in user space.
+
+A strategy that is not supported for a pair of filesystems is not tried
+again for other files on the same pair.
+"""
+
+import enum
+import errno
+import logging
+import os
+import pathlib
+import shutil
+import sys
+import typing
+
+log = logging.getLogger(__name__)
+
+# Block size for the kernel-side copies and the user space fallback, in bytes.
+BLOCK_SIZE = 8 * 2**20
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# Errors that indicate a strategy is not supported, rather than that copying
+# itself failed.
+_UNSUPPORTED_ERRNOS = {
+    errno.EBADF,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTSUP,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EPERM,
+    errno.ETXTBSY,
+    errno.EXDEV,
+}
+
+
+class Strategy(enum.Enum):
+    REFLINK = "reflink"
+    COPY_FILE_RANGE = "copy_file_range"
+    SENDFILE = "sendfile"
+    USERSPACE = "userspace"
+
+
+# (strategy, source device, destination device) combinations that failed.
+_unsupported = set()  # type: typing.Set[typing.Tuple[Strategy, int, int]]
+
+
+# Each strategy returns the number of bytes it copied.
+
+
+def _reflink(infd: int, outfd: int, size: int) -> int:
+    import fcntl
+
+    fcntl.ioctl(outfd, FICLONE, infd)
+    return os.fstat(outfd).st_size
+
+
+def _copy_file_range(infd: int, outfd: int, size: int) -> int:
+    offset = 0
+    while offset < size:
+        count = min(size - offset, BLOCK_SIZE)
+        copied = os.copy_file_range(infd, outfd, count, offset, offset)
+        if not copied:
+            break
+        offset += copied
+    return offset
+
+
+def _sendfile(infd: int, outfd: int, size: int) -> int:
+    offset = 0
+    while offset < size:
+        count = min(size - offset, BLOCK_SIZE)
+        sent = os.sendfile(outfd, infd, offset, count)
+        if not sent:
+            break
+        offset += sent
+    return offset
+
+
+def _strategies() -> typing.List[typing.Tuple[Strategy, typing.Callable]]:
+    strategies = []  # type: typing.List[typing.Tuple[Strategy, typing.Callable]]
+    if sys.platform.startswith("linux"):
+        strategies.append((Strategy.REFLINK, _reflink))
+    if hasattr(os, "copy_file_range"):
+        strategies.append((Strategy.COPY_FILE_RANGE, _copy_file_range))
+    if sys.platform.startswith("linux") and hasattr(os, "sendfile"):
+        strategies.append((Strategy.SENDFILE, _sendfile))
+    return strategies
+
+
+_STRATEGIES = _strategies()
+
+
+def copyfile(src: pathlib.Path, dst: pathlib.Path) -> Strategy:
+    """Copy the contents of src to dst, overwriting dst if it exists.
+
+    :returns: the strategy that performed the copy.
+    """
+    with src.open("rb", buffering=0) as infile, dst.open(
+        "wb", buffering=0
+    ) as outfile:
+        infd, outfd = infile.fileno(), outfile.fileno()
+        in_stat, out_stat = os.fstat(infd), os.fstat(outfd)
+        size = in_stat.st_size
+        devices = (in_stat.st_dev, out_stat.st_dev)
+
+        # Files that report a zero size may still have contents, like the ones
+        # in /proc, so only the user space copy is used for those.
+        strategies = _STRATEGIES if size else []
+        for strategy, func in strategies:
+            if (strategy, *devices) in _unsupported:
+                continue
+            try:
+                copied = func(infd, outfd, size)
+            except OSError as ex:
+                if ex.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+                log.debug("Unable to %s %s to %s: %s", strategy.value, src, dst, ex)
+            else:
+                if copied >= size:
+                    return strategy
+                # Some filesystems report success without copying everything,
+                # for example by returning 0 from copy_file_range().
+                log.debug(
+                    "Unable to %s %s to %s: copied only %d of %d bytes",
+                    strategy.value,
+                    src,
+                    dst,
+                    copied,
+                    size,
+                )
+
+            _unsupported.add((strategy, *devices))
+            # Start over, as the strategy may have copied part of the file.
+            outfile.seek(0)
+            outfile.truncate()
+
+        infile.seek(0)
+        outfile.seek(0)
+        outfile.truncate()
+        shutil.copyfileobj(infile, outfile, BLOCK_SIZE)
+        return Strategy.USERSPACE
+
+
+def copy2(src: pathlib.Path, dst: pathlib.Path) -> Strategy:
+    """Like shutil.copy2(), but copies the contents with copyfile().
+
+    :returns: the strategy that performed the copy.
+    """
+    if dst.is_dir():
+        dst = dst / src.name
+    strategy = copyfile(src, dst)
+    shutil.copystat(str(src), str(dst))
+    return strategy
@@ -18,6 +18,7 @@
 #
 # (c) 2018, Blender Foundation - Sybren A. Stüvel
 import collections
+import concurrent.futures
 import enum
 import functools
 import logging
@@ -27,6 +28,7 @@ import threading
 import typing
 
 from blender_asset_tracer import trace, bpathlib, blendfile
+from blender_asset_tracer.blendfile import patching
 from blender_asset_tracer.trace import file_sequence, result
 
 from . import filesystem, transfer, progress
@@ -65,6 +67,14 @@ class AssetAction:
         when this property is set, the file can be moved instead of copied.
         """
 
+        self.patches = None  # type: typing.Optional[patching.PatchList]
+        """Optional patches to apply while transferring the asset.
+
+        This is used instead of read_from when a blend file is rewritten
+        without making a temporary copy. The patches are (file offset, new
+        bytes) tuples against the original file.
+        """
+
         self.rewrites = []  # type: typing.List[result.BlockUsage]
         """BlockUsage objects in this asset that may require rewriting.
 
@@ -92,8 +102,18 @@ class Packer:
 
     The file transfer is performed in a separate thread by a FileTransferer
     instance.
+
+    In streaming mode the file transfer already starts in strategise(). Assets
+    that keep their path in the BAT Pack are queued as soon as the tracer
+    reports them, and only the blend files wait for execute(), as those may
+    have to be rewritten.
     """
 
+    # Rewriting a blend file is mostly I/O: copying the file, then writing
+    # the changed fields. Each file is rewritten in its own temporary copy,
+    # so a few of them can be rewritten at the same time.
+    rewrite_threads = 4  # type: typing.Optional[int]
+
     def __init__(
         self,
         bfile: pathlib.Path,
@@ -103,6 +123,8 @@ class Packer:
         noop=False,
         compress=False,
         relative_only=False,
+        streaming=False,
+        transfer_threads: typing.Optional[int] = None,
     ) -> None:
         self.blendfile = bfile
         self.project = project
@@ -111,6 +133,8 @@ class Packer:
         self.noop = noop
         self.compress = compress
         self.relative_only = relative_only
+        self.streaming = streaming
+        self.transfer_threads = transfer_threads
         self._aborted = threading.Event()
         self._abort_lock = threading.RLock()
         self._abort_reason = ""
@@ -135,6 +159,11 @@ class Packer:
         self._new_location_paths = set()  # type: typing.Set[pathlib.Path]
         self._output_path = None  # type: typing.Optional[pathlib.PurePath]
 
+        # Mapping from asset path to its packed path, for the assets that were
+        # queued for transfer before _copy_files_to_target() runs. These are
+        # streamed assets (see strategise()) and rewritten blend files.
+        self._queued = {}  # type: typing.Dict[pathlib.Path, pathlib.PurePath]
+
         # Filled by execute()
         self._file_transferer = None  # type: typing.Optional[transfer.FileTransferer]
 
@@ -193,6 +222,16 @@ class Packer:
                 self._file_transferer.abort()
             self._aborted.set()
 
+    def _is_aborted(self) -> bool:
+        """Return whether packing should stop, without reporting it.
+
+        Unlike _check_aborted(), this can be called from worker threads.
+        """
+        with self._abort_lock:
+            if self._aborted.is_set():
+                return True
+            return self._file_transferer is not None and self._file_transferer.has_error
+
     def _check_aborted(self) -> None:
         """Raises an Aborted exception when abort() was called."""
 
@@ -254,6 +293,21 @@ class Packer:
 
         self._check_aborted()
         self._new_location_paths = set()
+        self._queued = {}
+        if self.streaming:
+            self._start_file_transferrer()
+
+        try:
+            self._trace_assets()
+        except BaseException:
+            self._stop_file_transferrer()
+            raise
+
+        self._find_new_paths()
+        self._group_rewrites()
+
+    def _trace_assets(self) -> None:
+        """Visit every asset reported by the tracer."""
         for usage in trace.deps(self.blendfile, self._progress_cb):
             self._check_aborted()
             asset_path = usage.abspath
@@ -270,9 +324,6 @@ class Packer:
             else:
                 self._visit_asset(asset_path, usage)
 
-        self._find_new_paths()
-        self._group_rewrites()
-
     def _visit_sequence(self, asset_path: pathlib.Path, usage: result.BlockUsage):
         assert usage.is_sequence
 
@@ -338,6 +389,42 @@ class Packer:
             asset_pp = self._target_path / asset_path.relative_to(self.project)
             act.new_path = asset_pp
 
+            if (
+                self.streaming
+                and act.path_action == PathAction.KEEP_PATH
+                and not self._may_need_rewriting(asset_path, usage)
+            ):
+                self._stream_asset(asset_path, act)
+
+    @staticmethod
+    def _may_need_rewriting(
+        asset_path: pathlib.Path, usage: result.BlockUsage
+    ) -> bool:
+        """Return whether the asset is a blend file.
+
+        Blend files may have to be rewritten, which is only known after the
+        entire dependency tree has been traced.
+        """
+        return usage.block.code == b"LI" or asset_path.suffix.startswith(".blend")
+
+    def _stream_asset(self, asset_path: pathlib.Path, action: AssetAction) -> None:
+        """Queue the asset for transfer while strategise() is still running.
+
+        A later usage can still require a new location for the asset, for
+        example when another blend file refers to it by absolute path. In
+        that case _find_new_paths() keeps the asset at the location it was
+        streamed to, and only the usages are rewritten to point there.
+        """
+        if asset_path in self._queued:
+            return
+        self._queue_asset(asset_path, action)
+
+    def _queue_asset(self, asset_path: pathlib.Path, action: AssetAction) -> None:
+        """Queue the asset for transfer ahead of _copy_files_to_target()."""
+        assert action.new_path is not None
+        self._queued[asset_path] = action.new_path
+        self._copy_asset_and_deps(asset_path, action)
+
     def _find_new_paths(self):
         """Find new locations in the BAT Pack for the given assets."""
 
@@ -345,6 +432,13 @@ class Packer:
             act = self._actions[path]
             assert isinstance(act, AssetAction)
 
+            # Streamed assets are already on their way to the BAT Pack, so
+            # they keep their location; moving them would leave the streamed
+            # copy behind.
+            if path in self._queued:
+                act.new_path = self._queued[path]
+                continue
+
             relpath = bpathlib.strip_root(path)
             act.new_path = pathlib.Path(self._target_path, "_outside_project", relpath)
 
@@ -387,13 +481,27 @@ class Packer:
         """Execute the strategy."""
         assert self._actions, "Run strategise() first"
 
+        if self._file_transferer is None:
+            # In streaming mode it was already started by strategise().
+            self._start_file_transferrer()
+
         if not self.noop:
-            self._rewrite_paths()
+            try:
+                self._rewrite_paths()
+            except BaseException:
+                self._stop_file_transferrer()
+                raise
 
-        self._start_file_transferrer()
         self._perform_file_transfer()
         self._progress_cb.pack_done(self.output_path, self.missing_files)
 
+    def _stop_file_transferrer(self) -> None:
+        """Abort the file transfer, when packing fails before it is queued."""
+        if self._file_transferer is None:
+            return
+        self._file_transferer.abort_and_join()
+        self._file_transferer = None
+
     def _perform_file_transfer(self):
         """Use file transferrer to do the actual file transfer.
 
@@ -408,8 +516,8 @@ class Packer:
         """Create a FileCopier(), can be overridden in a subclass."""
 
         if self.compress:
-            return filesystem.CompressedFileCopier()
-        return filesystem.FileCopier()
+            return filesystem.CompressedFileCopier(self.transfer_threads)
+        return filesystem.FileCopier(self.transfer_threads)
 
     def _start_file_transferrer(self):
         """Starts the file transferrer thread."""
@@ -430,6 +538,9 @@ class Packer:
         try:
             for asset_path, action in self._actions.items():
                 self._check_aborted()
+                if self._queued.get(asset_path) == action.new_path:
+                    log.debug("Already queued %s", asset_path)
+                    continue
                 self._copy_asset_and_deps(asset_path, action)
 
             if self.noop:
@@ -461,97 +572,159 @@ class Packer:
     def _rewrite_paths(self) -> None:
         """Rewrite paths to the new location of the assets.
 
-        Writes the rewritten blend files to a temporary location.
+        Writes the rewritten blend files to a temporary location. Independent
+        blend files are rewritten in parallel, and each rewritten file is
+        queued for transfer as soon as it is done.
         """
 
-        for bfile_path, action in self._actions.items():
-            if not action.rewrites:
-                continue
-            self._check_aborted()
+        to_rewrite = [
+            bfile_path
+            for bfile_path, action in self._actions.items()
+            if action.rewrites
+        ]
+        if not to_rewrite:
+            return
 
-            assert isinstance(bfile_path, pathlib.Path)
-            # bfile_pp is the final path of this blend file in the BAT pack.
-            # It is used to determine relative paths to other blend files.
-            # It is *not* used for any disk I/O, since the file may not even
-            # exist on the local filesystem.
-            bfile_pp = action.new_path
-            assert (
-                bfile_pp is not None
-            ), f"Action {action.path_action.name} on {bfile_path} has no final path set, unable to process"
-
-            # Use tempfile to create a unique name in our temporary directoy.
-            # The file should be deleted when self.close() is called, and not
-            # when the bfile_tp object is GC'd.
-            bfile_tmp = tempfile.NamedTemporaryFile(
-                dir=str(self._rewrite_in),
-                prefix="bat-",
-                suffix="-" + bfile_path.name,
-                delete=False,
-            )
-            bfile_tp = pathlib.Path(bfile_tmp.name)
-            action.read_from = bfile_tp
-            log.info("Rewriting %s to %s", bfile_path, bfile_tp)
+        pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.rewrite_threads, thread_name_prefix="bat-rewrite"
+        )
+        try:
+            futures = {
+                pool.submit(self._rewrite_blendfile, bfile_path): bfile_path
+                for bfile_path in to_rewrite
+            }
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+                self._tscb.flush()
+                self._check_aborted()
 
-            # The original blend file will have been cached, so we can use it
-            # to avoid re-parsing all data blocks in the to-be-rewritten file.
-            bfile = blendfile.open_cached(bfile_path, assert_cached=True)
-            bfile.copy_and_rebind(bfile_tp, mode="rb+")
+                bfile_path = futures[future]
+                self._queue_asset(bfile_path, self._actions[bfile_path])
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            self._tscb.flush()
 
-            for usage in action.rewrites:
-                self._check_aborted()
-                assert isinstance(usage, result.BlockUsage)
-                asset_pp = self._actions[usage.abspath].new_path
-                assert isinstance(asset_pp, pathlib.Path)
-
-                log.debug("   - %s is packed at %s", usage.asset_path, asset_pp)
-                relpath = bpathlib.BlendPath.mkrelative(asset_pp, bfile_pp)
-                if relpath == usage.asset_path:
-                    log.info("   - %s remained at %s", usage.asset_path, relpath)
-                    continue
+    def _rewrite_blendfile(self, bfile_path: pathlib.Path) -> None:
+        """Rewrite the paths in the blend file.
+
+        When the file transferer supports it, the changes are recorded as
+        patches against the original blend file, which are applied while
+        transferring it. Otherwise, and for compressed blend files, a copy of
+        the blend file is rewritten instead.
 
-                log.info("   - %s moved to %s", usage.asset_path, relpath)
-
-                # Find the same block in the newly copied file.
-                block = bfile.dereference_pointer(usage.block.addr_old)
-
-                # Pointers can point to a non-existing data block, in which case
-                # either a SegmentationFault exception is thrown, or None is
-                # returned, based on the strict pointer mode set on the
-                # BlendFile class. Since this block was already meant to be
-                # rewritten, it was found before.
-                assert block is not None
-
-                if usage.path_full_field is None:
-                    dir_field = usage.path_dir_field
-                    assert dir_field is not None
-                    log.debug(
-                        "   - updating field %s of block %s",
-                        dir_field.name.name_only,
-                        block,
-                    )
-                    reldir = bpathlib.BlendPath.mkrelative(asset_pp.parent, bfile_pp)
-                    written = block.set(dir_field.name.name_only, reldir)
-                    log.debug("   - written %d bytes", written)
-
-                    # BIG FAT ASSUMPTION that the filename (e.g. basename
-                    # without path) does not change. This makes things much
-                    # easier, as in the sequence editor the directory and
-                    # filename fields are in different blocks. See the
-                    # blocks2assets.scene() function for the implementation.
-                else:
-                    log.debug(
-                        "   - updating field %s of block %s",
-                        usage.path_full_field.name.name_only,
-                        block,
-                    )
-                    written = block.set(usage.path_full_field.name.name_only, relpath)
-                    log.debug("   - written %d bytes", written)
-
-            # Make sure we close the file, otherwise changes may not be
-            # flushed before it gets copied.
-            if bfile.is_modified:
-                self._progress_cb.rewrite_blendfile(bfile_path)
-            bfile.close()
+        This is called from a worker thread of _rewrite_paths(); different
+        blend files can be rewritten at the same time.
+        """
+        action = self._actions[bfile_path]
+
+        assert isinstance(bfile_path, pathlib.Path)
+        # bfile_pp is the final path of this blend file in the BAT pack.
+        # It is used to determine relative paths to other blend files.
+        # It is *not* used for any disk I/O, since the file may not even
+        # exist on the local filesystem.
+        bfile_pp = action.new_path
+        assert (
+            bfile_pp is not None
+        ), f"Action {action.path_action.name} on {bfile_path} has no final path set, unable to process"
+
+        # The original blend file will have been cached, so we can use it
+        # to avoid re-parsing all data blocks in the to-be-rewritten file.
+        bfile = blendfile.open_cached(bfile_path, assert_cached=True)
+
+        assert self._file_transferer is not None
+        if self._file_transferer.supports_patches and not bfile.is_compressed:
+            log.info("Rewriting %s as patches", bfile_path)
+            patches = bfile.record_patches()
+            try:
+                self._rewrite_usages(bfile, bfile_pp, action)
+            finally:
+                bfile.stop_recording_patches()
+            if patches:
+                action.patches = patches
+                self._tscb.rewrite_blendfile(bfile_path)
+            return
+
+        # Use tempfile to create a unique name in our temporary directoy.
+        # The file should be deleted when self.close() is called, and not
+        # when the bfile_tp object is GC'd.
+        bfile_tmp = tempfile.NamedTemporaryFile(
+            dir=str(self._rewrite_in),
+            prefix="bat-",
+            suffix="-" + bfile_path.name,
+            delete=False,
+        )
+        bfile_tp = pathlib.Path(bfile_tmp.name)
+        action.read_from = bfile_tp
+        log.info("Rewriting %s to %s", bfile_path, bfile_tp)
+
+        bfile.copy_and_rebind(bfile_tp, mode="rb+")
+        self._rewrite_usages(bfile, bfile_pp, action)
+
+        # Make sure we close the file, otherwise changes may not be
+        # flushed before it gets copied.
+        if bfile.is_modified:
+            self._tscb.rewrite_blendfile(bfile_path)
+        bfile.close()
+
+    def _rewrite_usages(
+        self,
+        bfile: blendfile.BlendFile,
+        bfile_pp: pathlib.PurePath,
+        action: AssetAction,
+    ) -> None:
+        """Point the rewritten paths in the blend file to the packed assets."""
+
+        for usage in action.rewrites:
+            if self._is_aborted():
+                # The abort is reported by _rewrite_paths() in the main thread.
+                break
+            assert isinstance(usage, result.BlockUsage)
+            asset_pp = self._actions[usage.abspath].new_path
+            assert isinstance(asset_pp, pathlib.Path)
+
+            log.debug("   - %s is packed at %s", usage.asset_path, asset_pp)
+            relpath = bpathlib.BlendPath.mkrelative(asset_pp, bfile_pp)
+            if relpath == usage.asset_path:
+                log.info("   - %s remained at %s", usage.asset_path, relpath)
+                continue
+
+            log.info("   - %s moved to %s", usage.asset_path, relpath)
+
+            # Find the same block in the file being rewritten.
+            block = bfile.dereference_pointer(usage.block.addr_old)
+
+            # Pointers can point to a non-existing data block, in which case
+            # either a SegmentationFault exception is thrown, or None is
+            # returned, based on the strict pointer mode set on the
+            # BlendFile class. Since this block was already meant to be
+            # rewritten, it was found before.
+            assert block is not None
+
+            if usage.path_full_field is None:
+                dir_field = usage.path_dir_field
+                assert dir_field is not None
+                log.debug(
+                    "   - updating field %s of block %s",
+                    dir_field.name.name_only,
+                    block,
+                )
+                reldir = bpathlib.BlendPath.mkrelative(asset_pp.parent, bfile_pp)
+                written = block.set(dir_field.name.name_only, reldir)
+                log.debug("   - written %d bytes", written)
+
+                # BIG FAT ASSUMPTION that the filename (e.g. basename
+                # without path) does not change. This makes things much
+                # easier, as in the sequence editor the directory and
+                # filename fields are in different blocks. See the
+                # blocks2assets.scene() function for the implementation.
+            else:
+                log.debug(
+                    "   - updating field %s of block %s",
+                    usage.path_full_field.name.name_only,
+                    block,
+                )
+                written = block.set(usage.path_full_field.name.name_only, relpath)
+                log.debug("   - written %d bytes", written)
 
     def _copy_asset_and_deps(self, asset_path: pathlib.Path, action: AssetAction):
         asset_path_is_dir = asset_path.is_dir()
@@ -567,7 +740,10 @@ class Packer:
             assert packed_path is not None
             read_path = action.read_from or asset_path
             self._send_to_target(
-                read_path, packed_path, may_move=action.read_from is not None
+                read_path,
+                packed_path,
+                may_move=action.read_from is not None,
+                patches=action.patches,
             )
 
         if asset_path_is_dir:  # like 'some/directory':
@@ -607,7 +783,11 @@ class Packer:
             break
 
     def _send_to_target(
-        self, asset_path: pathlib.Path, target: pathlib.PurePath, may_move=False
+        self,
+        asset_path: pathlib.Path,
+        target: pathlib.PurePath,
+        may_move=False,
+        patches: typing.Optional[patching.PatchList] = None,
     ):
         if self.noop:
             print("%s -> %s" % (asset_path, target))
@@ -620,7 +800,9 @@ class Packer:
         self._tscb.flush()
 
         assert self._file_transferer is not None
-        if may_move:
+        if patches is not None:
+            self._file_transferer.queue_patched_copy(asset_path, target, patches)
+        elif may_move:
             self._file_transferer.queue_move(asset_path, target)
         else:
             self._file_transferer.queue_copy(asset_path, target)
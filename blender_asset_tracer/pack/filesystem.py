@@ -17,35 +17,179 @@
 # ***** END GPL LICENCE BLOCK *****
 #
 # (c) 2018, Blender Foundation - Sybren A. Stüvel
+import functools
 import logging
 import multiprocessing.pool
+import os
 import pathlib
 import shutil
+import threading
+import time
 import typing
 
-from .. import compressor
+from .. import compressor, fastcopy
+from ..blendfile import patching
 from . import transfer
 
 log = logging.getLogger(__name__)
 
+# Files of at least this size are copied in a separate lane, so that they do
+# not hold up the many smaller files.
+LARGE_FILE_SIZE = 64 * 2**20
+
+# Smaller files are handed to the worker threads in batches of this many
+# files or bytes, whichever limit is reached first.
+SMALL_BATCH_FILES = 32
+SMALL_BATCH_BYTES = 16 * 2**20
+
+TransferItem = typing.Tuple[
+    pathlib.Path,
+    pathlib.Path,
+    transfer.Action,
+    typing.Optional[patching.PatchList],
+]
+
 
 class AbortTransfer(Exception):
     """Raised when an error was detected and file transfer should be aborted."""
 
 
-class FileCopier(transfer.FileTransferer):
-    """Copies or moves files in source directory order."""
+class ThroughputTuner:
+    """Limits the number of concurrent transfers, tuned to the throughput.
+
+    Whether parallel copies help depends on the storage: a single spinning
+    disk is fastest with one copy at a time, whereas NVMe drives and network
+    shares need several copies in flight to reach their full bandwidth.
+
+    The tuner measures the throughput over windows of at least `window`
+    seconds. After each window it changes the limit by one in the direction
+    that last improved the throughput, and reverses direction when the
+    throughput drops. Windows in which not all transfers had to wait for a
+    free slot are not used, as those measure the supply of files rather than
+    the speed of the storage.
+    """
+
+    window = 1.0
+    """Minimum duration of a measurement window, in seconds."""
+
+    tolerance = 0.1
+    """Relative throughput change that is considered noise."""
+
+    def __init__(
+        self, name: str, ceiling: int, start: int = 1, adaptive: bool = True
+    ) -> None:
+        """Constructor.
+
+        :param ceiling: Maximum number of concurrent transfers.
+        :param start: Initial number of concurrent transfers.
+        :param adaptive: When False, the limit is never changed.
+        """
+        self.log = log.getChild("ThroughputTuner").getChild(name)
+        self.ceiling = max(1, ceiling)
+        self.limit = max(1, min(start, self.ceiling))
+        self.adaptive = adaptive
+
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._saturated = False
+        self._direction = 1
+        self._last_throughput = 0.0
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+
+    def acquire(self) -> None:
+        """Wait until another transfer is allowed to start."""
+        with self._cond:
+            if self._active >= self.limit:
+                self._saturated = True
+            self._waiting += 1
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._waiting -= 1
+            self._active += 1
+
+    def release(self, bytes_transferred: int) -> None:
+        """Indicate a transfer finished, and how many bytes it transferred."""
+        with self._cond:
+            self._active -= 1
+            self._window_bytes += bytes_transferred
+            self._tune()
+            self._cond.notify_all()
+
+    def _tune(self) -> None:
+        if not self.adaptive:
+            return
+
+        now = time.monotonic()
+        duration = now - self._window_start
+        if duration < self.window:
+            return
+
+        throughput = self._window_bytes / duration
+        saturated = self._saturated or self._waiting > 0
+        self._window_start = now
+        self._window_bytes = 0
+        self._saturated = False
+        if not saturated:
+            return
+
+        last = self._last_throughput
+        self._last_throughput = throughput
+        if throughput < last * (1 - self.tolerance):
+            self._direction = -self._direction
+        elif last and throughput <= last * (1 + self.tolerance):
+            return
+
+        new_limit = max(1, min(self.limit + self._direction, self.ceiling))
+        if new_limit == self.limit:
+            return
+        self.log.debug(
+            "%.1f MB/s, changing concurrency from %d to %d",
+            throughput / 2**20,
+            self.limit,
+            new_limit,
+        )
+        self.limit = new_limit
 
-    # When we don't compress the files, the process is I/O bound,
-    # and trashing the storage by using multiple threads will
-    # only slow things down.
-    transfer_threads = 1  # type: typing.Optional[int]
 
-    def __init__(self):
+class FileCopier(transfer.FileTransferer):
+    """Copies or moves files in source directory order.
+
+    Large files and batches of smaller files are copied in separate lanes,
+    each with its own worker threads. The lanes share the limit on the total
+    number of concurrent transfers.
+    """
+
+    # When we don't compress the files, the process is I/O bound. Depending
+    # on the storage, multiple threads can speed things up (NVMe, network
+    # shares) or only trash the storage (a single spinning disk). Each lane
+    # thus starts with one thread, and a ThroughputTuner adds more threads
+    # as long as that improves throughput. Both lanes together never run
+    # more transfers than this ceiling.
+    transfer_threads = 8  # type: typing.Optional[int]
+    adaptive_threads = True
+
+    supports_patches = True
+
+    def __init__(self, transfer_threads: typing.Optional[int] = None):
+        """Constructor.
+
+        :param transfer_threads: Maximum number of concurrent transfers, for
+            all lanes together. Defaults to the transfer_threads class
+            attribute; when that is None, the number of CPUs is used.
+        """
         super().__init__()
+        if transfer_threads is not None:
+            self.transfer_threads = transfer_threads
         self.files_transferred = 0
         self.files_skipped = 0
+        self._counter_lock = threading.Lock()
         self.already_copied = set()
+        self._transfer_slots = (
+            None
+        )  # type: typing.Optional[threading.BoundedSemaphore]
+        """Limits the number of transfers of all lanes together; set by run()."""
 
         # (is_dir, action)
         self.transfer_funcs = {
@@ -57,22 +201,69 @@ class FileCopier(transfer.FileTransferer):
 
     def run(self) -> None:
 
-        pool = multiprocessing.pool.ThreadPool(processes=self.transfer_threads)
+        ceiling = self.transfer_threads or os.cpu_count() or 1
+        self._transfer_slots = threading.BoundedSemaphore(ceiling)
+        if self.adaptive_threads:
+            small_lane = ThroughputTuner("small", ceiling)
+            large_lane = ThroughputTuner("large", ceiling)
+            small_pool = multiprocessing.pool.ThreadPool(processes=ceiling)
+            large_pool = multiprocessing.pool.ThreadPool(processes=ceiling)
+            pools = [small_pool, large_pool]
+        else:
+            # Without tuning, separate lanes gain nothing; a single lane
+            # simply runs at the ceiling.
+            small_lane = large_lane = ThroughputTuner(
+                "all", ceiling, ceiling, adaptive=False
+            )
+            small_pool = large_pool = multiprocessing.pool.ThreadPool(
+                processes=ceiling
+            )
+            pools = [small_pool]
+
+        batch = []  # type: typing.List[TransferItem]
+        batch_bytes = 0
+
         dst = pathlib.Path()
         for src, pure_dst, act in self.iter_queue():
             try:
                 dst = pathlib.Path(pure_dst)
 
+                patches = self.pop_patches(src, pure_dst)
+
                 if self.has_error or self._abort.is_set():
                     raise AbortTransfer()
 
-                if self._skip_file(src, dst, act):
+                # An existing patched copy may have been patched differently,
+                # so those are never skipped.
+                if patches is None and self._skip_file(src, dst, act):
                     continue
 
                 # We want to do this in this thread, as it's not thread safe itself.
                 dst.parent.mkdir(parents=True, exist_ok=True)
 
-                pool.apply_async(self._thread, (src, dst, act))
+                item = (src, dst, act, patches)
+                if src.is_dir():
+                    # Directories can be of any size, so assume they're large.
+                    large_pool.apply_async(self._transfer, (large_lane, [item], 0))
+                    continue
+                size = src.stat().st_size
+                if size >= LARGE_FILE_SIZE:
+                    large_pool.apply_async(self._transfer, (large_lane, [item], size))
+                    continue
+
+                batch.append(item)
+                batch_bytes += size
+                # Don't hold back a partial batch when there is nothing else
+                # to add to it right now.
+                if (
+                    len(batch) >= SMALL_BATCH_FILES
+                    or batch_bytes >= SMALL_BATCH_BYTES
+                    or self.queue.empty()
+                ):
+                    small_pool.apply_async(
+                        self._transfer, (small_lane, batch, batch_bytes)
+                    )
+                    batch, batch_bytes = [], 0
             except AbortTransfer:
                 # either self._error or self._abort is already set. We just have to
                 # let the system know we didn't handle those files yet.
@@ -93,10 +284,19 @@ class FileCopier(transfer.FileTransferer):
                 self.queue.put((src, dst, act), timeout=1.0)
                 break
 
+        if batch and (self.has_error or self._abort.is_set()):
+            # Let the system know we didn't handle those files yet.
+            for src, dst, act, _ in batch:
+                self.queue.put((src, dst, act), timeout=1.0)
+        elif batch:
+            small_pool.apply_async(self._transfer, (small_lane, batch, batch_bytes))
+
         log.debug("All transfer threads queued")
-        pool.close()
+        for pool in pools:
+            pool.close()
         log.debug("Waiting for transfer threads to finish")
-        pool.join()
+        for pool in pools:
+            pool.join()
         log.debug("All transfer threads finished")
 
         if self.files_transferred:
@@ -104,9 +304,38 @@ class FileCopier(transfer.FileTransferer):
         if self.files_skipped:
             log.info("Skipped %d files", self.files_skipped)
 
-    def _thread(self, src: pathlib.Path, dst: pathlib.Path, act: transfer.Action):
+    def _transfer(
+        self,
+        lane: ThroughputTuner,
+        items: typing.List[TransferItem],
+        num_bytes: int,
+    ):
+        """Transfer a batch of files, once the lane allows it.
+
+        The lane is acquired before the slot shared by all lanes, so that a
+        slot is never held while waiting for the lane.
+        """
+        assert self._transfer_slots is not None
+        lane.acquire()
         try:
-            tfunc = self.transfer_funcs[src.is_dir(), act]
+            with self._transfer_slots:
+                for item in items:
+                    self._thread(*item)
+        finally:
+            lane.release(num_bytes)
+
+    def _thread(
+        self,
+        src: pathlib.Path,
+        dst: pathlib.Path,
+        act: transfer.Action,
+        patches: typing.Optional[patching.PatchList] = None,
+    ):
+        try:
+            if patches is not None:
+                tfunc = functools.partial(self.copy_patched, patches=patches)
+            else:
+                tfunc = self.transfer_funcs[src.is_dir(), act]
 
             if self.has_error or self._abort.is_set():
                 raise AbortTransfer()
@@ -148,22 +377,43 @@ class FileCopier(transfer.FileTransferer):
         if act == transfer.Action.MOVE:
             log.debug("Deleting %s", src)
             src.unlink()
-        self.files_skipped += 1
+        self._count_skipped()
         return True
 
+    def _count_transferred(self) -> None:
+        with self._counter_lock:
+            self.files_transferred += 1
+
+    def _count_skipped(self) -> None:
+        with self._counter_lock:
+            self.files_skipped += 1
+
     def _move(self, srcpath: pathlib.Path, dstpath: pathlib.Path):
         """Low-level file move."""
         shutil.move(str(srcpath), str(dstpath))
 
     def _copy(self, srcpath: pathlib.Path, dstpath: pathlib.Path):
         """Low-level file copy. dstpath needs to be a file and not a directory."""
-        shutil.copyfile(str(srcpath), str(dstpath))
+        strategy = fastcopy.copyfile(srcpath, dstpath)
+        log.debug("Copied %s -> %s using %s", srcpath, dstpath, strategy.value)
+        self.progress_cb.transfer_strategy(srcpath, dstpath, strategy.value)
+
+    def _copy_patched(
+        self,
+        srcpath: pathlib.Path,
+        dstpath: pathlib.Path,
+        patches: patching.PatchList,
+    ):
+        """Low-level file copy, with the patches applied to the copy."""
+        self._copy(srcpath, dstpath)
+        with dstpath.open("r+b") as dstfile:
+            patching.apply_in_place(dstfile, patches)
 
     def move(self, srcpath: pathlib.Path, dstpath: pathlib.Path):
         s_stat = srcpath.stat()
         self._move(srcpath, dstpath)
 
-        self.files_transferred += 1
+        self._count_transferred()
         self.report_transferred(s_stat.st_size)
 
     def copyfile(self, srcpath: pathlib.Path, dstpath: pathlib.Path):
@@ -182,17 +432,36 @@ class FileCopier(transfer.FileTransferer):
             if d_stat.st_size == s_stat.st_size and d_stat.st_mtime >= s_stat.st_mtime:
                 log.info("SKIP %s; already exists", srcpath)
                 self.progress_cb.transfer_file_skipped(srcpath, dstpath)
-                self.files_skipped += 1
+                self._count_skipped()
                 return
 
         log.debug("Copying %s -> %s", srcpath, dstpath)
         self._copy(srcpath, dstpath)
 
         self.already_copied.add((srcpath, dstpath))
-        self.files_transferred += 1
+        self._count_transferred()
 
         self.report_transferred(s_stat.st_size)
 
+    def copy_patched(
+        self,
+        srcpath: pathlib.Path,
+        dstpath: pathlib.Path,
+        patches: patching.PatchList,
+    ):
+        """Copy a file, applying the patches to the copy."""
+
+        if self._abort.is_set() or self.has_error:
+            return
+
+        s_stat = srcpath.stat()  # must exist, or it wouldn't be queued.
+
+        log.debug("Copying %s -> %s with %d patches", srcpath, dstpath, len(patches))
+        self._copy_patched(srcpath, dstpath, patches)
+
+        self._count_transferred()
+        self.report_transferred(s_stat.st_size)
+
     def copytree(
         self,
         src: pathlib.Path,
@@ -274,9 +543,18 @@ class CompressedFileCopier(FileCopier):
     # so we benefit greatly by multi-threading (packing a Spring scene
     # lighting file took 6m30s single-threaded and 2min13 multi-threaded.
     transfer_threads = None  # type: typing.Optional[int]
+    adaptive_threads = False
 
     def _move(self, srcpath: pathlib.Path, dstpath: pathlib.Path):
         compressor.move(srcpath, dstpath)
 
     def _copy(self, srcpath: pathlib.Path, dstpath: pathlib.Path):
         compressor.copy(srcpath, dstpath)
+
+    def _copy_patched(
+        self,
+        srcpath: pathlib.Path,
+        dstpath: pathlib.Path,
+        patches: patching.PatchList,
+    ):
+        compressor.copy_patched(srcpath, dstpath, patches)
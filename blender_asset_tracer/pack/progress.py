@@ -66,6 +66,16 @@ class Callback(blender_asset_tracer.trace.progress.Callback):
     def transfer_file_skipped(self, src: pathlib.Path, dst: pathlib.PurePath) -> None:
         """Called when a file is skipped because it already exists."""
 
+    def transfer_strategy(
+        self, src: pathlib.Path, dst: pathlib.PurePath, strategy: str
+    ) -> None:
+        """Called when a file was copied, with how it was copied.
+
+        :param strategy: The name of the copy strategy, see
+            blender_asset_tracer.fastcopy.Strategy; for example "reflink"
+            when the copy shares its data with the original file.
+        """
+
     def transfer_progress(self, total_bytes: int, transferred_bytes: int) -> None:
         """Called during file transfer, with per-pack info (not per file).
 
@@ -123,12 +133,20 @@ class ThreadSafeCallback(Callback):
     def trace_asset(self, filename: pathlib.Path) -> None:
         self._queue(self.wrapped.trace_asset, filename)
 
+    def rewrite_blendfile(self, orig_filename: pathlib.Path) -> None:
+        self._queue(self.wrapped.rewrite_blendfile, orig_filename)
+
     def transfer_file(self, src: pathlib.Path, dst: pathlib.PurePath) -> None:
         self._queue(self.wrapped.transfer_file, src, dst)
 
     def transfer_file_skipped(self, src: pathlib.Path, dst: pathlib.PurePath) -> None:
         self._queue(self.wrapped.transfer_file_skipped, src, dst)
 
+    def transfer_strategy(
+        self, src: pathlib.Path, dst: pathlib.PurePath, strategy: str
+    ) -> None:
+        self._queue(self.wrapped.transfer_strategy, src, dst, strategy)
+
     def transfer_progress(self, total_bytes: int, transferred_bytes: int) -> None:
         self._queue(self.wrapped.transfer_progress, total_bytes, transferred_bytes)
 
@@ -24,6 +24,7 @@ import pathlib
 import typing
 import urllib.parse
 
+from ..blendfile import patching
 from . import Packer, transfer
 
 log = logging.getLogger(__name__)
@@ -33,10 +34,16 @@ log = logging.getLogger(__name__)
 # we can upload a file to S3 and compute an MD5 of another file simultaneously.
 
 
-def compute_md5(filepath: pathlib.Path) -> str:
+def compute_md5(
+    filepath: pathlib.Path, patches: typing.Optional[patching.PatchList] = None
+) -> str:
     log.debug("Computing MD5sum of %s", filepath)
     hasher = hashlib.md5()
-    with filepath.open("rb") as infile:
+    if patches is None:
+        opened = filepath.open("rb")  # type: typing.BinaryIO
+    else:
+        opened = patching.open_patched(filepath, patches)
+    with opened as infile:
         while True:
             block = infile.read(102400)
             if not block:
@@ -90,6 +97,8 @@ class S3Transferrer(transfer.FileTransferer):
     class AbortUpload(Exception):
         """Raised from the upload callback to abort an upload."""
 
+    supports_patches = True
+
     def __init__(self, botoclient) -> None:
         super().__init__()
         self.client = botoclient
@@ -100,7 +109,8 @@ class S3Transferrer(transfer.FileTransferer):
 
         for src, dst, act in self.iter_queue():
             try:
-                did_upload = self.upload_file(src, dst)
+                patches = self.pop_patches(src, dst)
+                did_upload = self.upload_file(src, dst, patches)
                 files_transferred += did_upload
                 files_skipped += not did_upload
 
@@ -122,17 +132,23 @@ class S3Transferrer(transfer.FileTransferer):
         if files_skipped:
             log.info("Skipped %d files", files_skipped)
 
-    def upload_file(self, src: pathlib.Path, dst: pathlib.PurePath) -> bool:
+    def upload_file(
+        self,
+        src: pathlib.Path,
+        dst: pathlib.PurePath,
+        patches: typing.Optional[patching.PatchList] = None,
+    ) -> bool:
         """Upload a file to an S3 bucket.
 
         The first part of 'dst' is used as the bucket name, the remained as the
         path inside the bucket.
 
+        :param patches: patches to apply to the uploaded data, if any.
         :returns: True if the file was uploaded, False if it was skipped.
         """
         bucket = dst.parts[0]
         dst_path = pathlib.Path(*dst.parts[1:])
-        md5 = compute_md5(src)
+        md5 = compute_md5(src, patches)
         key = str(dst_path)
 
         existing_md5, existing_size = self.get_metadata(bucket, key)
@@ -146,13 +162,23 @@ class S3Transferrer(transfer.FileTransferer):
 
         log.info("Uploading %s", src)
         try:
-            self.client.upload_file(
-                str(src),
-                Bucket=bucket,
-                Key=key,
-                Callback=self.report_transferred,
-                ExtraArgs={"Metadata": {"md5": md5}},
-            )
+            if patches is None:
+                self.client.upload_file(
+                    str(src),
+                    Bucket=bucket,
+                    Key=key,
+                    Callback=self.report_transferred,
+                    ExtraArgs={"Metadata": {"md5": md5}},
+                )
+            else:
+                with patching.open_patched(src, patches) as infile:
+                    self.client.upload_fileobj(
+                        infile,
+                        Bucket=bucket,
+                        Key=key,
+                        Callback=self.report_transferred,
+                        ExtraArgs={"Metadata": {"md5": md5}},
+                    )
         except self.AbortUpload:
             return False
         return True
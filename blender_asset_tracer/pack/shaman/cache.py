@@ -28,6 +28,7 @@ import typing
 from collections import deque
 from pathlib import Path
 
+from blender_asset_tracer.blendfile import patching
 from . import time_tracker
 
 CACHE_ROOT = Path().home() / ".cache/shaman-client/shasums"
@@ -72,14 +73,23 @@ def find_files(root: Path) -> typing.Iterable[Path]:
             yield path
 
 
-def compute_checksum(filepath: Path) -> str:
-    """Compute the SHA256 checksum for the given file."""
+def compute_checksum(
+    filepath: Path, patches: typing.Optional[patching.PatchList] = None
+) -> str:
+    """Compute the SHA256 checksum for the given file.
+
+    :param patches: patches to apply to the file data before hashing it.
+    """
     blocksize = 32 * 1024
 
     log.debug("Computing checksum of %s", filepath)
     with time_tracker.track_time(TimeInfo, "computing_checksums"):
         hasher = hashlib.sha256()
-        with filepath.open("rb") as infile:
+        if patches is None:
+            opened = filepath.open("rb")  # type: typing.BinaryIO
+        else:
+            opened = patching.open_patched(filepath, patches)
+        with opened as infile:
             while True:
                 block = infile.read(blocksize)
                 if not block:
@@ -27,6 +27,7 @@ import requests
 
 import blender_asset_tracer.pack.transfer as bat_transfer
 from blender_asset_tracer import bpathlib
+from blender_asset_tracer.blendfile import patching
 
 MAX_DEFERRED_PATHS = 8
 MAX_FAILED_PATHS = 8
@@ -36,15 +37,30 @@ response_already_uploading = "already-uploading"
 
 
 class FileInfo:
-    def __init__(self, checksum: str, filesize: int, abspath: pathlib.Path):
+    def __init__(
+        self,
+        checksum: str,
+        filesize: int,
+        abspath: pathlib.Path,
+        patches: typing.Optional[patching.PatchList] = None,
+    ):
         self.checksum = checksum
         self.filesize = filesize
         self.abspath = abspath
+        self.patches = patches
+
+    def open(self) -> typing.BinaryIO:
+        """Open the file for reading, with its patches applied."""
+        if self.patches is None:
+            return self.abspath.open("rb")
+        return patching.open_patched(self.abspath, self.patches)
 
 
 class ShamanTransferrer(bat_transfer.FileTransferer):
     """Sends files to a Shaman server."""
 
+    supports_patches = True
+
     class AbortUpload(Exception):
         """Raised from the upload callback to abort an upload."""
 
@@ -169,7 +185,12 @@ class ShamanTransferrer(bat_transfer.FileTransferer):
 
         for src, dst, act in self.iter_queue():
             try:
-                checksum = cache.compute_cached_checksum(src)
+                patches = self.pop_patches(src, dst)
+                if patches is None:
+                    checksum = cache.compute_cached_checksum(src)
+                else:
+                    # The cache is keyed by path, so it doesn't know the patches.
+                    checksum = cache.compute_checksum(src, patches)
                 filesize = src.stat().st_size
                 # relpath = dst.relative_to(self.project_root)
                 relpath = bpathlib.strip_root(dst).as_posix()
@@ -178,6 +199,7 @@ class ShamanTransferrer(bat_transfer.FileTransferer):
                     checksum=checksum,
                     filesize=filesize,
                     abspath=src,
+                    patches=patches,
                 )
                 line = "%s %s %s" % (checksum, filesize, relpath)
                 definition_lines.append(line.encode("utf8"))
@@ -308,7 +330,7 @@ class ShamanTransferrer(bat_transfer.FileTransferer):
 
             url = "files/%s/%d" % (fileinfo.checksum, fileinfo.filesize)
             try:
-                with fileinfo.abspath.open("rb") as infile:
+                with fileinfo.open() as infile:
                     resp = self.client.post(url, data=infile, headers=headers)
 
             except requests.ConnectionError as ex:
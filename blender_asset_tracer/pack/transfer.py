@@ -27,6 +27,7 @@ import time
 import typing
 from typing import Optional
 
+from ..blendfile import patching
 from . import progress
 
 log = logging.getLogger(__name__)
@@ -55,6 +56,10 @@ class FileTransferer(threading.Thread, metaclass=abc.ABCMeta):
     transfer.
     """
 
+    # Set to True in subclasses that handle patched copies, see
+    # queue_patched_copy().
+    supports_patches = False
+
     def __init__(self) -> None:
         super().__init__()
         self.log = log.getChild("FileTransferer")
@@ -84,6 +89,11 @@ class FileTransferer(threading.Thread, metaclass=abc.ABCMeta):
         self.total_queued_bytes = 0
         self.total_transferred_bytes = 0
 
+        # Patches of queued copies, keyed by (src, str(dst)).
+        self._patches = (
+            {}
+        )  # type: typing.Dict[typing.Tuple[pathlib.Path, str], patching.PatchList]
+
     @abc.abstractmethod
     def run(self):
         """Perform actual file transfer in a thread."""
@@ -100,8 +110,10 @@ class FileTransferer(threading.Thread, metaclass=abc.ABCMeta):
         ), "Queueing not allowed after abort_and_join() was called"
         if self.__error.is_set():
             return
-        self.queue.put((src, dst, Action.COPY))
+        # Stat before queueing, as a running transfer thread may move the file
+        # away before put() returns.
         self.total_queued_bytes += src.stat().st_size
+        self.queue.put((src, dst, Action.COPY))
 
     def queue_move(self, src: pathlib.Path, dst: pathlib.PurePath):
         """Queue a move action from 'src' to 'dst'."""
@@ -115,8 +127,31 @@ class FileTransferer(threading.Thread, metaclass=abc.ABCMeta):
         ), "Queueing not allowed after abort_and_join() was called"
         if self.__error.is_set():
             return
-        self.queue.put((src, dst, Action.MOVE))
+        # Stat before queueing, as a running transfer thread may move the file
+        # away before put() returns.
         self.total_queued_bytes += src.stat().st_size
+        self.queue.put((src, dst, Action.MOVE))
+
+    def queue_patched_copy(
+        self, src: pathlib.Path, dst: pathlib.PurePath, patches: patching.PatchList
+    ):
+        """Queue a copy action from 'src' to 'dst', patching the copy.
+
+        The patches are (file offset, new bytes) tuples, which are applied to
+        the data while it is transferred. The source file is not modified.
+        """
+        if not self.supports_patches:
+            raise TypeError(
+                "%s does not support patched copies" % self.__class__.__qualname__
+            )
+        self._patches[src, str(dst)] = patches
+        self.queue_copy(src, dst)
+
+    def pop_patches(
+        self, src: pathlib.Path, dst: pathlib.PurePath
+    ) -> typing.Optional[patching.PatchList]:
+        """Return the patches of a queued copy, or None if there are none."""
+        return self._patches.pop((src, str(dst)), None)
 
     def report_transferred(self, bytes_transferred: int):
         """Report transfer of `block_size` bytes."""
@@ -24,7 +24,9 @@ when you want to use the ZIP cross-platform and you have non-ASCII names.
 """
 import logging
 import pathlib
+import shutil
 
+from ..blendfile import patching
 from . import Packer, transfer
 
 log = logging.getLogger(__name__)
@@ -49,6 +51,8 @@ class ZipTransferrer(transfer.FileTransferer):
     file names as encoded in CP437, also known as DOS Latin.
     """
 
+    supports_patches = True
+
     def __init__(self, zippath: pathlib.Path) -> None:
         super().__init__()
         self.zippath = zippath
@@ -61,6 +65,7 @@ class ZipTransferrer(transfer.FileTransferer):
         with zipfile.ZipFile(str(zippath), "w") as outzip:
             for src, dst, act in self.iter_queue():
                 assert src.is_absolute(), "expecting only absolute paths, not %r" % src
+                patches = self.pop_patches(src, dst)
 
                 dst = pathlib.Path(dst).absolute()
                 try:
@@ -73,9 +78,14 @@ class ZipTransferrer(transfer.FileTransferer):
                     else:
                         compression = zipfile.ZIP_DEFLATED
                         log.debug("ZIP %s -> %s", src, relpath)
-                    outzip.write(
-                        str(src), arcname=str(relpath), compress_type=compression
-                    )
+                    if patches is None:
+                        outzip.write(
+                            str(src), arcname=str(relpath), compress_type=compression
+                        )
+                    else:
+                        self._write_patched(
+                            outzip, src, str(relpath), compression, patches
+                        )
 
                     if act == transfer.Action.MOVE:
                         self.delete_file(src)
@@ -89,3 +99,20 @@ class ZipTransferrer(transfer.FileTransferer):
                     # be reported there.
                     self.queue.put((src, dst, act))
                     return
+
+    @staticmethod
+    def _write_patched(
+        outzip,
+        src: pathlib.Path,
+        arcname: str,
+        compression: int,
+        patches: patching.PatchList,
+    ) -> None:
+        """Write the file to the ZIP, applying the patches while streaming it."""
+        import zipfile
+
+        zinfo = zipfile.ZipInfo.from_file(str(src), arcname=arcname)
+        zinfo.compress_type = compression
+        with patching.open_patched(src, patches) as infile:
+            with outzip.open(zinfo, "w") as outfile:
+                shutil.copyfileobj(infile, outfile)
@@ -22,7 +22,15 @@ import pathlib
 import typing
 
 from blender_asset_tracer import blendfile
-from . import result, blocks2assets, file2blocks, progress
+from . import (
+    result,
+    blocks2assets,
+    file2blocks,
+    index,
+    library_graph,
+    parallel,
+    progress,
+)
 
 log = logging.getLogger(__name__)
 
@@ -41,30 +49,99 @@ codes_to_skip = {
 
 
 def deps(
-    bfilepath: pathlib.Path, progress_cb: typing.Optional[progress.Callback] = None
+    bfilepath: pathlib.Path,
+    progress_cb: typing.Optional[progress.Callback] = None,
+    prefetch_libraries: int = 0,
+    dep_index: typing.Optional[index.DependencyIndex] = None,
 ) -> typing.Iterator[result.BlockUsage]:
     """Open the blend file and report its dependencies.
 
     :param bfilepath: File to open.
     :param progress_cb: Progress callback object.
+    :param prefetch_libraries: Number of linked libraries to open in
+        background threads while expanding the current one. The reported
+        dependencies and their order are the same as without prefetching.
+    :param dep_index: Persistent index of trace results. When given, blend
+        files that have not changed since they were indexed are not traced
+        again. Their block headers are still read, to reconstruct the
+        BlockUsage objects, but their DNA is only decoded when the fields of
+        those objects are accessed. Files are then traced one at a time, and
+        libraries breadth-first (see the parallel module), so the same
+        dependencies are reported, but in a different order than without
+        an index. Cannot be combined with prefetch_libraries.
     """
 
-    bi = file2blocks.BlockIterator()
+    if dep_index is not None:
+        if prefetch_libraries:
+            raise ValueError("prefetch_libraries cannot be used with dep_index")
+        if progress_cb is None:
+            progress_cb = progress.Callback()
+        yield from _unique_usages(
+            parallel.trace(bfilepath, progress_cb, index=dep_index)
+        )
+        return
+
+    bi = file2blocks.BlockIterator(prefetch_libraries=prefetch_libraries)
     if progress_cb:
         bi.progress_cb = progress_cb
     bfile = bi.open_blendfile(bfilepath)
 
+    try:
+        yield from _unique_usages(
+            block_usage
+            for block in asset_holding_blocks(bi.iter_blocks(bfile))
+            for block_usage in blocks2assets.iter_assets(block)
+        )
+    finally:
+        bi.close()
+
+
+def deps_parallel(
+    bfilepath: pathlib.Path,
+    progress_cb: typing.Optional[progress.Callback] = None,
+    max_workers: typing.Optional[int] = None,
+    dep_index: typing.Optional[index.DependencyIndex] = None,
+) -> typing.Iterator[result.BlockUsage]:
+    """Same as deps(), but traces each blend file in a separate worker process.
+
+    The blend file and each of its libraries are traced in parallel, which
+    can use multiple CPU cores for projects with many libraries. The same
+    dependencies are reported as by deps(), but possibly in a different order.
+
+    :param bfilepath: File to open.
+    :param progress_cb: Progress callback object.
+    :param max_workers: Number of worker processes; defaults to the number
+        of CPUs.
+    :param dep_index: Persistent index of trace results, see deps().
+    """
+
+    if progress_cb is None:
+        progress_cb = progress.Callback()
+
+    executor = parallel.worker_pool(max_workers)
+    try:
+        yield from _unique_usages(
+            parallel.trace(bfilepath, progress_cb, executor, dep_index)
+        )
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _unique_usages(
+    block_usages: typing.Iterable[result.BlockUsage],
+) -> typing.Iterator[result.BlockUsage]:
+    """Generator, yield each block usage only once."""
+
     # Remember which block usages we've reported already, without keeping the
     # blocks themselves in memory.
     seen_hashes = set()  # type: typing.Set[int]
 
-    for block in asset_holding_blocks(bi.iter_blocks(bfile)):
-        for block_usage in blocks2assets.iter_assets(block):
-            usage_hash = hash(block_usage)
-            if usage_hash in seen_hashes:
-                continue
-            seen_hashes.add(usage_hash)
-            yield block_usage
+    for block_usage in block_usages:
+        usage_hash = hash(block_usage)
+        if usage_hash in seen_hashes:
+            continue
+        seen_hashes.add(usage_hash)
+        yield block_usage
 
 
 def asset_holding_blocks(
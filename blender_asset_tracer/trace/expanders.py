@@ -110,20 +110,31 @@ def _expand_generic_nodetree(block: blendfile.BlendFileBlock):
         cdefs.SOCK_MATERIAL,  #  bNodeSocketValueMaterial
     }
 
-    for node in iterators.listbase(nodes):
-        if node[b"type"] == cdefs.CMP_NODE_R_LAYERS:
+    bfile = block.bfile
+    node_fields = (b"type", b"id", (b"inputs", b"first"))
+    for node, (node_type, id_ptr, inputs_ptr) in iterators.listbase_fields(
+        nodes, node_fields
+    ):
+        if node_type == cdefs.CMP_NODE_R_LAYERS:
             continue
 
         # The 'id' property points to whatever is used by the node
         # (like the image in an image texture node).
-        yield node.get_pointer(b"id")
+        if id_ptr:
+            yield bfile.dereference_pointer(id_ptr)
+
+        if not inputs_ptr:
+            continue
 
         # Default values of inputs can also point to ID datablocks.
-        inputs = node.get_pointer((b"inputs", b"first"))
-        for input in iterators.listbase(inputs):
-            if input[b"type"] not in socket_types_with_value_pointer:
+        inputs = bfile.dereference_pointer(inputs_ptr)
+        input_fields = (b"type", b"default_value")
+        for input, (socket_type, value_ptr) in iterators.listbase_fields(
+            inputs, input_fields
+        ):
+            if socket_type not in socket_types_with_value_pointer or not value_ptr:
                 continue
-            value_container = input.get_pointer(b"default_value")
+            value_container = bfile.dereference_pointer(value_ptr)
             if not value_container:
                 continue
             value = value_container.get_pointer(b"value")
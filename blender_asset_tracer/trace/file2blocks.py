@@ -25,9 +25,10 @@ initial blend file, and all *actually linked-to* data blocks in linked
 blend files.
 """
 import collections
+import concurrent.futures
+import heapq
 import logging
 import pathlib
-import queue
 import typing
 
 from blender_asset_tracer import blendfile, bpathlib
@@ -36,17 +37,57 @@ from . import expanders, progress
 _funcs_for_code = {}  # type: typing.Dict[bytes, typing.Callable]
 log = logging.getLogger(__name__)
 
+# Library path, the ID blocks to expand from it, and the future that opens it.
+_PrefetchedLib = typing.Tuple[
+    pathlib.Path, typing.Set[blendfile.BlendFileBlock], concurrent.futures.Future
+]
 
-# noinspection PyProtectedMember
-class BlockQueue(queue.PriorityQueue):
-    """PriorityQueue that sorts by filepath and file offset"""
 
-    def _put(self, item: blendfile.BlendFileBlock):
-        super()._put((item.bfile.filepath, item.file_offset, item))
+class BlockQueue:
+    """Queue of blocks to visit, sorted by file and file offset.
 
-    def _get(self) -> blendfile.BlendFileBlock:
-        _, _, item = super()._get()
-        return item
+    Each block is only queued once; putting a block that was queued before,
+    even when it has been taken out of the queue again, does nothing.
+
+    Unlike queue.PriorityQueue this does not do any locking, as the tracer
+    only uses it from a single thread.
+    """
+
+    def __init__(self) -> None:
+        # Heap of (file ID, file offset, block) tuples.
+        self._heap = (
+            []
+        )  # type: typing.List[typing.Tuple[int, int, blendfile.BlendFileBlock]]
+
+        # Mapping from blend file path to the integer ID used in the heap.
+        self._file_ids = {}  # type: typing.Dict[pathlib.Path, int]
+
+        # Set of (file ID, block address) of blocks that have been queued.
+        self._seen = set()  # type: typing.Set[typing.Tuple[int, int]]
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def _file_id(self, bfile: blendfile.BlendFile) -> int:
+        try:
+            return self._file_ids[bfile.filepath]
+        except KeyError:
+            file_id = self._file_ids[bfile.filepath] = len(self._file_ids)
+            return file_id
+
+    def put(self, block: blendfile.BlendFileBlock) -> None:
+        file_id = self._file_id(block.bfile)
+        key = (file_id, block.addr_old)
+        if key in self._seen:
+            return
+        self._seen.add(key)
+        heapq.heappush(self._heap, (file_id, block.file_offset, block))
+
+    def get(self) -> blendfile.BlendFileBlock:
+        return heapq.heappop(self._heap)[2]
+
+    def empty(self) -> bool:
+        return not self._heap
 
 
 class BlockIterator:
@@ -56,15 +97,37 @@ class BlockIterator:
     without having to pass those variables to each recursive call.
     """
 
-    def __init__(self) -> None:
+    def __init__(self, prefetch_libraries: int = 0) -> None:
+        """
+        :param prefetch_libraries: number of linked libraries to open and
+            parse in background threads, while the blocks of the previous
+            library are being expanded. Zero disables prefetching.
+        """
         # Set of (blend file Path, block address) of already-reported blocks.
+        # Duplicates are already skipped by the queue; this is kept for
+        # callers that want to know which blocks were reported.
         self.blocks_yielded = set()  # type: typing.Set[typing.Tuple[pathlib.Path, int]]
 
-        # Queue of blocks to visit
+        # Queue of blocks to visit. It also keeps track of the blocks that
+        # were queued before, so that each block is reported only once.
         self.to_visit = BlockQueue()
 
         self.progress_cb = progress.Callback()
 
+        self.prefetch_libraries = prefetch_libraries
+        self._prefetcher = None  # type: typing.Optional[concurrent.futures.Executor]
+
+    def close(self) -> None:
+        """Stop prefetching libraries.
+
+        Libraries that are still waiting to be prefetched are skipped, but
+        the ones that are being opened right now will be waited for.
+        """
+        if self._prefetcher is None:
+            return
+        self._prefetcher.shutdown(wait=True, cancel_futures=True)
+        self._prefetcher = None
+
     def open_blendfile(self, bfilepath: pathlib.Path) -> blendfile.BlendFile:
         """Open a blend file, sending notification about this to the progress callback."""
 
@@ -88,6 +151,27 @@ class BlockIterator:
         blocks_per_lib = yield from self._visit_blocks(bfile, limit_to)
         yield from self._visit_linked_blocks(blocks_per_lib)
 
+    def iter_blocks_in_file(
+        self,
+        bfile: blendfile.BlendFile,
+        id_names: typing.Optional[typing.Set[bytes]] = None,
+    ) -> typing.Generator[blendfile.BlendFileBlock, None, typing.Dict]:
+        """Expand blocks of this file, without visiting linked libraries.
+
+        :param id_names: ID names (like b'OBCube') of the blocks to expand. If
+            not given, all blocks of the file are expanded.
+        :returns: (as generator return value) mapping from library path
+            (absolute BlendPath) to the set of ID blocks to expand from it.
+        """
+        log.info("inspecting: %s", bfile.filepath)
+        if id_names:
+            self._queue_blocks_by_name(bfile, id_names)
+        else:
+            self._queue_all_blocks(bfile)
+
+        blocks_per_lib = yield from self._visit_blocks(bfile, id_names)
+        return blocks_per_lib
+
     def _visit_blocks(self, bfile, limit_to):
         bpath = bpathlib.make_absolute(bfile.filepath)
         root_dir = bpathlib.BlendPath(bpath.parent)
@@ -98,8 +182,6 @@ class BlockIterator:
         while not self.to_visit.empty():
             block = self.to_visit.get()
             assert isinstance(block, blendfile.BlendFileBlock)
-            if (bpath, block.addr_old) in self.blocks_yielded:
-                continue
 
             if block.code == b"ID":
                 # ID blocks represent linked-in assets. Those are the ones that
@@ -125,6 +207,10 @@ class BlockIterator:
     def _visit_linked_blocks(self, blocks_per_lib):
         # We've gone through all the blocks in this file, now open the libraries
         # and iterate over the blocks referred there.
+        if self.prefetch_libraries > 0:
+            yield from self._visit_linked_blocks_prefetched(blocks_per_lib)
+            return
+
         for lib_bpath, idblocks in blocks_per_lib.items():
             lib_path = bpathlib.make_absolute(lib_bpath.to_path())
 
@@ -136,14 +222,61 @@ class BlockIterator:
             libfile = self.open_blendfile(lib_path)
             yield from self.iter_blocks(libfile, idblocks)
 
+    def _visit_linked_blocks_prefetched(self, blocks_per_lib):
+        """Same as _visit_linked_blocks(), but opens libraries in the background.
+
+        The libraries are still expanded one at a time and in the same order,
+        so the order of the yielded blocks does not change; only the opening
+        and parsing of the next libraries overlaps with the expansion.
+        """
+        if self._prefetcher is None:
+            self._prefetcher = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.prefetch_libraries,
+                thread_name_prefix="bat-prefetch",
+            )
+
+        pending = collections.deque()  # type: typing.Deque[_PrefetchedLib]
+
+        for lib_bpath, idblocks in blocks_per_lib.items():
+            lib_path = bpathlib.make_absolute(lib_bpath.to_path())
+
+            if not lib_path.exists():
+                log.warning("Library %s does not exist", lib_path)
+                continue
+
+            future = self._prefetcher.submit(blendfile.open_cached, lib_path)
+            pending.append((lib_path, idblocks, future))
+            if len(pending) > self.prefetch_libraries:
+                yield from self._expand_prefetched(*pending.popleft())
+
+        while pending:
+            yield from self._expand_prefetched(*pending.popleft())
+
+    def _expand_prefetched(
+        self,
+        lib_path: pathlib.Path,
+        idblocks: typing.Set[blendfile.BlendFileBlock],
+        future: concurrent.futures.Future,
+    ) -> typing.Iterator[blendfile.BlendFileBlock]:
+        # Wait for the prefetch to finish, and re-raise any exception it raised.
+        future.result()
+
+        log.debug("Expanding %d blocks in %s", len(idblocks), lib_path)
+        # The file is cached now, so this just takes care of the logging and
+        # progress reporting.
+        libfile = self.open_blendfile(lib_path)
+        yield from self.iter_blocks(libfile, idblocks)
+
     def _queue_all_blocks(self, bfile: blendfile.BlendFile):
         log.debug("Queueing all blocks from file %s", bfile.filepath)
-        for block in bfile.blocks:
+        for code in bfile.code_index:
             # Don't bother visiting DATA blocks, as we won't know what
-            # to do with them anyway.
-            if block.code == b"DATA":
+            # to do with them anyway. The code is checked before the blocks
+            # are looked up, so their block objects are never created.
+            if code == b"DATA":
                 continue
-            self.to_visit.put(block)
+            for block in bfile.code_index[code]:
+                self.to_visit.put(block)
 
     def _queue_named_blocks(
         self, bfile: blendfile.BlendFile, limit_to: typing.Set[blendfile.BlendFileBlock]
@@ -156,9 +289,18 @@ class BlockIterator:
             selected by name.
         """
 
+        names_to_find = set()
         for to_find in limit_to:
             assert to_find.code == b"ID"
-            name_to_find = to_find[b"name"]
+            names_to_find.add(to_find[b"name"])
+        self._queue_blocks_by_name(bfile, names_to_find)
+
+    def _queue_blocks_by_name(
+        self, bfile: blendfile.BlendFile, names_to_find: typing.Iterable[bytes]
+    ):
+        """Queue the blocks with the given ID names."""
+
+        for name_to_find in names_to_find:
             code = name_to_find[:2]
             log.debug("Finding block %r with code %r", name_to_find, code)
             same_code = bfile.find_blocks_from_code(code)
@@ -178,4 +320,7 @@ def iter_blocks(
 ) -> typing.Iterator[blendfile.BlendFileBlock]:
     """Generator, yield all blocks in this file + required blocks in libs."""
     bi = BlockIterator()
-    yield from bi.iter_blocks(bfile)
+    try:
+        yield from bi.iter_blocks(bfile)
+    finally:
+        bi.close()
@@ -0,0 +1,259 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+# ***** END GPL LICENCE BLOCK *****
+"""Persistent index of dependency tracing results.
+
+The index stores the trace results of each blend file in an SQLite database,
+keyed by the file's path and the ID names that were expanded from it. Each
+entry also records the size and modification time of the file, and optionally
+a hash of its contents. When the file is traced again and has not changed, the
+stored results are used instead of parsing the file again.
+
+Only the tracing itself is skipped; the blend files are still opened to
+reconstruct the BlockUsage objects. That only reads their block headers, their
+DNA is decoded when the fields of a BlockUsage are accessed.
+
+The results are stored as JSON of plain strings, numbers, and lists, so that
+opening an index file never runs any code from it.
+"""
+
+import hashlib
+import json
+import logging
+import pathlib
+import sqlite3
+import typing
+
+from . import parallel
+
+log = logging.getLogger(__name__)
+
+# Increase this whenever the stored results change in an incompatible way.
+SCHEMA_VERSION = 2
+
+
+class FileStamp(typing.NamedTuple):
+    """Properties of a file used to detect changes."""
+
+    size: int
+    mtime_ns: int
+    content_hash: typing.Optional[str]
+
+
+class DependencyIndex:
+    """SQLite database of per-file trace results.
+
+    Use as context manager, or call close() when done.
+    """
+
+    def __init__(self, db_path: pathlib.Path, use_content_hash: bool = False) -> None:
+        """
+        :param db_path: the SQLite database file, created if it does not exist.
+        :param use_content_hash: also compare the SHA-256 hash of the blend
+            files, and not just their size and modification time. This is
+            more reliable, but requires reading each file completely.
+        """
+        self.db_path = db_path
+        self.use_content_hash = use_content_hash
+
+        self._db = sqlite3.connect(str(db_path))
+        self._create_tables()
+
+    def __enter__(self) -> "DependencyIndex":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._db.close()
+
+    def _create_tables(self) -> None:
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS file_traces ("
+                " path TEXT NOT NULL,"
+                " id_names BLOB NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " mtime_ns INTEGER NOT NULL,"
+                " content_hash TEXT,"
+                " schema_version INTEGER NOT NULL,"
+                " file_trace TEXT NOT NULL,"
+                " PRIMARY KEY (path, id_names))"
+            )
+
+    def stamp(self, bfilepath: pathlib.Path) -> FileStamp:
+        """Determine the current stamp of the file."""
+        stat = bfilepath.stat()
+        content_hash = None
+        if self.use_content_hash:
+            content_hash = _sha256(bfilepath)
+        return FileStamp(stat.st_size, stat.st_mtime_ns, content_hash)
+
+    def lookup(
+        self,
+        bfilepath: pathlib.Path,
+        id_names: typing.Optional[typing.FrozenSet[bytes]],
+        stamp: FileStamp,
+    ) -> typing.Optional[parallel.FileTrace]:
+        """Return the stored trace result, or None if missing or outdated.
+
+        :param stamp: the current stamp of the file, see stamp().
+        """
+        row = self._db.execute(
+            "SELECT size, mtime_ns, content_hash, schema_version, file_trace"
+            " FROM file_traces WHERE path=? AND id_names=?",
+            (str(bfilepath), _names_key(id_names)),
+        ).fetchone()
+        if row is None:
+            return None
+
+        size, mtime_ns, content_hash, schema_version, data = row
+        if schema_version != SCHEMA_VERSION:
+            return None
+        if (size, mtime_ns) != (stamp.size, stamp.mtime_ns):
+            log.debug("%s changed since it was indexed", bfilepath)
+            return None
+        if self.use_content_hash and content_hash != stamp.content_hash:
+            log.debug("%s has different contents than indexed", bfilepath)
+            return None
+
+        try:
+            file_trace = _decode_trace(data)
+        except (ValueError, TypeError, KeyError, IndexError) as ex:
+            log.warning("Ignoring unreadable index entry for %s: %s", bfilepath, ex)
+            return None
+        return file_trace
+
+    def store(
+        self,
+        bfilepath: pathlib.Path,
+        id_names: typing.Optional[typing.FrozenSet[bytes]],
+        stamp: FileStamp,
+        file_trace: parallel.FileTrace,
+    ) -> None:
+        """Store the trace result of the file.
+
+        :param stamp: the stamp of the file before it was traced, so that
+            changes made during tracing are detected the next time.
+        """
+        data = _encode_trace(file_trace)
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO file_traces"
+                " (path, id_names, size, mtime_ns, content_hash,"
+                " schema_version, file_trace)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    str(bfilepath),
+                    _names_key(id_names),
+                    stamp.size,
+                    stamp.mtime_ns,
+                    stamp.content_hash,
+                    SCHEMA_VERSION,
+                    data,
+                ),
+            )
+
+
+# Bytes, like asset paths and ID names, are stored as str decoded from Latin-1,
+# so that any byte value round-trips through JSON unchanged.
+
+
+def _encode_trace(file_trace: parallel.FileTrace) -> str:
+    def field_ref(ref: typing.Optional[parallel.FieldRef]) -> typing.Any:
+        if ref is None:
+            return None
+        return [name.decode("latin-1") for name in ref]
+
+    usages = [
+        [
+            str(usage.bfilepath),
+            usage.block_addr,
+            usage.block_name.decode("latin-1"),
+            usage.asset_path.decode("latin-1"),
+            usage.is_sequence,
+            field_ref(usage.path_full_field),
+            field_ref(usage.path_dir_field),
+            field_ref(usage.path_base_field),
+        ]
+        for usage in file_trace.usages
+    ]
+    libraries = [
+        [str(lib_path), sorted(name.decode("latin-1") for name in id_names)]
+        for lib_path, id_names in file_trace.libraries.items()
+    ]
+    return json.dumps({"usages": usages, "libraries": libraries})
+
+
+def _decode_trace(data: str) -> parallel.FileTrace:
+    def field_ref(ref: typing.Any) -> typing.Optional[parallel.FieldRef]:
+        if ref is None:
+            return None
+        struct_name, field_name = ref
+        return struct_name.encode("latin-1"), field_name.encode("latin-1")
+
+    stored = json.loads(data)
+    usages = [
+        parallel.UsageSummary(
+            bfilepath=pathlib.Path(bfilepath),
+            block_addr=int(block_addr),
+            block_name=block_name.encode("latin-1"),
+            asset_path=asset_path.encode("latin-1"),
+            is_sequence=bool(is_sequence),
+            path_full_field=field_ref(path_full_field),
+            path_dir_field=field_ref(path_dir_field),
+            path_base_field=field_ref(path_base_field),
+        )
+        for (
+            bfilepath,
+            block_addr,
+            block_name,
+            asset_path,
+            is_sequence,
+            path_full_field,
+            path_dir_field,
+            path_base_field,
+        ) in stored["usages"]
+    ]
+    libraries = {
+        pathlib.Path(lib_path): frozenset(name.encode("latin-1") for name in names)
+        for lib_path, names in stored["libraries"]
+    }
+    return parallel.FileTrace(usages, libraries)
+
+
+def _names_key(id_names: typing.Optional[typing.FrozenSet[bytes]]) -> bytes:
+    """Return the ID names as bytes, for use in the primary key.
+
+    ID names are zero-terminated in the blend file, so they never contain
+    zero bytes themselves.
+    """
+    if not id_names:
+        return b""
+    return b"\0".join(sorted(id_names))
+
+
+def _sha256(filepath: pathlib.Path) -> str:
+    summer = hashlib.sha256()
+    with filepath.open("rb") as infile:
+        while True:
+            block = infile.read(1024 * 1024)
+            if not block:
+                break
+            summer.update(block)
+    return summer.hexdigest()
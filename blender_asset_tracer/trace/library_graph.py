@@ -0,0 +1,177 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+# ***** END GPL LICENCE BLOCK *****
+"""Library-link graph of all blend files in a project.
+
+Only the LI blocks of each blend file are read, so building the graph is much
+faster than tracing the dependencies of every file. The graph tells which
+blend files link which libraries, and in reverse, which blend files are
+affected when a library changes.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import os
+import pathlib
+import typing
+
+from blender_asset_tracer import blendfile, bpathlib
+from . import parallel
+
+log = logging.getLogger(__name__)
+
+PathSet = typing.Set[pathlib.Path]
+
+
+class LibraryGraph:
+    """Which blend files link which libraries.
+
+    Blender normally does not allow libraries to (indirectly) link themselves,
+    so the graph is a DAG. Broken projects can contain such cycles though,
+    which the methods of this class handle gracefully.
+    """
+
+    def __init__(self) -> None:
+        self.libraries = collections.defaultdict(
+            set
+        )  # type: typing.DefaultDict[pathlib.Path, PathSet]
+        """Mapping from blend file to the libraries it links directly."""
+
+        self.users = collections.defaultdict(
+            set
+        )  # type: typing.DefaultDict[pathlib.Path, PathSet]
+        """Mapping from library to the blend files linking it directly."""
+
+        self.blendfiles = set()  # type: PathSet
+        """The blend files that were scanned."""
+
+        self.errors = {}  # type: typing.Dict[pathlib.Path, str]
+        """Mapping from blend file to the reason it could not be scanned."""
+
+    def add_file(
+        self, bfilepath: pathlib.Path, libraries: typing.Iterable[pathlib.Path]
+    ) -> None:
+        """Add a scanned blend file and the libraries it links."""
+        self.blendfiles.add(bfilepath)
+        for lib_path in libraries:
+            self.libraries[bfilepath].add(lib_path)
+            self.users[lib_path].add(bfilepath)
+
+    def missing_libraries(self) -> PathSet:
+        """Return the linked libraries that do not exist."""
+        return {lib_path for lib_path in self.users if not lib_path.exists()}
+
+    def all_libraries(self, bfilepath: pathlib.Path) -> PathSet:
+        """Return the libraries the file links, directly or indirectly."""
+        return _reachable(self.libraries, bfilepath)
+
+    def all_users(self, lib_path: pathlib.Path) -> PathSet:
+        """Return the blend files that link the library, directly or indirectly.
+
+        These are the files affected when the library changes.
+        """
+        return _reachable(self.users, lib_path)
+
+
+def _reachable(
+    edges: typing.Mapping[pathlib.Path, PathSet], start: pathlib.Path
+) -> PathSet:
+    """Return all paths reachable from the start path, excluding itself."""
+    found = set()  # type: PathSet
+    to_visit = [start]
+    while to_visit:
+        path = to_visit.pop()
+        for next_path in edges.get(path, ()):
+            if next_path in found:
+                continue
+            found.add(next_path)
+            to_visit.append(next_path)
+    found.discard(start)
+    return found
+
+
+def file_libraries(bfilepath: pathlib.Path) -> typing.List[pathlib.Path]:
+    """Return the absolute paths of the libraries linked by the blend file.
+
+    Only the LI blocks of the file are inspected. The DNA is only decoded
+    when the location of the library path is not cached for it yet, see
+    BlendFile.library_paths().
+    """
+    bpath = bpathlib.make_absolute(bfilepath)
+    root_dir = bpathlib.BlendPath(bpath.parent)
+
+    with blendfile.BlendFile(bpath, defer_dna=True) as bfile:
+        lib_paths = []
+        for lib_path in bfile.library_paths():
+            lib_bpath = bpathlib.BlendPath(lib_path).absolute(root_dir)
+            lib_paths.append(bpathlib.make_absolute(lib_bpath.to_path()))
+    return lib_paths
+
+
+def iter_blendfiles(project_dir: pathlib.Path) -> typing.Iterator[pathlib.Path]:
+    """Generator, yield the absolute path of every blend file in the project.
+
+    Backup files like 'file.blend1' are skipped, and symlinked directories are
+    not followed.
+    """
+    project_dir = bpathlib.make_absolute(project_dir)
+    for dirpath, dirnames, filenames in os.walk(str(project_dir)):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(".blend"):
+                yield pathlib.Path(dirpath, filename)
+
+
+def scan(
+    project_dir: pathlib.Path,
+    max_workers: typing.Optional[int] = None,
+    executor: typing.Optional[concurrent.futures.Executor] = None,
+) -> LibraryGraph:
+    """Build the library-link graph of all blend files in the project.
+
+    The blend files are read in parallel by a pool of worker processes, while
+    the project directory is still being walked.
+
+    :param max_workers: number of worker processes; defaults to the number
+        of CPUs. Ignored when an executor is given.
+    :param executor: used to read the blend files. When None, a process pool
+        is created with parallel.worker_pool() for the duration of the scan.
+    """
+    if executor is None:
+        with parallel.worker_pool(max_workers) as pool:
+            return scan(project_dir, executor=pool)
+
+    futures = {
+        executor.submit(file_libraries, bfilepath): bfilepath
+        for bfilepath in iter_blendfiles(project_dir)
+    }
+    log.info("Scanning %d blend files in %s", len(futures), project_dir)
+
+    graph = LibraryGraph()
+    for future in concurrent.futures.as_completed(futures):
+        bfilepath = futures[future]
+        try:
+            lib_paths = future.result()
+        except Exception as ex:
+            # A single broken file should not prevent the rest of the project
+            # from being scanned.
+            log.warning("Unable to read %s: %s", bfilepath, ex)
+            graph.errors[bfilepath] = str(ex)
+            continue
+        graph.add_file(bfilepath, lib_paths)
+    return graph
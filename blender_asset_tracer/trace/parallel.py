@@ -0,0 +1,308 @@
+# ***** BEGIN GPL LICENSE BLOCK *****
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+# ***** END GPL LICENCE BLOCK *****
+"""Dependency tracing one blend file at a time.
+
+Each blend file is traced separately: its blocks are expanded and the assets
+they use are found, without following links to other libraries. Instead, the
+libraries that are linked, and the ID blocks to expand from them, are
+reported. Those libraries are then traced in turn.
+
+This allows tracing each blend file in a separate worker process, and storing
+per-file results in a persistent index (see the index module).
+
+BlendFileBlock and dna.Field objects cannot be sent between processes, so the
+workers send back UsageSummary tuples. The parent process turns those back into
+BlockUsage objects, by looking up the blocks in its own copy of the blend file.
+That copy is opened without decoding its DNA; the fields of the usages are
+only looked up in the DNA when they are accessed.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import pathlib
+import typing
+
+from blender_asset_tracer import blendfile, bpathlib
+from blender_asset_tracer.blendfile import dna
+from . import blocks2assets, file2blocks, progress, result
+
+if typing.TYPE_CHECKING:
+    from . import index as _index
+
+log = logging.getLogger(__name__)
+
+# Field of a BlockUsage, as (DNA struct name, field name).
+FieldRef = typing.Tuple[bytes, bytes]
+
+
+class UsageSummary(typing.NamedTuple):
+    """Picklable summary of a result.BlockUsage."""
+
+    bfilepath: pathlib.Path
+    block_addr: int
+    block_name: bytes
+    asset_path: bytes
+    is_sequence: bool
+    path_full_field: typing.Optional[FieldRef]
+    path_dir_field: typing.Optional[FieldRef]
+    path_base_field: typing.Optional[FieldRef]
+
+
+class FileTrace(typing.NamedTuple):
+    """Result of tracing a single blend file in a worker process."""
+
+    usages: typing.List[UsageSummary]
+
+    libraries: typing.Dict[pathlib.Path, typing.FrozenSet[bytes]]
+    """Mapping from linked library to the ID names to expand from it."""
+
+
+def worker_pool(
+    max_workers: typing.Optional[int] = None,
+) -> concurrent.futures.ProcessPoolExecutor:
+    """Create a process pool for use with trace().
+
+    :param max_workers: number of worker processes; defaults to the number
+        of CPUs.
+    """
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_worker,
+        initargs=(
+            blendfile.BlendFile.strict_pointer_mode,
+            blendfile.BlendFile.use_mmap,
+            blendfile.BlendFile.in_memory_limit,
+            blendfile.BlendFile.payload_cache_size,
+        ),
+    )
+
+
+def _init_worker(
+    strict_pointer_mode: bool,
+    use_mmap: bool,
+    in_memory_limit: int,
+    payload_cache_size: int,
+) -> None:
+    blendfile.set_strict_pointer_mode(strict_pointer_mode)
+    blendfile.set_mmap_mode(use_mmap)
+    blendfile.set_in_memory_limit(in_memory_limit)
+    blendfile.set_payload_cache_size(payload_cache_size)
+
+
+def _trace_file_in_worker(
+    bfilepath: pathlib.Path, id_names: typing.Optional[typing.FrozenSet[bytes]]
+) -> FileTrace:
+    try:
+        return trace_file(bfilepath, id_names)
+    finally:
+        blendfile.close_all_cached()
+
+
+def trace_file(
+    bfilepath: pathlib.Path, id_names: typing.Optional[typing.FrozenSet[bytes]]
+) -> FileTrace:
+    """Find the assets used by a single blend file.
+
+    :param id_names: the ID names (like b'OBCube') of the blocks to expand, or
+        None to expand all blocks in the file.
+    """
+    from . import asset_holding_blocks
+
+    bfile = blendfile.open_cached(bfilepath)
+    bi = file2blocks.BlockIterator()
+    field_owners = _field_owners(bfile)
+    blocks_per_lib = {}  # type: typing.Dict[bpathlib.BlendPath, typing.Set]
+
+    def visit_blocks() -> typing.Iterator[blendfile.BlendFileBlock]:
+        names = set(id_names) if id_names else None
+        blocks_per_lib.update((yield from bi.iter_blocks_in_file(bfile, names)))
+
+    usages = [
+        _summarise_usage(usage, field_owners)
+        for block in asset_holding_blocks(visit_blocks())
+        for usage in blocks2assets.iter_assets(block)
+    ]
+
+    libraries = {}  # type: typing.Dict[pathlib.Path, typing.FrozenSet[bytes]]
+    for lib_bpath, idblocks in blocks_per_lib.items():
+        lib_path = bpathlib.make_absolute(lib_bpath.to_path())
+        names = frozenset(idblock[b"name"] for idblock in idblocks)
+        libraries[lib_path] = libraries.get(lib_path, frozenset()) | names
+
+    return FileTrace(usages, libraries)
+
+
+def _field_owners(bfile: blendfile.BlendFile) -> typing.Dict[int, bytes]:
+    """Mapping from id(field) to the name of the struct containing it."""
+    return {
+        id(field): dna_struct.dna_type_id
+        for dna_struct in bfile.structs
+        for field in dna_struct.fields
+    }
+
+
+def _summarise_usage(
+    usage: result.BlockUsage, field_owners: typing.Dict[int, bytes]
+) -> UsageSummary:
+    def field_ref(field: typing.Optional[dna.Field]) -> typing.Optional[FieldRef]:
+        if field is None:
+            return None
+        return field_owners[id(field)], field.name.name_only
+
+    return UsageSummary(
+        bfilepath=usage.block.bfile.filepath,
+        block_addr=usage.block.addr_old,
+        block_name=usage.block_name,
+        asset_path=bytes(usage.asset_path),
+        is_sequence=usage.is_sequence,
+        path_full_field=field_ref(usage.path_full_field),
+        path_dir_field=field_ref(usage.path_dir_field),
+        path_base_field=field_ref(usage.path_base_field),
+    )
+
+
+def _block_usage(summary: UsageSummary) -> result.BlockUsage:
+    """Reconstruct the BlockUsage from its summary.
+
+    Only the block headers of the blend file are read for this. Its DNA is
+    decoded when the fields of the usage are first accessed.
+    """
+    bfile = blendfile.open_cached(summary.bfilepath, defer_dna=True)
+    return _SummarisedUsage(bfile.block_from_addr[summary.block_addr], summary)
+
+
+class _SummarisedUsage(result.BlockUsage):
+    """BlockUsage that looks up its fields in the DNA only when used."""
+
+    def __init__(
+        self, block: blendfile.BlendFileBlock, summary: UsageSummary
+    ) -> None:
+        # Not calling super().__init__(), as that needs the fields right away.
+        self.block = block
+        self.block_name = summary.block_name
+        self.asset_path = bpathlib.BlendPath(summary.asset_path)
+        self.is_sequence = summary.is_sequence
+        self._summary = summary
+        self._abspath = None  # type: typing.Optional[pathlib.Path]
+
+    def _field(self, ref: typing.Optional[FieldRef]) -> typing.Optional[dna.Field]:
+        if ref is None:
+            return None
+        struct_name, field_name = ref
+        bfile = self.block.bfile
+        dna_struct = bfile.struct(struct_name)
+        return dna_struct.field_from_path(bfile.header.pointer_size, field_name)[0]
+
+    @property
+    def path_full_field(self) -> typing.Optional[dna.Field]:
+        return self._field(self._summary.path_full_field)
+
+    @property
+    def path_dir_field(self) -> typing.Optional[dna.Field]:
+        return self._field(self._summary.path_dir_field)
+
+    @property
+    def path_base_field(self) -> typing.Optional[dna.Field]:
+        return self._field(self._summary.path_base_field)
+
+
+def trace(
+    bfilepath: pathlib.Path,
+    progress_cb: progress.Callback,
+    executor: typing.Optional[concurrent.futures.Executor] = None,
+    index: typing.Optional["_index.DependencyIndex"] = None,
+) -> typing.Iterator[result.BlockUsage]:
+    """Generator, yield the block usages of the file and its libraries.
+
+    The same block usage can be yielded multiple times, when different files
+    link to different parts of the same library. Libraries are traced
+    breadth-first, and the results are processed in the order in which the
+    files were submitted, so the output is deterministic.
+
+    :param executor: used to trace the blend files, typically created with
+        worker_pool(). When None, the files are traced in this process.
+    :param index: when given, unchanged blend files are not traced but their
+        results are taken from this index.
+    """
+    bfilepath = bpathlib.make_absolute(bfilepath)
+
+    # Mapping from library path to ID names already submitted for tracing.
+    requested = {}  # type: typing.Dict[pathlib.Path, typing.Set[bytes]]
+
+    # Files that have been submitted for tracing, in order of submission.
+    pending = collections.deque()  # type: typing.Deque[_PendingTrace]
+
+    def submit(
+        path: pathlib.Path, id_names: typing.Optional[typing.FrozenSet[bytes]]
+    ) -> None:
+        log.info("opening: %s", path)
+        progress_cb.trace_blendfile(path)
+
+        stamp = None
+        if index is not None:
+            stamp = index.stamp(path)
+            file_trace = index.lookup(path, id_names, stamp)
+            if file_trace is not None:
+                log.debug("Using indexed trace of %s", path)
+                pending.append(_PendingTrace(path, id_names, None, file_trace))
+                return
+
+        if executor is None:
+            outcome = trace_file(
+                path, id_names
+            )  # type: typing.Union[FileTrace, concurrent.futures.Future]
+        else:
+            outcome = executor.submit(_trace_file_in_worker, path, id_names)
+        pending.append(_PendingTrace(path, id_names, stamp, outcome))
+
+    submit(bfilepath, None)
+    while pending:
+        path, id_names, stamp, outcome = pending.popleft()
+        if isinstance(outcome, concurrent.futures.Future):
+            file_trace = outcome.result()
+        else:
+            file_trace = outcome
+        if index is not None and stamp is not None:
+            index.store(path, id_names, stamp, file_trace)
+
+        for summary in file_trace.usages:
+            yield _block_usage(summary)
+
+        for lib_path, lib_id_names in file_trace.libraries.items():
+            if not lib_path.exists():
+                log.warning("Library %s does not exist", lib_path)
+                continue
+
+            already_requested = requested.setdefault(lib_path, set())
+            new_names = lib_id_names - already_requested
+            if not new_names:
+                continue
+            already_requested.update(new_names)
+            log.debug("Expanding %d blocks in %s", len(new_names), lib_path)
+            submit(lib_path, frozenset(new_names))
+
+
+class _PendingTrace(typing.NamedTuple):
+    path: pathlib.Path
+    id_names: typing.Optional[typing.FrozenSet[bytes]]
+
+    stamp: typing.Optional["_index.FileStamp"]
+    """Stamp of the file before tracing; None when it was taken from the index."""
+
+    outcome: typing.Union[FileTrace, concurrent.futures.Future]